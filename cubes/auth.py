@@ -63,6 +63,12 @@ class Authorizer(object):
         # TODO: provisional feature, might change
         return []
 
+    def unlimited_export(self, token):
+        """Returns ``True`` if `token` is allowed to request results without
+        the server's record limit, for example for data exports. Default
+        implementation returns ``False``."""
+        return False
+
 
 class NoopAuthorizer(Authorizer):
     def __init__(self):
@@ -71,8 +77,9 @@ class NoopAuthorizer(Authorizer):
 
 class _SimpleAccessRight(object):
     def __init__(self, roles, allowed_cubes, denied_cubes, cell_restrictions,
-                 hierarchy_limits):
+                 hierarchy_limits, unlimited_export=False):
         self.roles = set(roles) if roles else set([])
+        self.unlimited_export = bool(unlimited_export)
         self.cell_restrictions = cell_restrictions or {}
 
         self.hierarchy_limits = defaultdict(list)
@@ -114,9 +121,11 @@ class _SimpleAccessRight(object):
         * `allowed_cubes` are merged (union)
         * `denied_cubes` are merged (union)
         * `cube_restrictions` from `other` with same cube replace restrictions
-          from the receiver"""
+          from the receiver
+        * `unlimited_export` is allowed if it is allowed in any of them"""
 
         self.roles |= other.roles
+        self.unlimited_export = self.unlimited_export or other.unlimited_export
         self.allowed_cubes |= other.allowed_cubes
         self.denied_cubes |= other.denied_cubes
 
@@ -187,7 +196,8 @@ class _SimpleAccessRight(object):
             "allowed_cubes": list(self.allowed_cubes),
             "denied_cubes": list(self.denied_cubes),
             "cell_restrictions": self.cell_restrictions,
-            "hierarchy_limits": self.hierarchy_limits
+            "hierarchy_limits": self.hierarchy_limits,
+            "unlimited_export": self.unlimited_export
         }
 
         return as_dict
@@ -199,7 +209,8 @@ def right_from_dict(info):
                allowed_cubes=info.get('allowed_cubes'),
                denied_cubes=info.get('denied_cubes'),
                cell_restrictions=info.get('cell_restrictions'),
-               hierarchy_limits=info.get('hierarchy_limits')
+               hierarchy_limits=info.get('hierarchy_limits'),
+               unlimited_export=info.get('unlimited_export')
            )
 
 class SimpleAuthorizer(Authorizer):
@@ -379,3 +390,11 @@ class SimpleAuthorizer(Authorizer):
         return right.hierarchy_limits.get(str(cube), [])
 
 
+
+    def unlimited_export(self, token):
+        try:
+            right = self.right(token)
+        except NotAuthorized:
+            return False
+
+        return right.unlimited_export
@@ -3,6 +3,7 @@ from ...errors import *
 from ...browser import *
 from ...computation import *
 from ...statutils import calculators_for_aggregates, available_calculators
+from ...common import to_unicode_string
 from cubes import statutils
 from .mapper import MongoCollectionMapper
 from .datesupport import DateSupport
@@ -12,6 +13,7 @@ from .util import to_json_safe, collapse_record
 import collections
 import copy
 import pymongo
+import pymongo.errors
 import bson
 import re
 
@@ -27,6 +29,9 @@ tz_utc = pytz.timezone('UTC')
 
 SO_FAR_DIMENSION_REGEX = re.compile(r"^.+_sf$", re.IGNORECASE)
 
+# Number of concurrently executed report queries
+DEFAULT_REPORT_WORKERS = 4
+
 def is_date_dimension(dim):
     if isinstance(dim, basestring):
         return 'date' in dim.lower()
@@ -38,11 +43,34 @@ def is_date_dimension(dim):
         return False
 
 class Mongo2Browser(AggregationBrowser):
+    __options__ = [
+        {
+            "name": "report_workers",
+            "type": "int"
+        },
+        {
+            "name": "report_timeout",
+            "type": "float"
+        },
+        {
+            "name": "timeout",
+            "type": "float"
+        }
+    ]
+
     def __init__(self, cube, store, locale=None, metadata={}, url=None, **options):
         super(Mongo2Browser, self).__init__(cube, store)
 
         self.logger = get_logger()
 
+        # Report queries share the thread-safe connection pool of the client
+        self.report_workers = options.get("report_workers",
+                                          DEFAULT_REPORT_WORKERS)
+        self.report_timeout = options.get("report_timeout")
+
+        # Queries are stopped by the server after `maxTimeMS`
+        self.timeout = options.get("timeout")
+
         database = store.database
         if cube.browser_options.get('database'):
             database = cube.browser_options.get('database')
@@ -66,7 +94,8 @@ class Mongo2Browser(AggregationBrowser):
         features = {
             "facts": ["fields", "missing_values"],
             "aggregate_functions": available_aggregate_functions(),
-            "post_aggregate_functions": available_calculators()
+            "post_aggregate_functions": available_calculators(),
+            "query_options": ["timeout"]
         }
 
         cube_actions = self.cube.browser_options.get("actions")
@@ -125,7 +154,8 @@ class Mongo2Browser(AggregationBrowser):
                                                     drilldown=drilldown,
                                                     split=split, order=order,
                                                     page=page,
-                                                    page_size=page_size)
+                                                    page_size=page_size,
+                                                    timeout=options.get("timeout"))
         result.cells = iter(items)
         result.summary = summary or {}
         # add calculated measures w/o drilldown or split if no drilldown or split
@@ -163,6 +193,10 @@ class Mongo2Browser(AggregationBrowser):
         # TODO include fields_obj, fully populated
         cursor = self.data_store.find(query_obj)
 
+        max_time_ms = self._max_time_ms(options.get("timeout"))
+        if max_time_ms:
+            cursor = cursor.max_time_ms(max_time_ms)
+
         order = self.prepare_order(order)
         if order:
             order_obj = self._order_to_sort_object(order)
@@ -176,7 +210,7 @@ class Mongo2Browser(AggregationBrowser):
             cursor = cursor.limit(page_size)
 
         facts = MongoFactsIterator(cursor, attributes, self.mapper,
-                                   self.datesupport)
+                                   self.datesupport, timeout=max_time_ms)
 
         return facts
 
@@ -214,7 +248,8 @@ class Mongo2Browser(AggregationBrowser):
                                                                  hierarchy,
                                                                  levels)],
                                                      order=order, page=page,
-                                                     page_size=page_size)
+                                                     page_size=page_size,
+                                                     timeout=options.get("timeout"))
 
         data = []
         for item in cursor:
@@ -228,6 +263,88 @@ class Mongo2Browser(AggregationBrowser):
 
         return data
 
+    def path_details(self, dimension, path, hierarchy=None):
+        """Returns details for `path` in `dimension`, see
+        `paths_details()`."""
+        return self.paths_details(dimension, [path], hierarchy)[0]
+
+    def paths_details(self, dimension, paths, hierarchy=None):
+        """Returns details of `paths` of one `dimension` hierarchy. Details
+        of all the paths are fetched with one aggregation pipeline that
+        matches any of the paths and groups by the level attributes. Date
+        dimension levels are parts of a date, their details are the path
+        values."""
+
+        dimension = self.cube.dimension(dimension)
+        hierarchy = dimension.hierarchy(hierarchy)
+
+        for path in paths:
+            if len(path) > len(hierarchy):
+                raise ArgumentError("Path %s has more items than there are "
+                                    "levels in dimension %s"
+                                    % (path, dimension.name))
+
+        if is_date_dimension(dimension):
+            return [dict((level.key.ref(), value) for level, value
+                         in zip(hierarchy.levels, path))
+                    for path in paths]
+
+        depth = max(len(path) for path in paths) if paths else 0
+        if not depth:
+            return [None] * len(paths)
+
+        cut = SetCut(dimension, [path for path in paths if path],
+                     hierarchy=hierarchy)
+        query_obj, fields_obj = self._build_query_and_fields(Cell(self.cube,
+                                                                  [cut]),
+                                                             [])
+        group_id = {}
+        for level in hierarchy.levels[0:depth]:
+            for attr in level.attributes:
+                ref = escape_level(attr.ref())
+                fields_obj[ref] = self.mapper.physical(attr).project_expression()
+                group_id[ref] = "$%s" % ref
+
+        pipeline = [
+            { "$match": query_obj },
+            { "$project": fields_obj },
+            { "$group": { "_id": group_id } }
+        ]
+        self.logger.debug("PIPELINE: %s", pipeline)
+
+        options = {}
+        max_time_ms = self._max_time_ms()
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
+
+        try:
+            results = self.data_store.aggregate(pipeline, **options)
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError("Query did not finish in %s ms"
+                                    % max_time_ms)
+
+        members = [dict((unescape_level(key), value) for key, value
+                        in item["_id"].items())
+                   for item in results.get('result', [])]
+
+        details = []
+        for path in paths:
+            keys = [level.key.ref() for level in hierarchy.levels[0:len(path)]]
+            values = [to_unicode_string(value) for value in path]
+            found = None
+            if path:
+                for member in members:
+                    if [to_unicode_string(member.get(key))
+                            for key in keys] == values:
+                        found = dict((attr.ref(), member.get(attr.ref()))
+                                     for level
+                                     in hierarchy.levels[0:len(path)]
+                                     for attr in level.attributes)
+                        break
+            details.append(found)
+
+        return details
+
     def _in_same_collection(self, physical_ref):
         return (physical_ref.database == self.mapper.database) and (physical_ref.collection == self.mapper.collection)
 
@@ -271,8 +388,17 @@ class Mongo2Browser(AggregationBrowser):
 
         return query, fields
 
+    def _max_time_ms(self, timeout=None):
+        """Returns the query time limit in milliseconds for `maxTimeMS` or
+        ``None`` if there is no limit. See `query_timeout()`."""
+        timeout = self.query_timeout(timeout)
+        if timeout:
+            return max(int(timeout * 1000), 1)
+        else:
+            return None
+
     def _do_aggregation_query(self, cell, aggregates, attributes, drilldown,
-                              split, order, page, page_size):
+                              split, order, page, page_size, timeout=None):
 
         # determine query for cell cut
         query_obj, fields_obj = self._build_query_and_fields(cell, attributes)
@@ -282,12 +408,21 @@ class Mongo2Browser(AggregationBrowser):
         if not aggregates:
             raise ArgumentError("No aggregates provided.")
 
+        max_time_ms = self._max_time_ms(timeout)
+
         if (not drilldown and not split) \
                 and len(aggregates) == 1 \
                 and aggregates[0].function in ("count", "identity"):
 
             self.logger.debug("doing plain aggregation")
-            return (self.data_store.find(query_obj).count(), [])
+            cursor = self.data_store.find(query_obj)
+            if max_time_ms:
+                cursor = cursor.max_time_ms(max_time_ms)
+            try:
+                return (cursor.count(), [])
+            except pymongo.errors.ExecutionTimeout:
+                raise QueryTimeoutError("Query did not finish in %s ms"
+                                        % max_time_ms)
 
         group_id = {}
 
@@ -429,7 +564,16 @@ class Mongo2Browser(AggregationBrowser):
         result_items = []
         self.logger.debug("PIPELINE: %s", pipeline)
 
-        results = self.data_store.aggregate(pipeline).get('result', [])
+        options = {}
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
+
+        try:
+            results = self.data_store.aggregate(pipeline, **options)
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError("Query did not finish in %s ms"
+                                    % max_time_ms)
+        results = results.get('result', [])
         results = [date_transform(r) for r in results]
 
         if timezone_shift_processing:
@@ -681,12 +825,21 @@ def unescape_level(ref):
 
 
 class MongoFactsIterator(Facts):
-    def __init__(self, facts, attributes, mapper, datesupport):
+    def __init__(self, facts, attributes, mapper, datesupport, timeout=None):
         super(MongoFactsIterator, self).__init__(facts, attributes)
         self.mapper = mapper
         self.datesupport = datesupport
+        self.timeout = timeout
 
     def __iter__(self):
+        try:
+            for record in self._records():
+                yield record
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError("Query did not finish in %s ms"
+                                    % self.timeout)
+
+    def _records(self):
         for fact in self.facts:
             fact = to_json_safe(fact)
             fact = collapse_record(fact)
@@ -7,11 +7,29 @@ import urllib
 from ...logging import get_logger
 from ...browser import *
 
+# Number of concurrently executed report queries
+DEFAULT_REPORT_WORKERS = 4
+
 class SlicerBrowser(AggregationBrowser):
     """Aggregation browser for Cubes Slicer OLAP server."""
 
+    __options__ = [
+        {
+            "name": "report_workers",
+            "type": "int"
+        },
+        {
+            "name": "report_timeout",
+            "type": "float"
+        }
+    ]
+
     def __init__(self, cube, store, locale=None, **options):
         """Browser for another Slicer server.
+
+        Report queries are sent as concurrent requests, at most
+        `report_workers` (default 4) at once. `report_timeout` is the report
+        deadline in seconds.
         """
         super(SlicerBrowser, self).__init__(cube, store, locale)
 
@@ -20,6 +38,10 @@ class SlicerBrowser(AggregationBrowser):
         self.locale = locale
         self.store = store
 
+        self.report_workers = options.get("report_workers",
+                                          DEFAULT_REPORT_WORKERS)
+        self.report_timeout = options.get("report_timeout")
+
     def features(self):
 
         # Get the original features as provided by the Slicer server.
@@ -4,12 +4,23 @@
 from ...browser import *
 from ...logging import get_logger
 from ...statutils import calculators_for_aggregates, available_calculators
+from ...statutils import SampleEstimator, DEFAULT_CONFIDENCE
 from ...errors import *
+from ...common import to_unicode_string
 from .mapper import SnowflakeMapper, DenormalizedMapper
 from .functions import get_aggregate_function, available_aggregate_functions
-from .query import QueryBuilder
+from .query import QueryBuilder, SnowflakeSchema, snowflake_schema_key
+from .query import CachedStatement, cell_shape, cell_parameters
+from .navigator import AggregateNavigator
+from .utils import supports_window_functions, column_python_types
+from .utils import supports_grouping_sets, statement_canceller
+from .utils import supports_statement_timeout, limit_session_timeout
+from .utils import is_session_timeout_error
+from .utils import tablesample_clause
 
 import collections
+import itertools
+import threading
 
 try:
     import sqlalchemy
@@ -23,6 +34,12 @@ __all__ = [
     "SnowflakeBrowser",
 ]
 
+# Number of rows fetched from a result cursor at once
+DEFAULT_FETCH_SIZE = 1000
+
+# Number of concurrently executed report queries
+DEFAULT_REPORT_WORKERS = 4
+
 
 class SnowflakeBrowser(AggregationBrowser):
     __options__ = [
@@ -41,6 +58,42 @@ class SnowflakeBrowser(AggregationBrowser):
         {
             "name": "safe_labels",
             "type": "bool"
+        },
+        {
+            "name": "single_pass_aggregation",
+            "type": "bool"
+        },
+        {
+            "name": "use_aggregates",
+            "type": "bool"
+        },
+        {
+            "name": "stream_results",
+            "type": "bool"
+        },
+        {
+            "name": "fetch_size",
+            "type": "int"
+        },
+        {
+            "name": "report_workers",
+            "type": "int"
+        },
+        {
+            "name": "report_timeout",
+            "type": "float"
+        },
+        {
+            "name": "merge_report_queries",
+            "type": "bool"
+        },
+        {
+            "name": "timeout",
+            "type": "float"
+        },
+        {
+            "name": "sample_confidence",
+            "type": "float"
         }
 
     ]
@@ -67,6 +120,37 @@ class SnowflakeBrowser(AggregationBrowser):
         * `include_cell_count` – if ``True`` then total cell count is included
           in aggregation result. Turned on by default.
           performance reasons
+        * `single_pass_aggregation` – if ``True`` then drill-down summary
+          and total cell count are computed with window functions within
+          the drill-down statement instead of separate queries, if the
+          database supports window functions. Default is ``False``.
+        * `use_aggregates` – if ``True`` then aggregations are computed from
+          the smallest materialized cuboid (see
+          `SQLStore.create_cube_aggregate()`) that contains all the required
+          attributes and aggregates. Default is ``False``.
+        * `stream_results` – if ``True`` then facts are fetched through a
+          server-side cursor, if the database driver supports it. The rows
+          are not buffered in the client before the first one is returned.
+          Default is ``False``.
+        * `fetch_size` – number of rows fetched from a cursor at once.
+          Default is 1000.
+        * `report_workers` – number of report queries executed concurrently,
+          each with its own pooled connection. Default is 4. Queries are
+          executed one after another if the engine has only one connection
+          (such as in-memory SQLite).
+        * `report_timeout` – report deadline in seconds, no deadline by
+          default
+        * `merge_report_queries` – if ``True`` (default) then report
+          aggregation queries that differ only in the drill-down are
+          computed by one statement with ``GROUPING SETS``, if the database
+          supports it
+        * `timeout` – time limit of every statement in seconds, no limit by
+          default. Statements are cancelled when the limit is reached on
+          SQLite and PostgreSQL and `QueryTimeoutError` is raised.
+          Queries might request a shorter limit with the `timeout`
+          argument.
+        * `sample_confidence` – confidence level of intervals of aggregates
+          estimated from a sample (see `aggregate()`), default is 0.95
 
         Limitations:
 
@@ -88,6 +172,7 @@ class SnowflakeBrowser(AggregationBrowser):
         # Database connection and metadata
         # --------------------------------
 
+        self.store = store
         self.connectable = store.connectable
         self.metadata = store.metadata or sqlalchemy.MetaData(bind=self.connectable)
 
@@ -103,9 +188,33 @@ class SnowflakeBrowser(AggregationBrowser):
 
         self.include_summary = options.get("include_summary", True)
         self.include_cell_count = options.get("include_cell_count", True)
+        self.single_pass_aggregation = options.get("single_pass_aggregation",
+                                                   False)
         self.safe_labels = options.get("safe_labels", False)
+        self.stream_results = options.get("stream_results", False)
+        self.fetch_size = options.get("fetch_size") or DEFAULT_FETCH_SIZE
+
+        self.report_workers = options.get("report_workers",
+                                          DEFAULT_REPORT_WORKERS)
+        self.report_timeout = options.get("report_timeout")
+        self.merge_report_queries = options.get("merge_report_queries", True)
+        self.timeout = options.get("timeout")
+        self.sample_confidence = options.get("sample_confidence") \
+                                    or DEFAULT_CONFIDENCE
+
+        # Connections of single-connection pools can not be used by
+        # multiple threads
+        pool = getattr(self.connectable, "pool", None)
+        if isinstance(pool, (sqlalchemy.pool.SingletonThreadPool,
+                             sqlalchemy.pool.StaticPool)):
+            self.report_workers = 1
         self.label_counter = 1
 
+        if options.get("use_aggregates"):
+            self.navigator = AggregateNavigator(self, store.aggregate_registry)
+        else:
+            self.navigator = None
+
         # Mapper
         # ------
 
@@ -114,16 +223,46 @@ class SnowflakeBrowser(AggregationBrowser):
         # about relevant joins to be able to retrieve certain attributes.
 
         if options.get("use_denormalization"):
-            mapper_class = DenormalizedMapper
+            self.mapper_class = DenormalizedMapper
         else:
-            mapper_class = SnowflakeMapper
+            self.mapper_class = SnowflakeMapper
+
+        self.mapper_options = options
 
         self.logger.debug("using mapper %s for cube '%s' (locale: %s)" %
-                          (str(mapper_class.__name__), cube.name, locale))
+                          (str(self.mapper_class.__name__), cube.name, locale))
 
-        self.mapper = mapper_class(cube, locale=self.locale, **options)
+        # Mappers and their schema keys by locale – reused on locale switch
+        self._mappers = {}
+        self._set_mapper(self.locale)
         self.logger.debug("mapper schema: %s" % self.mapper.schema)
 
+    def _set_mapper(self, locale):
+        """Sets the browser's mapper for `locale` and the key of the reflected
+        schema corresponding to the mapper. Mappers are created only once per
+        locale."""
+        try:
+            (mapper, key) = self._mappers[locale]
+        except KeyError:
+            mapper = self.mapper_class(self.cube, locale=locale,
+                                       **self.mapper_options)
+            key = snowflake_schema_key(self.cube, mapper, self.safe_labels)
+            self._mappers[locale] = (mapper, key)
+
+        self.mapper = mapper
+        self.schema_key = key
+
+    def snowflake_schema(self):
+        """Returns a `SnowflakeSchema` for the browsed cube and current
+        locale. The reflected schema is shared through the store's schema
+        cache by all browsers with the same cube, locale and mapping."""
+
+        def create_schema():
+            return SnowflakeSchema(self.cube, self.mapper, self.metadata,
+                                   safe_labels=self.safe_labels)
+
+        return self.store.schema_cache.schema(self.schema_key, create_schema)
+
     def features(self):
         """Return SQL features. Currently they are all the same for every
         cube, however in the future they might depend on the SQL engine or
@@ -132,21 +271,80 @@ class SnowflakeBrowser(AggregationBrowser):
         features = {
             "actions": ["aggregate", "fact", "facts", "cell"],
             "aggregate_functions": available_aggregate_functions(),
-            "post_aggregate_functions": available_calculators()
+            "post_aggregate_functions": available_calculators(),
+            "query_options": ["after"]
+        }
+
+        if supports_statement_timeout(self.connectable.dialect):
+            features["query_options"].append("timeout")
+
+        approximate = self.approximate_aggregates()
+        if approximate:
+            features["approximate_aggregates"] = approximate
+
+        features["sampling"] = {
+            "method": self.sampling_method(),
+            "confidence": self.sample_confidence
         }
 
         return features
 
+    def sampling_method(self):
+        """Returns how facts are sampled by aggregations with the `sample`
+        argument: ``tablesample`` if the database supports the
+        ``TABLESAMPLE`` clause, otherwise ``modulo`` – facts are chosen by
+        their key."""
+
+        if tablesample_clause(self.connectable.dialect, 0.01):
+            return "tablesample"
+        else:
+            return "modulo"
+
+    def approximate_aggregates(self):
+        """Returns a dictionary of cube's aggregates that are estimated,
+        such as ``approx_count_distinct``. Values are dictionaries with
+        keys ``function``, ``method`` (``native``, ``hyperloglog`` or
+        ``exact``) and ``relative_error`` – relative standard error of the
+        estimate, ``None`` if not known."""
+
+        dialect = self.connectable.dialect
+        precision = getattr(self.store, "hll_precision", None)
+
+        approximate = {}
+        for aggregate in self.cube.aggregates:
+            try:
+                function = get_aggregate_function(aggregate.function)
+            except KeyError:
+                continue
+
+            if not hasattr(function, "relative_error"):
+                continue
+
+            if precision:
+                error = function.relative_error(dialect, precision)
+            else:
+                error = function.relative_error(dialect)
+
+            approximate[aggregate.name] = {
+                "function": aggregate.function,
+                "method": function.method(dialect),
+                "relative_error": error
+            }
+
+        return approximate
+
     def is_builtin_function(self, name, aggregate):
         return self.builtin_function(name, aggregate) is not None
 
     def set_locale(self, locale):
         """Change the browser's locale"""
         self.logger.debug("changing browser's locale to %s" % locale)
-        self.mapper.set_locale(locale)
+        # Mapper might be referenced by a shared schema, therefore we do not
+        # change the locale of the existing one.
+        self._set_mapper(locale)
         self.locale = locale
 
-    def fact(self, key_value, fields=None):
+    def fact(self, key_value, fields=None, timeout=None):
         """Get a single fact with key `key_value` from cube.
 
         Number of SQL queries: 1."""
@@ -159,7 +357,8 @@ class SnowflakeBrowser(AggregationBrowser):
 
         builder.fact(key_value)
 
-        cursor = self.execute_statement(builder.statement, "facts")
+        cursor = self.execute_statement(builder.route_partitions(), "facts",
+                                        timeout=timeout)
         row = cursor.fetchone()
 
         if row:
@@ -173,13 +372,19 @@ class SnowflakeBrowser(AggregationBrowser):
         return record
 
     def facts(self, cell=None, fields=None, order=None, page=None,
-              page_size=None):
+              page_size=None, timeout=None, after=None):
         """Return all facts from `cell`, might be ordered and paginated.
 
+        Paginated facts are ordered by the fact key after the `order`. The
+        returned iterator has a `next_page` token (see `page_token()`) that
+        can be passed as `after` to get the following page. Page `page` is
+        ignored if `after` is specified.
+
         Number of SQL queries: 1.
         """
 
         cell = cell or Cell(self.cube)
+        page = self._keyset_page(page, page_size, after)
 
         attributes = self.cube.get_attributes(fields)
 
@@ -189,21 +394,42 @@ class SnowflakeBrowser(AggregationBrowser):
                                        include_fact_key=True)
         builder.paginate(page, page_size)
         order = self.prepare_order(order, is_aggregate=False)
-        builder.order(order)
+        builder.order(order, keyset=bool(page_size))
 
-        cursor = self.execute_statement(builder.statement,
-                                        "facts")
+        parameters = self._seek(builder, after)
 
-        return ResultIterator(cursor, builder.labels)
+        cursor = self.execute_statement(builder.route_partitions(),
+                                        "facts",
+                                        stream=self.stream_results,
+                                        parameters=parameters,
+                                        timeout=timeout)
+
+        types = column_python_types(builder.statement.columns)
+        return self._page_iterator(cursor, builder, page_size, types=types,
+                                   fetch_size=self.fetch_size)
 
     def members(self, cell, dimension, depth=None, hierarchy=None, page=None,
-                page_size=None, order=None):
+                page_size=None, order=None, timeout=None, after=None):
         """Return values for `dimension` with level depth `depth`. If `depth`
         is ``None``, all levels are returned.
 
-        Number of database queries: 1.
+        Paginated members can be continued with the `next_page` token of the
+        returned iterator passed as `after`, see `facts()`.
+
+        If the store has a member cache (see `member_cache_ttl` store
+        option), then members of an unrestricted cell are returned from the
+        cache.
+
+        Number of database queries: 1 or 0 with a member cache.
         """
+        if not (cell and cell.cuts) and not order and page_size is None \
+                and after is None:
+            cached = self._cached_members(dimension, hierarchy, depth)
+            if cached is not None:
+                return [dict(member) for member in cached[0]]
+
         cell = cell or Cell(self.cube)
+        page = self._keyset_page(page, page_size, after)
         order = self.prepare_order(order, is_aggregate=False)
 
         dimension = self.cube.dimension(dimension)
@@ -223,21 +449,136 @@ class SnowflakeBrowser(AggregationBrowser):
         builder = QueryBuilder(self)
         builder.members_statement(cell, attributes)
         builder.paginate(page, page_size)
-        builder.order(order)
+        builder.order(order, keyset=bool(page_size))
+
+        parameters = self._seek(builder, after)
+
+        result = self.execute_statement(builder.route_partitions(),
+                                        "members",
+                                        parameters=parameters,
+                                        timeout=timeout)
+
+        return self._page_iterator(result, builder, page_size)
+
+    def _cached_members(self, dimension, hierarchy=None, depth=None):
+        """Returns a tuple (`members`, `index`) of all members of `dimension`
+        `hierarchy` up to level `depth` from the store member cache, or
+        ``None`` if the store has no member cache. `index` is a dictionary
+        of members by tuples of level keys converted to strings.
+
+        Members are selected from the dimension tables, therefore members
+        without facts are included."""
+
+        cache = self.store.member_cache
+        if cache is None:
+            return None
 
-        result = self.execute_statement(builder.statement, "members")
+        dimension = self.cube.dimension(dimension)
+        hierarchy = dimension.hierarchy(hierarchy)
+        if depth == 0:
+            raise ArgumentError("Depth for dimension members should not be 0")
+        depth = depth or len(hierarchy)
 
-        return ResultIterator(result, builder.labels)
+        def load():
+            levels = hierarchy.levels[0:depth]
+            attributes = []
+            for level in levels:
+                attributes += level.attributes
+
+            builder = QueryBuilder(self)
+            builder.dimension_members_statement(attributes)
+            builder.order(self.prepare_order(None, is_aggregate=False))
+
+            result = self.execute_statement(builder.route_partitions(),
+                                            "dimension members")
+            members = list(ResultIterator(result, builder.labels))
+
+            keys = [level.key.ref() for level in levels]
+            index = {}
+            for member in members:
+                index[_path_key(member[key] for key in keys)] = member
+
+            return (members, index)
+
+        key = (self.schema_key, dimension.name, hierarchy.name, depth)
+        return cache.get(key, load)
+
+    def _keyset_page(self, page, page_size, after):
+        """Returns the page to be passed to `QueryBuilder.paginate()`: 0 if
+        the page follows the `after` token or if only `page_size` is
+        specified (the first page), otherwise `page`."""
+        if after is None:
+            if page is None and page_size:
+                return 0
+            return page
+        elif not page_size:
+            raise ArgumentError("Page size is required for a page following "
+                                "a page token")
+        else:
+            return 0
+
+    def _seek(self, builder, after):
+        """Restricts statement of `builder` to rows following the page token
+        `after`, if specified. Returns the bound parameters of the token
+        values or ``None``."""
+        if after is None:
+            return None
+
+        builder.seek()
+        return self._seek_parameters(builder.keyset, after)
+
+    def _seek_parameters(self, keyset, after):
+        """Returns bound parameters of `QueryBuilder.seek()` condition from
+        the page token `after`."""
+        names = [name for name, index in keyset]
+        values = page_token_values(after, names)
+        return QueryBuilder.seek_parameters(values)
+
+    def _next_page(self, keyset, rows, page_size):
+        """Returns token of the page following `rows` or ``None`` if `rows`
+        is the last page."""
+        if not rows or len(rows) < page_size:
+            return None
+
+        last = rows[-1]
+        return page_token([name for name, index in keyset],
+                          [last[index] for name, index in keyset])
+
+    def _page_iterator(self, cursor, builder, page_size, **options):
+        """Returns a `ResultIterator` of the `cursor`. If the statement of
+        `builder` is paginated, rows of the page are fetched to get the
+        `next_page` token of the iterator."""
+
+        if not page_size:
+            return ResultIterator(cursor, builder.labels, **options)
+
+        rows = cursor.fetchall()
+        iterator = ResultIterator(cursor, builder.labels, rows, **options)
+        iterator.next_page = self._next_page(builder.keyset, rows, page_size)
+
+        return iterator
 
     def path_details(self, dimension, path, hierarchy=None):
         """Returns details for `path` in `dimension`. Can be used for
         multi-dimensional "breadcrumbs" in a used interface.
 
-        Number of SQL queries: 1.
+        Details are looked up in the store member cache first, if there is
+        one. Paths missing in the cache are queried.
+
+        Number of SQL queries: 1 or 0 with a member cache.
         """
         dimension = self.cube.dimension(dimension)
         hierarchy = dimension.hierarchy(hierarchy)
 
+        if path and len(path) <= len(hierarchy):
+            cached = self._cached_members(dimension, hierarchy, len(path))
+            if cached is not None:
+                try:
+                    return dict(cached[1][_path_key(path)])
+                except KeyError:
+                    self.logger.debug("path %s of %s is not cached"
+                                      % (path, dimension.name))
+
         cut = PointCut(dimension, path, hierarchy=hierarchy)
         cell = Cell(self.cube, [cut])
 
@@ -250,7 +591,7 @@ class SnowflakeBrowser(AggregationBrowser):
                                        attributes,
                                        include_fact_key=True)
         builder.paginate(0, 1)
-        cursor = self.execute_statement(builder.statement,
+        cursor = self.execute_statement(builder.route_partitions(),
                                         "path details")
 
         row = cursor.fetchone()
@@ -262,11 +603,195 @@ class SnowflakeBrowser(AggregationBrowser):
 
         return member
 
-    def execute_statement(self, statement, label=None):
+    def paths_details(self, dimension, paths, hierarchy=None):
+        """Returns details of `paths` of `dimension`, see
+        `AggregationBrowser.paths_details()`. Paths are looked up in the
+        store member cache first, if there is one.
+
+        Number of SQL queries: one for each length of paths not found in
+        the member cache.
+        """
+        dimension = self.cube.dimension(dimension)
+        hierarchy = dimension.hierarchy(hierarchy)
+
+        details = [None] * len(paths)
+
+        # Indexes of queried paths by path length
+        queried = collections.OrderedDict()
+
+        for i, path in enumerate(paths):
+            if path and len(path) <= len(hierarchy):
+                cached = self._cached_members(dimension, hierarchy, len(path))
+                if cached is not None:
+                    member = cached[1].get(_path_key(path))
+                    if member is not None:
+                        details[i] = dict(member)
+                        continue
+                queried.setdefault(len(path), []).append(i)
+            else:
+                # Not a valid path for the IN condition, query it alone
+                details[i] = self.path_details(dimension, path, hierarchy)
+
+        for depth, indexes in queried.items():
+            builder = QueryBuilder(self)
+            builder.paths_details_statement(dimension,
+                                            [paths[i] for i in indexes],
+                                            hierarchy)
+            cursor = self.execute_statement(builder.route_partitions(),
+                                            "paths details")
+
+            levels = hierarchy.levels[0:depth]
+            keys = [level.key.ref() for level in levels]
+            members = {}
+            for row in cursor:
+                member = dict(zip(builder.labels, row))
+                members.setdefault(_path_key(member[key] for key in keys),
+                                   member)
+
+            for i in indexes:
+                details[i] = members.get(_path_key(paths[i]))
+
+        return details
+
+    def execute_statement(self, statement, label=None, stream=False,
+                          parameters=None, timeout=None):
         """Execute the `statement`, optionally log it. Returns the result
-        cursor."""
+        cursor. If `stream` is ``True`` then the statement is executed with
+        a server-side cursor, where the database driver supports it.
+        `parameters` is a dictionary of bound parameter values, `statement`
+        might be a compiled statement as well.
+
+        The statement is cancelled if it does not finish within `timeout`
+        seconds (see `query_timeout()`) and `QueryTimeoutError` is raised.
+        The limit applies to the execution, not to fetching of the rows.
+        SQLite and PostgreSQL (psycopg2) statements are cancelled, MySQL and
+        MariaDB statements are limited by a session setting. `ArgumentError`
+        is raised if the database can not limit the statement.
+
+        The statement is executed on a read replica of the store, if there
+        are any. If the replica can not be connected or the connection is
+        lost, the statement is executed on the next one and eventually on
+        the primary database."""
+
         self._log_statement(statement, label)
-        return self.connectable.execute(statement)
+        if stream:
+            statement = statement.execution_options(stream_results=True)
+
+        args = [statement]
+        if parameters is not None:
+            args.append(parameters)
+
+        timeout = self.query_timeout(timeout)
+
+        replicas = self.store.replicas
+        connectables = replicas.connectables()
+        last = len(connectables) - 1
+
+        for i, connectable in enumerate(connectables):
+            # The connection is returned to the pool when the result is
+            # closed
+            try:
+                connection = connectable.connect(close_with_result=True)
+            except sqlalchemy.exc.DBAPIError as e:
+                if i == last:
+                    raise
+                replicas.mark_failed(connectable, e)
+                continue
+
+            try:
+                return self._execute(connection, args, label, timeout)
+            except sqlalchemy.exc.DBAPIError as e:
+                if i == last or not e.connection_invalidated:
+                    raise
+                replicas.mark_failed(connectable, e)
+
+    def _execute(self, connection, args, label, timeout):
+        """Executes statement with `args` on `connection`, see
+        `execute_statement()`. The connection is closed if the execution
+        fails."""
+
+        cancel = None
+        limited = False
+        if timeout:
+            cancel = statement_canceller(connection.dialect,
+                                         connection.connection.connection)
+
+        if timeout and not cancel:
+            try:
+                limited = limit_session_timeout(connection, timeout)
+            except sqlalchemy.exc.DBAPIError:
+                connection.close()
+                raise
+
+            if not limited:
+                connection.close()
+                raise ArgumentError("Query timeout is not supported by "
+                                    "database dialect '%s'"
+                                    % connection.dialect.name)
+
+        if not cancel:
+            try:
+                return connection.execute(*args)
+            except sqlalchemy.exc.DBAPIError as e:
+                connection.close()
+                if limited and is_session_timeout_error(e):
+                    self.logger.warn("statement (%s) interrupted after %s "
+                                     "seconds" % (label, timeout))
+                    raise QueryTimeoutError("Query did not finish in %s "
+                                            "seconds" % timeout)
+                raise
+
+        lock = threading.Lock()
+        state = {"running": True, "cancelled": False}
+
+        def cancel_statement():
+            with lock:
+                if state["running"]:
+                    state["cancelled"] = True
+                    cancel()
+
+        timer = threading.Timer(timeout, cancel_statement)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            result = connection.execute(*args)
+        except sqlalchemy.exc.DBAPIError:
+            connection.close()
+            if state["cancelled"]:
+                self.logger.warn("statement (%s) cancelled after %s seconds"
+                                 % (label, timeout))
+                raise QueryTimeoutError("Query did not finish in %s seconds"
+                                        % timeout)
+            raise
+        finally:
+            with lock:
+                state["running"] = False
+            timer.cancel()
+
+        return result
+
+    def _statement_key(self, kind, cell, drilldown, aggregates, split=None,
+                       order=None, *options):
+        """Returns a key of a statement cache for a query of given shape:
+        cube schema, `kind` of the statement, shapes of the `cell` and
+        `split` (see `cell_shape()`), drill-down levels, aggregates, `order`
+        and other statement `options`. Fact partitions of the cell are part
+        of the key if the facts are partitioned."""
+
+        partitions = self.snowflake_schema().partition_tables(cell)
+        if partitions is not None:
+            options += (tuple(partitions), )
+
+        return (self.schema_key,
+                kind,
+                cell_shape(cell),
+                cell_shape(split),
+                tuple(drilldown.items_as_strings()) if drilldown else (),
+                tuple(str(agg) for agg in aggregates),
+                tuple((str(attr.ref()), direction)
+                      for attr, direction in order or []),
+                options)
 
     def aggregate(self, cell=None, measures=None, drilldown=None, split=None,
                   attributes=None, page=None, page_size=None, order=None,
@@ -293,14 +818,48 @@ class SnowflakeBrowser(AggregationBrowser):
           computed as well, otherwise it will be ``None``.
         * `include_summary`: if ``True`` (default) then summary is computed,
           otherwise it will be ``None``
-
-        Result is paginated by `page_size` and ordered by `order`.
+        * `timeout`: time limit of every statement in seconds, at most the
+          browser's `timeout`
+        * `sample`: fraction of facts to aggregate, such as ``0.01``, for
+          fast approximate results. See below.
+        * `after`: page token of the previous page, see below
+
+        Result is paginated by `page_size` and ordered by `order`. Paginated
+        drill-down cells are ordered also by all the drill-down attributes
+        and `result.next_page` is a token of the following page. The token
+        passed as `after` selects the cells following the last cell of the
+        previous page instead of skipping `page` pages.
 
         Number of database queries:
 
         * without drill-down: 1 – summary
         * with drill-down (default): 3 – summary, drilldown, total drill-down
           record count
+        * with drill-down and `single_pass_aggregation`: 1 – summary and
+          total record count are computed together with the drill-down, if
+          the database supports window functions and all the aggregates can
+          be rolled up. Otherwise summary or total count are fetched by
+          separate queries.
+
+        If `use_aggregates` is set and there is a materialized cuboid that
+        contains all attributes of the cell, drilldown and order and all the
+        aggregates, then the queries are issued against the cuboid table.
+
+        Sampling:
+
+        If `sample` is specified, then only a sample of facts is aggregated:
+        the fact table is sampled with ``TABLESAMPLE`` if the database
+        supports it, otherwise facts with integer keys divisible by ``round(1
+        / sample)`` are aggregated (`ArgumentError` is raised for other
+        keys). Additive aggregates (``sum``, ``count``
+        and ``count_nonempty``) are scaled up by the sampled fraction and
+        every cell and the summary have bounds of their confidence intervals
+        in ``<aggregate>_lower`` and ``<aggregate>_upper``. Other aggregates
+        are computed from the sample as they are. Cells without any sampled
+        fact are missing and `total_cell_count` is the number of sampled
+        cells. `result.sample` describes the sampling.
+
+        Aggregations routed to a materialized cuboid are not sampled.
 
         Notes:
 
@@ -318,62 +877,168 @@ class SnowflakeBrowser(AggregationBrowser):
         drilldown = Drilldown(drilldown, cell)
         result = AggregationResult(cell=cell, aggregates=aggregates)
 
-        # Summary
-        # -------
-
-        if include_summary or \
-                (include_summary is None and self.include_summary) or \
-                not (drilldown or split):
-
-            builder = QueryBuilder(self)
-            builder.aggregation_statement(cell,
-                                          aggregates=aggregates,
-                                          drilldown=drilldown,
-                                          summary_only=True)
-
-            cursor = self.execute_statement(builder.statement,
-                                            "aggregation summary")
-            row = cursor.fetchone()
-
-            # TODO: use builder.labels
-            if row:
-                # Convert SQLAlchemy object into a dictionary
-                record = dict(zip(builder.labels, row))
-            else:
-                record = None
-
-            cursor.close()
-            result.summary = record
-
+        if include_summary is None:
+            include_summary = self.include_summary
         if include_cell_count is None:
             include_cell_count = self.include_cell_count
 
+        timeout = options.get("timeout")
+
+        sample = options.get("sample")
+        if sample is not None:
+            try:
+                sample = float(sample)
+            except (TypeError, ValueError):
+                raise ArgumentError("Sample should be a number, not %r"
+                                    % (sample, ))
+            if not 0 < sample <= 1:
+                raise ArgumentError("Sample should be greater than 0 and "
+                                    "at most 1, not %s" % (sample, ))
+            if sample == 1:
+                sample = None
+
+        after = options.get("after")
+        page = self._keyset_page(page, page_size, after)
+
+        # Aggregate tables
+        # ----------------
+
+        if self.navigator and not split:
+            cuboid = self.navigator.find_cuboid(cell, drilldown, aggregates,
+                                    self.prepare_order(order, is_aggregate=True))
+        else:
+            cuboid = None
+
+        if cuboid:
+            self.logger.debug("aggregating from cuboid table '%s'"
+                              % cuboid.table)
+            browser = self.navigator.cuboid_browser(cuboid)
+            result = browser.aggregate(Cell(browser.cube, cell.cuts),
+                                       aggregates=[a.name for a in aggregates],
+                                       drilldown=drilldown.items_as_strings(),
+                                       page=page,
+                                       page_size=page_size,
+                                       order=order,
+                                       include_summary=include_summary,
+                                       include_cell_count=include_cell_count,
+                                       timeout=timeout,
+                                       after=after)
+            result.cell = cell
+            return result
+
+        # Window totals would be computed from the sample without scaling or
+        # only from the cells following the page token
+        single_pass = (drilldown or split) \
+                        and self.single_pass_aggregation \
+                        and not sample \
+                        and after is None \
+                        and supports_window_functions(self.connectable.dialect)
 
         # Drill-down
         # ----------
         #
         # Note that a split cell if present prepends the drilldown
 
+        summary = None
+        total_cell_count = None
+
         if drilldown or split:
-            if not (page_size and page is not None):
+            paginated = bool(page_size and page is not None)
+            if not paginated:
                 self.assert_low_cardinality(cell, drilldown)
 
             result.levels = drilldown.result_levels(include_split=bool(split))
 
-            self.logger.debug("preparing drilldown statement")
-
-            builder = QueryBuilder(self)
-            builder.aggregation_statement(cell,
-                                          drilldown=drilldown,
-                                          aggregates=aggregates,
-                                          split=split)
-            builder.paginate(page, page_size)
             order = self.prepare_order(order, is_aggregate=True)
-            builder.order(order)
-
-            cursor = self.execute_statement(builder.statement,
-                                            "aggregation drilldown")
-
+            key = self._statement_key("drilldown", cell, drilldown,
+                                      aggregates, split, order,
+                                      (page, page_size)
+                                        if page_size and page is not None
+                                        else None,
+                                      single_pass and include_summary,
+                                      single_pass and include_cell_count,
+                                      sample,
+                                      after is not None)
+            cached = self.store.statement_cache.get(key)
+
+            if cached:
+                (statement, count_statement, totals, sampling,
+                 keyset) = cached
+            else:
+                self.logger.debug("preparing drilldown statement")
+
+                builder = QueryBuilder(self)
+                builder.aggregation_statement(cell,
+                                              drilldown=drilldown,
+                                              aggregates=aggregates,
+                                              split=split,
+                                              sample=sample)
+                sampling = self._sampling(builder)
+
+                if single_pass:
+                    totals = builder.window_totals(aggregates,
+                                                   include_summary,
+                                                   include_cell_count)
+                else:
+                    totals = []
+
+                # Statement for the total cell count, if needed
+                count_statement = builder.route_partitions().alias().count()
+                count_statement = CachedStatement(count_statement, None,
+                                                  self.connectable.dialect)
+
+                builder.paginate(page, page_size)
+                builder.order(order, keyset=paginated)
+                if after is not None:
+                    builder.seek()
+                keyset = builder.keyset
+
+                statement = CachedStatement(builder.route_partitions(),
+                                            builder.labels,
+                                            self.connectable.dialect)
+                if builder.cacheable:
+                    self.store.statement_cache.set(key, (statement,
+                                                         count_statement,
+                                                         totals,
+                                                         sampling,
+                                                         keyset))
+
+            parameters = cell_parameters(cell)
+            parameters.update(cell_parameters(split, "s"))
+
+            drilldown_parameters = dict(parameters)
+            if after is not None:
+                drilldown_parameters.update(self._seek_parameters(keyset,
+                                                                  after))
+
+            cursor = self.execute_statement(statement.compiled,
+                                            "aggregation drilldown",
+                                            parameters=drilldown_parameters,
+                                            timeout=timeout)
+            labels = statement.labels
+
+            batch = None
+            if totals:
+                # Totals are the same in every row, take them from the first
+                # one. If there is none (page out of range), use separate
+                # queries.
+                batch = cursor.fetchmany()
+                if batch:
+                    row = batch[0]
+                    values = row[len(labels):]
+                    totals = zip(totals, values)
+
+                    if totals[0][0] is None:
+                        total_cell_count = totals.pop(0)[1]
+                    if totals:
+                        summary = dict(totals)
+
+            if paginated:
+                # Fetch the page to get the last cell
+                batch = list(batch or [])
+                if not cursor.closed:
+                    batch += cursor.fetchall()
+                result.next_page = self._next_page(keyset, batch, page_size)
             #
             # Find post-aggregation calculations and decorate the result
             #
@@ -382,18 +1047,99 @@ class SnowflakeBrowser(AggregationBrowser):
                                                             drilldown,
                                                             split,
                                                             available_aggregate_functions())
-            result.cells = ResultIterator(cursor, builder.labels)
-            result.labels = builder.labels
-
-            # TODO: Introduce option to disable this
+            types = column_python_types(statement.statement.columns)
+            result.types = dict(zip(labels, types))
+
+            if sampling:
+                (method, fraction, squares) = sampling
+                estimator = SampleEstimator(fraction, self.sample_confidence)
+                result.sample = self._sample_info(method, estimator)
+
+                hidden = [label for agg, label in squares if label]
+                cells = ResultIterator(cursor, labels + hidden, batch,
+                                       types=types)
+                estimate = lambda record: self._estimate_sampled(record,
+                                                                 estimator,
+                                                                 squares)
+                result.cells = itertools.imap(estimate, cells)
+
+                interval_labels = self._interval_labels(squares)
+                for label in interval_labels:
+                    result.types[label] = float
+                for aggregate, label in squares:
+                    result.types[aggregate.name] = float
+                result.labels = labels + interval_labels
+            else:
+                result.cells = ResultIterator(cursor, labels, batch,
+                                              types=types)
+                result.labels = labels
 
             if include_cell_count:
-                count_statement = builder.statement.alias().count()
-                row_count = self.execute_statement(count_statement).fetchone()
-                total_cell_count = row_count[0]
+                if total_cell_count is None:
+                    row_count = self.execute_statement(count_statement.compiled,
+                                                       "aggregation count",
+                                                       parameters=parameters,
+                                                       timeout=timeout)
+                    total_cell_count = row_count.fetchone()[0]
                 result.total_cell_count = total_cell_count
 
-        elif result.summary is not None:
+        # Summary
+        # -------
+
+        if summary is not None:
+            result.summary = summary
+
+        elif include_summary or not (drilldown or split):
+
+            key = self._statement_key("summary", cell, drilldown,
+                                      aggregates, None, None, sample)
+            cached = self.store.statement_cache.get(key)
+
+            if cached:
+                (statement, sampling) = cached
+            else:
+                builder = QueryBuilder(self)
+                builder.aggregation_statement(cell,
+                                              aggregates=aggregates,
+                                              drilldown=drilldown,
+                                              summary_only=True,
+                                              sample=sample)
+                statement = CachedStatement(builder.route_partitions(),
+                                            builder.labels,
+                                            self.connectable.dialect)
+                sampling = self._sampling(builder)
+                if builder.cacheable:
+                    self.store.statement_cache.set(key, (statement,
+                                                         sampling))
+
+            cursor = self.execute_statement(statement.compiled,
+                                            "aggregation summary",
+                                            parameters=cell_parameters(cell),
+                                            timeout=timeout)
+            row = cursor.fetchone()
+
+            if sampling:
+                (method, fraction, squares) = sampling
+                hidden = [label for agg, label in squares if label]
+                estimator = SampleEstimator(fraction, self.sample_confidence)
+                result.sample = self._sample_info(method, estimator)
+            else:
+                hidden = []
+
+            # TODO: use builder.labels
+            if row:
+                # Convert SQLAlchemy object into a dictionary
+                record = dict(zip(statement.labels + hidden, row))
+                if sampling:
+                    record = self._estimate_sampled(record, estimator,
+                                                    squares)
+            else:
+                record = None
+
+            cursor.close()
+            result.summary = record
+
+        if not (drilldown or split) and result.summary is not None:
             # Do calculated measures on summary if no drilldown or split
             # TODO: should not we do this anyway regardless of
             # drilldown/split?
@@ -407,6 +1153,210 @@ class SnowflakeBrowser(AggregationBrowser):
 
         return result
 
+    def _sampling(self, builder):
+        """Returns a tuple (`method`, `fraction`, `squares`) describing the
+        sampling of the last aggregation statement of `builder` or ``None``
+        if the statement is not sampled."""
+        if builder.sample_method:
+            return (builder.sample_method, builder.sample_fraction,
+                    builder.sample_squares)
+        else:
+            return None
+
+    def _sample_info(self, method, estimator):
+        return {
+            "method": method,
+            "fraction": estimator.fraction,
+            "confidence": estimator.confidence
+        }
+
+    def _interval_labels(self, squares):
+        """Returns labels of confidence interval bounds of the estimated
+        aggregates from `squares` (see `QueryBuilder.sample_squares`)."""
+        labels = []
+        for aggregate, label in squares:
+            labels += [aggregate.name + "_lower", aggregate.name + "_upper"]
+        return labels
+
+    def _estimate_sampled(self, record, estimator, squares):
+        """Scales additive aggregates of `record` aggregated from a sample
+        and sets bounds of their confidence intervals. Sums of squares are
+        removed from the record."""
+
+        for aggregate, label in squares:
+            value = record.get(aggregate.name)
+            square = record.pop(label, None) if label else None
+            (lower, upper) = estimator.interval(value, square)
+
+            record[aggregate.name] = estimator.estimate(value)
+            record[aggregate.name + "_lower"] = lower
+            record[aggregate.name + "_upper"] = upper
+
+        return record
+
+    def report_jobs(self, cell, queries):
+        """Returns report jobs. Aggregation queries with the same cell,
+        aggregates and roll-up that differ only in the drill-down are
+        bundled into one job computed by a single ``GROUPING SETS``
+        statement, if the database supports it and `merge_report_queries`
+        is enabled. Queries with other arguments (such as pagination or
+        order) are performed separately."""
+
+        if not self.merge_report_queries or self.navigator \
+                or not supports_grouping_sets(self.connectable.dialect):
+            return super(SnowflakeBrowser, self).report_jobs(cell, queries)
+
+        mergeable_keys = set(["query", "drilldown", "aggregates", "rollup"])
+        groups = collections.OrderedDict()
+        others = {}
+
+        for name, query in sorted(queries.items()):
+            if query.get("query") != "aggregate" \
+                    or not query.get("drilldown") \
+                    or not set(query.keys()) <= mergeable_keys:
+                others[name] = query
+                continue
+
+            rollup = query.get("rollup")
+            query_cell = cell.rollup(rollup) if rollup else cell
+
+            try:
+                aggregates = self.prepare_aggregates(query.get("aggregates"))
+                drilldown = Drilldown(query["drilldown"], query_cell)
+                self.assert_low_cardinality(query_cell, drilldown)
+            except UserError:
+                # Let the query fail on its own
+                others[name] = query
+                continue
+
+            key = (repr(rollup), tuple(str(agg) for agg in aggregates))
+            group = groups.setdefault(key, (query_cell, aggregates, []))
+            group[2].append((name, drilldown))
+
+        jobs = []
+        for query_cell, aggregates, items in groups.values():
+            if len(items) == 1:
+                name = items[0][0]
+                others[name] = queries[name]
+                continue
+
+            names = tuple(name for name, drilldown in items)
+            function = self._grouped_aggregate_function(query_cell,
+                                                        aggregates,
+                                                        items)
+            jobs.append((names, function))
+
+        jobs += super(SnowflakeBrowser, self).report_jobs(cell, others)
+
+        return jobs
+
+    def _grouped_aggregate_function(self, cell, aggregates, items):
+        """Returns a function that aggregates `cell` by drilldowns of `items`
+        – list of (`name`, `drilldown`) tuples."""
+        def function(timeout=None):
+            timeout = self.report_query_timeout(timeout)
+            return self.grouped_aggregate(cell, aggregates, items,
+                                          timeout=timeout)
+        return function
+
+    def grouped_aggregate(self, cell, aggregates, items, timeout=None):
+        """Aggregates `cell` by every drilldown of `items` – list of
+        (`name`, `Drilldown`) tuples – with one ``GROUPING SETS`` statement.
+        `aggregates` is a list of prepared aggregates. Returns a dictionary
+        of `AggregationResult`s by name. The cells are ordered by the
+        drill-down levels and every result has the cell summary and the
+        total cell count. `timeout` is the time limit of the statements.
+
+        If the statement can not be composed (see
+        `QueryBuilder.grouping_sets_statement()`), then the drilldowns are
+        aggregated separately."""
+
+        builder = QueryBuilder(self)
+        drilldowns = [drilldown for name, drilldown in items]
+        statement = builder.grouping_sets_statement(cell, drilldowns,
+                                                    aggregates)
+
+        if statement is None:
+            results = {}
+            for name, drilldown in items:
+                results[name] = self.aggregate(cell,
+                                               drilldown=drilldown,
+                                               aggregates=aggregates,
+                                               timeout=timeout)
+            return results
+
+        cursor = self.execute_statement(builder.route_partitions(statement),
+                                        "grouped aggregation",
+                                        timeout=timeout)
+        labels = builder.labels
+        # There is one GROUPING() indicator for every attribute
+        attribute_count = len(statement.columns) - len(labels)
+        types = column_python_types(statement.columns)[:len(labels)]
+
+        # Rows by tuple of grouped (non-rolled-up) attribute labels
+        rows = collections.defaultdict(list)
+        for row in cursor:
+            flags = row[len(labels):]
+            grouped = tuple(label for label, flag
+                            in zip(labels[:attribute_count], flags)
+                            if not flag)
+            rows[frozenset(grouped)].append(dict(zip(labels, row)))
+        cursor.close()
+
+        aggregate_labels = labels[attribute_count:]
+        summaries = rows.get(frozenset())
+        if summaries:
+            summary = dict((label, summaries[0][label])
+                           for label in aggregate_labels)
+        else:
+            summary = None
+
+        results = {}
+        for name, drilldown in items:
+            drilldown_labels = [self.mapper.logical(attr) for attr
+                                in drilldown.all_attributes()]
+            result_labels = drilldown_labels + aggregate_labels
+
+            cells = rows.get(frozenset(drilldown_labels), [])
+            cells = [dict((label, row[label]) for label in result_labels)
+                     for row in cells]
+            self._sort_cells(cells, drilldown)
+
+            result = AggregationResult(cell=cell, aggregates=aggregates)
+            result.levels = drilldown.result_levels()
+            result.labels = result_labels
+            result.summary = dict(summary) if summary is not None else None
+            result.total_cell_count = len(cells)
+            result.types = dict((label, type_) for label, type_
+                                in zip(labels, types)
+                                if label in result_labels)
+            result.calculators = calculators_for_aggregates(self.cube,
+                                                    aggregates,
+                                                    drilldown,
+                                                    None,
+                                                    available_aggregate_functions())
+            result.cells = cells
+            results[name] = result
+
+        return results
+
+    def _sort_cells(self, cells, drilldown):
+        """Sorts `cells` in place by the order attributes of `drilldown`
+        levels, the same way as the aggregation statement is ordered by
+        default."""
+
+        order = []
+        for dditem in drilldown:
+            for level in dditem.levels:
+                attribute = level.order_attribute or level.key
+                order.append((self.mapper.logical(attribute),
+                              level.order or "asc"))
+
+        # Stable sort from the least significant level
+        for label, direction in reversed(order):
+            cells.sort(key=lambda cell: cell.get(label),
+                       reverse=(direction.lower().startswith("desc")))
+
     def builtin_function(self, name, aggregate):
         """Returns a built-in function for `aggregate`"""
         try:
@@ -515,24 +1465,100 @@ class SnowflakeBrowser(AggregationBrowser):
         return issues
 
 
+def _path_key(values):
+    """Returns a hashable key of path `values` where all the values are
+    converted to unicode strings, as path values might be strings from an
+    URL or values of any type from the database."""
+    return tuple(to_unicode_string(value) for value in values)
+
+
 class ResultIterator(object):
     """
     Iterator that returns SQLAlchemy ResultProxy rows as dictionaries
     """
-    def __init__(self, result, labels):
+    def __init__(self, result, labels, batch=None, types=None,
+                 fetch_size=None):
+        """Creates an iterator over `result` rows. `batch` is an optional
+        list of rows that were already fetched from the `result`. Row
+        values beyond `labels` are ignored. `types` is a list of Python
+        types of the values, if known. `fetch_size` is number of rows
+        fetched from the cursor at once, default is
+        ``DEFAULT_FETCH_SIZE``."""
         self.result = result
-        self.batch = None
+        self.batch = collections.deque(batch) if batch else None
         self.labels = labels
+        self.types = dict(zip(labels, types)) if types else {}
+        self.fetch_size = fetch_size or DEFAULT_FETCH_SIZE
+
+        # Token of the following page of paginated results
+        self.next_page = None
 
     def __iter__(self):
         return self
 
     def next(self):
         if not self.batch:
-            many = self.result.fetchmany()
+            # Result is closed when all rows were already fetched
+            if self.result.closed:
+                raise StopIteration
+            many = self.result.fetchmany(self.fetch_size)
             if not many:
                 raise StopIteration
             self.batch = collections.deque(many)
 
         row = self.batch.popleft()
         return dict(zip(self.labels, row))
+
+    def columns(self, limit=None):
+        """Returns remaining rows as an ordered dictionary where keys are
+        labels and values are lists of row values. At most `limit` rows are
+        fetched if specified. Rows are transposed as they are fetched,
+        without creating a dictionary for every row."""
+
+        rows = list(self.batch or [])
+        self.batch = None
+
+        if limit:
+            rows = rows[:limit]
+
+        if not self.result.closed:
+            if not limit:
+                rows += self.result.fetchall()
+            elif len(rows) < limit:
+                rows += self.result.fetchmany(limit - len(rows))
+
+        return self._transpose(rows)
+
+    def column_batches(self, size=1000):
+        """Yields remaining rows in batches of at most `size` rows fetched
+        from the cursor. Every batch is an ordered dictionary of value lists
+        by label, as in `columns()`."""
+
+        while True:
+            rows = []
+            while self.batch and len(rows) < size:
+                rows.append(self.batch.popleft())
+
+            if len(rows) < size and not self.result.closed:
+                rows += self.result.fetchmany(size - len(rows))
+
+            if not rows:
+                break
+
+            yield self._transpose(rows)
+
+    def close(self):
+        """Closes the result cursor and releases its connection. Use when
+        the remaining rows are not going to be fetched, for example to free
+        a server-side cursor."""
+        self.batch = None
+        self.result.close()
+
+    def _transpose(self, rows):
+        if rows:
+            values = zip(*rows)
+        else:
+            values = [()] * len(self.labels)
+
+        return collections.OrderedDict((label, list(column)) for label, column
+                                       in zip(self.labels, values))
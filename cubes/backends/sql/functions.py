@@ -2,6 +2,8 @@
 
 from collections import namedtuple
 from ...errors import *
+from ...statutils import HyperLogLog, hyperloglog_error
+from ...statutils import DEFAULT_HLL_PRECISION
 
 try:
     import sqlalchemy
@@ -20,7 +22,11 @@ except ImportError:
 
 __all__ = (
     "get_aggregate_function",
-    "available_aggregate_functions"
+    "available_aggregate_functions",
+    "get_rollup_function",
+    "rollup_function_name",
+    "merge_records",
+    "register_sqlite_functions"
 )
 
 
@@ -78,6 +84,21 @@ class AggregateFunction(object):
 
         Returns a SQLAlchemy expression."""
 
+        column = self.measure_column(aggregate, context)
+
+        if coalesce:
+            column = self.coalesce_value(aggregate, column)
+
+        expression = self.function(column, *self.args, **self.kwargs)
+
+        if coalesce:
+            expression = self.coalesce_aggregate(aggregate, expression)
+
+        return expression
+
+    def measure_column(self, aggregate, context):
+        """Returns column of the measure aggregated by `aggregate`."""
+
         if not context:
             raise InternalError("No context provided for AggregationFunction")
 
@@ -91,17 +112,7 @@ class AggregateFunction(object):
         except NoSuchAttributeError:
             source = context.cube.aggregate(aggregate.measure)
 
-        column = context.column(source)
-
-        if coalesce:
-            column = self.coalesce_value(aggregate, column)
-
-        expression = self.function(column, *self.args, **self.kwargs)
-
-        if coalesce:
-            expression = self.coalesce_aggregate(aggregate, expression)
-
-        return expression
+        return context.column(source)
 
     def __str__(self):
         return self.name
@@ -149,6 +160,102 @@ class FactCountFunction(AggregateFunction):
         else:
             return sql.functions.count(1)
 
+def _count_distinct(column):
+    return sql.functions.count(sql.expression.distinct(column))
+
+
+# Dialects with a native approximate distinct count function
+_native_distinct_functions = {
+    "oracle": "approx_count_distinct",
+    "mssql": "approx_count_distinct",
+    "snowflake": "approx_count_distinct",
+    "bigquery": "approx_count_distinct",
+    "vertica": "approximate_count_distinct",
+    "presto": "approx_distinct",
+    "trino": "approx_distinct"
+}
+
+# Name of the HyperLogLog aggregate registered in SQLite connections
+SQLITE_HLL_FUNCTION = "cubes_approx_count_distinct"
+
+
+class ApproximateDistinctFunction(SummaryCoalescingFunction):
+    def __init__(self, name):
+        """Creates a function that estimates number of distinct values of a
+        measure. Dialect-native function is used, if there is one. In SQLite
+        the values are counted by a HyperLogLog aggregate computed in Python
+        (see `register_sqlite_functions()`). Other databases count the
+        distinct values exactly."""
+        super(ApproximateDistinctFunction, self).__init__(name)
+
+    def method(self, dialect):
+        """Returns how the function is computed in SQL `dialect`:
+        ``native``, ``hyperloglog`` or ``exact``."""
+        if dialect.name in _native_distinct_functions:
+            return "native"
+        elif dialect.name == "sqlite":
+            return "hyperloglog"
+        else:
+            return "exact"
+
+    def relative_error(self, dialect, precision=DEFAULT_HLL_PRECISION):
+        """Returns relative standard error of the estimate in SQL `dialect`,
+        ``0`` for exact count and ``None`` if it is not known (native
+        functions)."""
+        method = self.method(dialect)
+        if method == "hyperloglog":
+            return hyperloglog_error(precision)
+        elif method == "exact":
+            return 0.0
+        else:
+            return None
+
+    def apply(self, aggregate, context=None, coalesce=False):
+        column = self.measure_column(aggregate, context)
+        dialect = context.browser.connectable.dialect
+        method = self.method(dialect)
+
+        if method == "native":
+            function = getattr(sql.expression.func,
+                               _native_distinct_functions[dialect.name])
+            expression = function(column)
+        elif method == "hyperloglog":
+            function = getattr(sql.expression.func, SQLITE_HLL_FUNCTION)
+            expression = function(column)
+        else:
+            expression = _count_distinct(column)
+
+        if coalesce:
+            expression = self.coalesce_aggregate(aggregate, expression)
+
+        return expression
+
+
+class _HyperLogLogAggregate(object):
+    """SQLite aggregate class, see `register_sqlite_functions()`."""
+    precision = DEFAULT_HLL_PRECISION
+
+    def __init__(self):
+        self.counter = HyperLogLog(self.precision)
+
+    def step(self, value):
+        self.counter.add(value)
+
+    def finalize(self):
+        return self.counter.count()
+
+
+def register_sqlite_functions(dbapi_connection,
+                              precision=DEFAULT_HLL_PRECISION):
+    """Registers aggregate functions implemented in Python into a SQLite
+    DB-API connection: HyperLogLog distinct count with 2^`precision`
+    registers used by the ``approx_count_distinct`` aggregate function."""
+
+    aggregate = type("HyperLogLogAggregate", (_HyperLogLogAggregate, ),
+                     {"precision": precision})
+    dbapi_connection.create_aggregate(SQLITE_HLL_FUNCTION, 1, aggregate)
+
+
 class avg(ReturnTypeFromArgs):
     pass
 
@@ -165,6 +272,8 @@ class variance(ReturnTypeFromArgs):
 _functions = (
     SummaryCoalescingFunction("sum", sql.functions.sum),
     SummaryCoalescingFunction("count_nonempty", sql.functions.count),
+    SummaryCoalescingFunction("count_distinct", _count_distinct),
+    ApproximateDistinctFunction("approx_count_distinct"),
     FactCountFunction("count"),
     ValueCoalescingFunction("min", sql.functions.min),
     ValueCoalescingFunction("max", sql.functions.max),
@@ -176,6 +285,17 @@ _functions = (
 
 _function_dict = {}
 
+# Functions that combine values computed by an aggregate function for
+# disjoint groups of facts into a value for the whole set of facts. Functions
+# not listed here (such as `avg`) can not be combined that way.
+_rollup_functions = {
+    "sum": "sum",
+    "count": "sum",
+    "count_nonempty": "sum",
+    "min": "min",
+    "max": "max"
+}
+
 
 def _create_function_dict():
     if not _function_dict:
@@ -197,3 +317,57 @@ def available_aggregate_functions():
     _create_function_dict()
     return _function_dict.keys()
 
+
+def rollup_function_name(name):
+    """Returns name of an aggregate function that combines partial aggregates
+    computed by aggregate function `name`, for example ``sum`` for
+    ``count``. Returns ``None`` if the function `name` results can not be
+    combined."""
+    return _rollup_functions.get(name)
+
+
+def get_rollup_function(name):
+    """Returns a SQL function that combines partial aggregates computed by
+    aggregate function `name`, for example ``SUM`` for ``count``. Returns
+    ``None`` if the function `name` results can not be combined."""
+    rollup = _rollup_functions.get(name)
+    if rollup:
+        return getattr(sql.functions, rollup)
+    else:
+        return None
+
+
+def merge_records(records, functions):
+    """Returns one record merged from `records` – partial aggregations of the
+    same cell, for example from multiple shards. `functions` is a dictionary
+    of roll-up function names (``sum``, ``min`` or ``max``, see
+    `rollup_function_name()`) by aggregate label. Other values are taken
+    from the first record."""
+
+    merged = None
+    for record in records:
+        if merged is None:
+            merged = dict(record)
+            continue
+
+        for label, function in functions.items():
+            merged[label] = _merge_value(function,
+                                         merged.get(label),
+                                         record.get(label))
+
+    return merged
+
+
+def _merge_value(function, value, other):
+    if value is None:
+        return other
+    elif other is None:
+        return value
+    elif function == "sum":
+        return value + other
+    elif function == "min":
+        return min(value, other)
+    elif function == "max":
+        return max(value, other)
+    else:
+        raise ArgumentError("Unknown roll-up function '%s'" % (function, ))
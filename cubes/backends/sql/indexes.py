@@ -0,0 +1,252 @@
+# -*- coding=utf -*-
+"""Index recommendations based on logged queries."""
+
+from ...logging import get_logger
+from ...errors import *
+from .browser import SnowflakeBrowser
+
+from collections import namedtuple, OrderedDict
+
+try:
+    import sqlalchemy
+except ImportError:
+    from cubes.common import MissingPackage
+    sqlalchemy = MissingPackage("sqlalchemy", "SQL index advisor")
+
+
+__all__ = [
+    "IndexAdvisor",
+    "RecommendedIndex"
+]
+
+
+RecommendedIndex = namedtuple("RecommendedIndex",
+                              ["schema", "table", "columns", "elapsed_time",
+                               "queries"])
+
+
+class IndexAdvisor(object):
+    def __init__(self, store, cube, method="aggregate"):
+        """Recommends indexes of tables of `cube` in `store` for `method`
+        queries logged by a `SQLRequestLogHandler` with dimensions table.
+
+        Two kinds of composite indexes are considered for every logged
+        query:
+
+        * fact table index on columns that join or contain keys of the cut
+          levels followed by those of the drilled-down levels
+        * dimension table index on keys of cut levels stored in the
+          dimension table
+
+        Indexes are ranked by total elapsed time of the queries that would
+        use them. Indexes covered by existing indexes are not recommended.
+        """
+
+        self.store = store
+        self.cube = cube
+        self.method = method
+        self.logger = get_logger()
+
+        self.browser = SnowflakeBrowser(cube, store, use_aggregates=False)
+        self.mapper = self.browser.mapper
+        self.fact_key = (self.mapper.schema, self.mapper.fact_name)
+
+        # Aliased tables of joins
+        self.aliases = {}
+        for join in getattr(self.mapper, "joins", None) or []:
+            if join.alias:
+                self.aliases[(join.detail.schema, join.alias)] = \
+                        (join.detail.schema, join.detail.table)
+
+    def table_key(self, schema, table):
+        """Returns (`schema`, `table`) of the physical table of possibly
+        aliased `table`."""
+        key = (schema or self.mapper.schema, table)
+        return self.aliases.get((schema, table), key)
+
+    def query_levels(self, uses):
+        """Returns a tuple (`cuts`, `drilldown`) of lists of (`dimension`,
+        `levels`) used in a logged query. `uses` are tuples returned by
+        `SQLRequestLogHandler.query_uses()`. Returns ``None`` if the query
+        does not match the cube model anymore."""
+
+        cuts = []
+        drilldown = []
+
+        for dim, hier, level, used_as in uses:
+            if not level:
+                continue
+
+            try:
+                dim = self.cube.dimension(dim)
+                hierarchy = dim.hierarchy(hier)
+            except (ModelError, NoSuchDimensionError):
+                return None
+
+            names = [str(l) for l in hierarchy.levels]
+            if level not in names:
+                return None
+            levels = hierarchy.levels[0:names.index(level) + 1]
+
+            if used_as == "drilldown":
+                drilldown.append((dim, levels))
+            else:
+                cuts.append((dim, levels))
+
+        return (cuts, drilldown)
+
+    def fact_columns(self, levels):
+        """Returns list of fact table columns which contain keys of `levels`
+        or which join the tables with the keys."""
+
+        columns = []
+        for level in levels:
+            ref = self.mapper.physical(level.key)
+            if ref.expr or ref.func:
+                continue
+
+            if self.table_key(ref.schema, ref.table) == self.fact_key:
+                column = ref.column
+            else:
+                column = None
+                for join in self.mapper.relevant_joins([level.key]):
+                    master = (join.master.schema or self.mapper.schema,
+                              join.master.table)
+                    if master == self.fact_key:
+                        column = join.master.column
+                        break
+
+            if column and column not in columns:
+                columns.append(column)
+
+        return columns
+
+    def dimension_columns(self, levels):
+        """Returns list of tuples (`table`, `columns`) of key columns of
+        `levels` stored outside of the fact table. `table` is a tuple
+        (`schema`, `table`)."""
+
+        tables = OrderedDict()
+        for level in levels:
+            ref = self.mapper.physical(level.key)
+            if ref.expr or ref.func:
+                continue
+
+            table = self.table_key(ref.schema, ref.table)
+            if table == self.fact_key:
+                continue
+
+            columns = tables.setdefault(table, [])
+            if ref.column not in columns:
+                columns.append(ref.column)
+
+        return list(tables.items())
+
+    def candidates(self, query_uses):
+        """Returns a dictionary of candidate indexes – keys are tuples
+        (`schema`, `table`, `columns`), values are tuples (`elapsed_time`,
+        `queries`) of the logged queries in `query_uses`."""
+
+        candidates = {}
+
+        def add(table, columns, count, elapsed):
+            key = table + (tuple(columns), )
+            (total_elapsed, total_count) = candidates.get(key, (0.0, 0))
+            candidates[key] = (total_elapsed + elapsed, total_count + count)
+
+        for uses, count, elapsed in query_uses:
+            query = self.query_levels(uses)
+            if query is None:
+                self.logger.debug("ignoring logged query of unknown levels "
+                                  "%s" % (uses, ))
+                continue
+
+            (cuts, drilldown) = query
+
+            # Cut keys first: they are restricted by equality or range
+            columns = []
+            for dim, levels in cuts + drilldown:
+                for column in self.fact_columns(levels):
+                    if column not in columns:
+                        columns.append(column)
+
+            if columns:
+                add(self.fact_key, columns, count, elapsed)
+
+            for dim, levels in cuts:
+                for table, columns in self.dimension_columns(levels):
+                    add(table, columns, count, elapsed)
+
+        return candidates
+
+    def existing_indexes(self, schema, table):
+        """Returns list of column lists of existing indexes of `table`."""
+        inspector = sqlalchemy.inspect(self.store.connectable)
+        try:
+            indexes = inspector.get_indexes(table, schema=schema)
+        except sqlalchemy.exc.NoSuchTableError:
+            return []
+
+        columns = [index["column_names"] for index in indexes]
+        try:
+            pk = inspector.get_pk_constraint(table, schema=schema)
+        except NotImplementedError:
+            pk = None
+        if pk and pk.get("constrained_columns"):
+            columns.append(pk["constrained_columns"])
+
+        return columns
+
+    def is_covered(self, schema, table, columns):
+        """Returns ``True`` if an existing index of `table` starts with the
+        `columns`."""
+        columns = list(columns)
+        for existing in self.existing_indexes(schema, table):
+            if list(existing[0:len(columns)]) == columns:
+                return True
+        return False
+
+    def recommend(self, request_log, limit=None):
+        """Returns list of `RecommendedIndex` tuples sorted by the total
+        elapsed time of the queries logged in `request_log` that would use
+        the index. At most `limit` indexes are returned if specified."""
+
+        query_uses = request_log.query_uses(self.cube.name, self.method)
+        candidates = self.candidates(query_uses)
+
+        indexes = []
+        for key, (elapsed, count) in candidates.items():
+            (schema, table, columns) = key
+            if self.is_covered(schema, table, columns):
+                self.logger.debug("index %s of %s is covered by an existing "
+                                  "index" % (columns, table))
+                continue
+            indexes.append(RecommendedIndex(schema, table, list(columns),
+                                            elapsed, count))
+
+        indexes.sort(key=lambda index: (-index.elapsed_time, -index.queries,
+                                        index.table, index.columns))
+
+        if limit:
+            indexes = indexes[0:limit]
+
+        return indexes
+
+    def index_name(self, index):
+        """Returns name of a recommended `index`."""
+        return "idx_%s_%s" % (index.table, "_".join(index.columns))
+
+    def ddl(self, index, name=None):
+        """Returns ``CREATE INDEX`` statement of a recommended `index` in the
+        dialect of the store. Default `name` is ``idx_<table>_<columns>``."""
+
+        metadata = sqlalchemy.MetaData()
+        columns = [sqlalchemy.Column(column) for column in index.columns]
+        table = sqlalchemy.Table(index.table, metadata, *columns,
+                                 schema=index.schema)
+
+        name = name or self.index_name(index)
+        index = sqlalchemy.schema.Index(name, *table.columns)
+
+        create = sqlalchemy.schema.CreateIndex(index)
+        return str(create.compile(dialect=self.store.connectable.dialect))
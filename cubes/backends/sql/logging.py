@@ -4,6 +4,9 @@ from ...server.logging import RequestLogHandler, REQUEST_LOG_ITEMS
 from sqlalchemy import create_engine, Table, MetaData, Column
 from sqlalchemy import Integer, Sequence, DateTime, String, Float
 from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.sql import select, and_
+from collections import Counter
+from ...errors import *
 from ...browser import string_to_drilldown, Drilldown
 from .store import create_sqlalchemy_engine
 
@@ -71,7 +74,7 @@ class SQLRequestLogHandler(RequestLogHandler):
         drilldown = record.get("drilldown")
 
         if drilldown is not None:
-            if cell:
+            if cell is not None:
                 drilldown = Drilldown(drilldown, cell)
                 record["drilldown"] = str(drilldown)
             else:
@@ -129,3 +132,63 @@ class SQLRequestLogHandler(RequestLogHandler):
             if uses:
                 insert = self.dims_table.insert().values(uses)
                 self.engine.execute(insert)
+
+    def level_usage(self, cube, method="aggregate"):
+        """Returns a list of tuples (`uses`, `count`) where `uses` is a tuple
+        of (`dimension`, `hierarchy`, `level`) used in cuts and drill-downs of
+        logged `method` queries of `cube` and `count` is number of queries
+        with the same uses. Level or hierarchy is ``None`` if it was not
+        specified. Requires the dimensions table."""
+
+        counter = Counter()
+        for uses, count, elapsed in self.query_uses(cube, method):
+            levels = tuple(sorted(set(use[0:3] for use in uses)))
+            counter[levels] += count
+
+        return list(counter.items())
+
+    def query_uses(self, cube, method="aggregate"):
+        """Returns a list of tuples (`uses`, `count`, `elapsed_time`) where
+        `uses` is a tuple of (`dimension`, `hierarchy`, `level`, `used_as`)
+        used in logged `method` queries of `cube`, `count` is number of
+        queries with the same uses and `elapsed_time` is their total elapsed
+        time. `used_as` is ``cell`` or ``drilldown``. Requires the dimensions
+        table."""
+
+        if self.dims_table is None:
+            raise ConfigurationError("Request log has no dimensions table")
+
+        queries = self.table
+        uses = self.dims_table
+
+        condition = and_(queries.c.cube == str(cube),
+                         queries.c.method == method)
+        join = queries.outerjoin(uses, uses.c.query_id == queries.c.id)
+        statement = select([queries.c.id,
+                            queries.c.elapsed_time,
+                            uses.c.dimension,
+                            uses.c.hierarchy,
+                            uses.c.level,
+                            uses.c.used_as],
+                           from_obj=join,
+                           whereclause=condition)
+
+        def none(value):
+            return None if value == "None" else value
+
+        by_query = {}
+        elapsed = {}
+        for row in self.engine.execute(statement):
+            query_uses = by_query.setdefault(row[0], set())
+            elapsed[row[0]] = row[1] or 0
+            if row[2] is not None:
+                query_uses.add((row[2], none(row[3]), none(row[4]), row[5]))
+
+        grouped = {}
+        for query_id, value in by_query.items():
+            key = tuple(sorted(value))
+            (count, total) = grouped.get(key, (0, 0.0))
+            grouped[key] = (count + 1, total + elapsed[query_id])
+
+        return [(key, count, total)
+                for key, (count, total) in grouped.items()]
@@ -12,11 +12,15 @@ __all__ = (
     "TableColumnReference",
     "TableJoin",
     "coalesce_physical",
-    "DEFAULT_KEY_FIELD"
+    "DEFAULT_KEY_FIELD",
+    "DEFAULT_PARTITION_REFRESH"
 )
 
 DEFAULT_KEY_FIELD = "id"
 
+# Seconds after which fact partition tables are discovered again
+DEFAULT_PARTITION_REFRESH = 300
+
 """Physical reference to a table column. Note that the table might be an
 aliased table name as specified in relevant join."""
 TableColumnReference = namedtuple("TableColumnReference",
@@ -115,6 +119,15 @@ class SnowflakeMapper(Mapper):
         * `schema` – default database schema
         * `dimension_schema` – schema whre dimension tables are stored (if
           different than fact table schema)
+        * `fact_partitions` – template of names of fact table partitions,
+          such as ``fact_sales_{year}_{month:02d}``, if facts are stored in
+          multiple tables split by `partition_dimension` (see
+          `FactPartitions`)
+        * `partition_dimension`, `partition_hierarchy`, `partition_level` –
+          dimension, hierarchy and the deepest level by which the facts are
+          partitioned
+        * `partition_refresh` – seconds after which the partition tables are
+          discovered again, default is 300
 
         `mappings` is a dictionary where keys are logical attribute references
         and values are table column references. The keys are mostly in the
@@ -145,6 +158,13 @@ class SnowflakeMapper(Mapper):
         self.fact_name = fact_name or self.cube.fact or "%s%s%s" % (fact_prefix, self.cube.name, fact_suffix)
         self.schema = schema
 
+        self.fact_partitions = options.get("fact_partitions")
+        self.partition_dimension = options.get("partition_dimension")
+        self.partition_hierarchy = options.get("partition_hierarchy")
+        self.partition_level = options.get("partition_level")
+        self.partition_refresh = options.get("partition_refresh",
+                                             DEFAULT_PARTITION_REFRESH)
+
         self._collect_joins(joins or cube.joins)
 
     def _collect_joins(self, joins):
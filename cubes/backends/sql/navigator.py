@@ -0,0 +1,489 @@
+# -*- coding=utf -*-
+"""Aggregate navigator – routes aggregation queries to pre-aggregated
+cuboid tables."""
+
+from ...model import Cube, Measure, MeasureAggregate
+from ...browser import _encode_token_value, _decode_token_value
+from ...logging import get_logger
+from ...errors import *
+from .functions import rollup_function_name
+
+import threading
+import datetime
+import json
+import time
+
+try:
+    import sqlalchemy
+    import sqlalchemy.sql as sql
+except ImportError:
+    from cubes.common import MissingPackage
+    sqlalchemy = sql = MissingPackage("sqlalchemy", "SQL aggregate navigator")
+
+
+# Seconds after which the list of cuboids of a cube is read from the
+# registry again
+DEFAULT_AGGREGATES_REFRESH = 60
+
+
+__all__ = [
+    "MaterializedCuboid",
+    "AggregateRegistry",
+    "AggregateNavigator",
+    "DEFAULT_AGGREGATES_REFRESH",
+    "cuboid_table_name",
+    "rollup_aggregates"
+]
+
+
+def cuboid_table_name(prefix, levels):
+    """Returns name of a table for cuboid with `levels` – list of
+    (`dimension`, `level`) tuples. For example ``agg_sales_date_month``. The
+    apex cuboid (no levels) is named ``prefix`` + ``_all``."""
+
+    if levels:
+        suffix = "_".join("%s_%s" % (dim, level) for dim, level in levels)
+    else:
+        suffix = "all"
+
+    return "%s_%s" % (prefix, suffix)
+
+
+def rollup_aggregates(cube, aggregates=None):
+    """Returns list of `aggregates` of `cube` that can be computed from
+    partial aggregates – their function has a roll-up function (``sum``,
+    ``count``, ``min``, ...). If `aggregates` is not specified, then all
+    cube's aggregates are considered."""
+
+    if aggregates is None:
+        aggregates = cube.aggregates
+    else:
+        aggregates = cube.get_aggregates(aggregates)
+
+    return [agg for agg in aggregates
+                if agg.function and rollup_function_name(agg.function)]
+
+
+class MaterializedCuboid(object):
+    def __init__(self, cube, table, levels, attributes, aggregates,
+                 schema=None, row_count=None):
+        """Description of a cuboid materialized in an aggregate table.
+
+        Attributes:
+
+        * `cube` – name of the aggregated cube
+        * `table` – name of the aggregate table
+        * `schema` – schema of the aggregate table
+        * `levels` – list of (`dimension`, `level`) tuples – the deepest
+          levels of the cuboid dimensions
+        * `attributes` – list of attribute references available in the table.
+          Every attribute is stored in a column with the same name.
+        * `aggregates` – list of aggregate names available in the table
+        * `row_count` – number of rows in the table
+        """
+
+        self.cube = str(cube)
+        self.table = table
+        self.schema = schema
+        self.levels = [tuple(item) for item in levels]
+        self.attributes = list(attributes)
+        self.aggregates = list(aggregates)
+        self.row_count = row_count
+
+    def covers(self, attributes, aggregates):
+        """Returns ``True`` if the cuboid contains all `attributes` and
+        `aggregates` (lists of references)."""
+        return set(attributes) <= set(self.attributes) \
+                and set(aggregates) <= set(self.aggregates)
+
+    def to_dict(self):
+        return {
+            "cube": self.cube,
+            "table": self.table,
+            "schema": self.schema,
+            "levels": self.levels,
+            "attributes": self.attributes,
+            "aggregates": self.aggregates,
+            "row_count": self.row_count
+        }
+
+    def __repr__(self):
+        return "MaterializedCuboid(%s: %s)" % (self.cube, self.table)
+
+
+class AggregateRegistry(object):
+    def __init__(self, connectable, table_name="cubes_aggregates",
+                 schema=None, refresh=DEFAULT_AGGREGATES_REFRESH):
+        """Registry of materialized cuboids stored in a database table
+        `table_name` in `schema`, so that aggregates built by one process are
+        visible to the servers. The cuboids of a cube are cached and read
+        from the registry again after `refresh` seconds (``None`` caches
+        them until `invalidate()` is called).
+        """
+
+        self.connectable = connectable
+        self.table_name = table_name
+        self.schema = schema
+        self.logger = get_logger()
+
+        self.refresh = refresh
+
+        self.lock = threading.RLock()
+        self._cuboids = {}
+        self._loaded = {}
+        self._table = None
+        self._state_table = None
+
+    @property
+    def table(self):
+        """Registry table. The table is created when the first cuboid is
+        registered."""
+
+        if self._table is None:
+            metadata = sqlalchemy.MetaData(bind=self.connectable)
+            table = sqlalchemy.Table(self.table_name, metadata,
+                        sqlalchemy.Column("cube", sqlalchemy.String),
+                        sqlalchemy.Column("table_name", sqlalchemy.String),
+                        sqlalchemy.Column("table_schema", sqlalchemy.String),
+                        sqlalchemy.Column("levels", sqlalchemy.Text),
+                        sqlalchemy.Column("attributes", sqlalchemy.Text),
+                        sqlalchemy.Column("aggregates", sqlalchemy.Text),
+                        sqlalchemy.Column("row_count", sqlalchemy.Integer),
+                        sqlalchemy.Column("created", sqlalchemy.DateTime),
+                        schema=self.schema)
+            self._table = table
+
+        return self._table
+
+    @property
+    def state_table(self):
+        """Table with the last processed fact watermark of every cuboid. The
+        table is named as the registry with ``_state`` suffix and is created
+        on first use."""
+
+        if self._state_table is None:
+            metadata = sqlalchemy.MetaData(bind=self.connectable)
+            table = sqlalchemy.Table(self.table_name + "_state", metadata,
+                        sqlalchemy.Column("cube", sqlalchemy.String),
+                        sqlalchemy.Column("table_name", sqlalchemy.String),
+                        sqlalchemy.Column("watermark", sqlalchemy.Text),
+                        sqlalchemy.Column("updated", sqlalchemy.DateTime),
+                        schema=self.schema)
+            self._state_table = table
+
+        return self._state_table
+
+    def watermark(self, cube, table):
+        """Returns the last processed watermark of cuboid stored in `table`
+        or ``None`` if the cuboid has no recorded watermark."""
+
+        state = self.state_table
+        if not state.exists():
+            return None
+
+        condition = sql.expression.and_(state.c.cube == str(cube),
+                                        state.c.table_name == table)
+        value = self.connectable.execute(state.select(condition)).first()
+
+        if value is None or value["watermark"] is None:
+            return None
+        else:
+            return json.loads(value["watermark"],
+                              object_hook=_decode_token_value)
+
+    def set_watermark(self, cube, table, watermark, connection=None):
+        """Records `watermark` as the last processed watermark of the cuboid
+        stored in `table`. Dates, date-times and decimals are stored with
+        their type (as in page tokens) and `watermark()` returns the same
+        type. Pass `connection` to record the watermark in the transaction
+        that refreshed the cuboid."""
+
+        connection = connection or self.connectable
+        state = self.state_table
+        state.create(bind=connection, checkfirst=True)
+
+        condition = sql.expression.and_(state.c.cube == str(cube),
+                                        state.c.table_name == table)
+        record = {
+            "cube": str(cube),
+            "table_name": table,
+            "watermark": json.dumps(watermark, default=_encode_token_value),
+            "updated": datetime.datetime.now()
+        }
+        connection.execute(state.delete(condition))
+        connection.execute(state.insert(), record)
+
+    def cuboids(self, cube):
+        """Returns list of `MaterializedCuboid` objects for `cube`."""
+
+        name = str(cube)
+        with self.lock:
+            if name in self._cuboids and not self._expired(name):
+                return self._cuboids[name]
+
+            table = self.table
+            if table.exists():
+                selection = table.select(table.c.cube == name)
+                rows = self.connectable.execute(selection)
+            else:
+                rows = []
+
+            cuboids = []
+            for row in rows:
+                cuboid = MaterializedCuboid(row["cube"],
+                                            row["table_name"],
+                                            json.loads(row["levels"]),
+                                            json.loads(row["attributes"]),
+                                            json.loads(row["aggregates"]),
+                                            schema=row["table_schema"],
+                                            row_count=row["row_count"])
+                cuboids.append(cuboid)
+
+            self._cuboids[name] = cuboids
+            self._loaded[name] = time.time()
+
+        return cuboids
+
+    def _expired(self, name):
+        """Returns ``True`` if the cuboids of cube `name` were read from the
+        registry more than `refresh` seconds ago."""
+        return self.refresh is not None \
+                and time.time() - self._loaded[name] >= self.refresh
+
+    def register(self, cuboid):
+        """Registers `cuboid`. Cuboid with the same table replaces the
+        existing one, its watermark is kept."""
+
+        with self.lock:
+            table = self.table
+            table.create(checkfirst=True)
+            condition = sql.expression.and_(table.c.cube == cuboid.cube,
+                                            table.c.table_name == cuboid.table)
+            self.connectable.execute(table.delete(condition))
+
+            record = {
+                "cube": cuboid.cube,
+                "table_name": cuboid.table,
+                "table_schema": cuboid.schema,
+                "levels": json.dumps(cuboid.levels),
+                "attributes": json.dumps(cuboid.attributes),
+                "aggregates": json.dumps(cuboid.aggregates),
+                "row_count": cuboid.row_count,
+                "created": datetime.datetime.now()
+            }
+            self.connectable.execute(self.table.insert(), record)
+            self._cuboids.pop(cuboid.cube, None)
+
+    def unregister(self, cube, table=None):
+        """Removes cuboid stored in `table` of `cube` and its watermark from
+        the registry. If no `table` is specified, all cuboids of the cube are
+        removed."""
+
+        cube = str(cube)
+        with self.lock:
+            self.table.create(checkfirst=True)
+            condition = self.table.c.cube == cube
+            if table:
+                condition = sql.expression.and_(condition,
+                                        self.table.c.table_name == table)
+            self.connectable.execute(self.table.delete(condition))
+
+            state = self.state_table
+            if state.exists():
+                condition = state.c.cube == cube
+                if table:
+                    condition = sql.expression.and_(condition,
+                                                state.c.table_name == table)
+                self.connectable.execute(state.delete(condition))
+
+            self._cuboids.pop(cube, None)
+
+    def invalidate(self, cube=None):
+        """Forgets cached cuboids of `cube` or of all cubes, if no cube is
+        specified. They are read from the registry table on next use."""
+        with self.lock:
+            if cube is None:
+                self._cuboids.clear()
+            else:
+                self._cuboids.pop(str(cube), None)
+
+
+class AggregateNavigator(object):
+    def __init__(self, browser, registry):
+        """Finds the smallest materialized cuboid of the `browser`'s cube in
+        the `registry` that can answer an aggregation query and provides a
+        browser for the cuboid table.
+
+        Aggregates are re-aggregated from the cuboid with their roll-up
+        functions: ``sum`` for ``sum``, ``count`` and ``count_nonempty``,
+        ``min`` and ``max`` for themselves. Queries that require other
+        aggregates, localized attributes, period-to-date conditions or
+        semi-additive measures are not routed.
+        """
+
+        self.browser = browser
+        self.cube = browser.cube
+        self.registry = registry
+        self.logger = browser.logger
+
+        self._browsers = {}
+
+    def is_navigable(self):
+        """Returns ``True`` if queries of the cube can be routed to
+        aggregate tables at all."""
+        return not self.cube.info.get("semiadditive") \
+                and not self.cube.browser_options.get("ptd_master_required")
+
+    def required_attributes(self, cell, drilldown, order):
+        """Returns a tuple (`attributes`, `aggregates`) of references required
+        to answer the query or ``None`` if the query can not be answered from
+        an aggregate table."""
+
+        attributes = set()
+        aggregates = set()
+
+        for cut in cell.cuts:
+            depth = cut.level_depth()
+            if depth:
+                dim = self.cube.dimension(cut.dimension)
+                hier = dim.hierarchy(cut.hierarchy)
+                attributes |= set(level.key for level in hier[0:depth])
+
+        attributes |= set(drilldown.all_attributes())
+
+        levels = cell.deepest_levels() + drilldown.deepest_levels()
+        for dim, hier, level in levels:
+            if self.browser.mapper.physical(level.key).condition:
+                # Period-to-date condition
+                return None
+
+        for attribute, direction in order:
+            if isinstance(attribute, MeasureAggregate):
+                aggregates.add(attribute.name)
+            elif isinstance(attribute, Measure):
+                return None
+            else:
+                attributes.add(attribute)
+
+        if any(attr.is_localizable() for attr in attributes):
+            return None
+
+        refs = [self.browser.mapper.logical(attr) for attr in attributes]
+        return (refs, aggregates)
+
+    def find_cuboid(self, cell, drilldown, aggregates, order=None):
+        """Returns the smallest `MaterializedCuboid` that can answer
+        aggregation of `aggregates` in `cell` with `drilldown` (a `Drilldown`
+        object) ordered by `order` (prepared order) or ``None`` if there is no
+        such cuboid."""
+
+        if not self.is_navigable():
+            return None
+
+        required = self.required_attributes(cell, drilldown, order or [])
+        if required is None:
+            return None
+
+        (attributes, agg_names) = required
+
+        for agg in aggregates:
+            if self.browser.is_builtin_function(agg.function, agg):
+                if not rollup_function_name(agg.function):
+                    return None
+                agg_names.add(agg.name)
+            elif not agg.function:
+                return None
+            # Post-aggregation calculations are computed from the results
+
+        candidates = [cuboid for cuboid in self.registry.cuboids(self.cube)
+                        if cuboid.covers(attributes, agg_names)]
+
+        if not candidates:
+            return None
+
+        def cost(cuboid):
+            row_count = cuboid.row_count
+            if row_count is None:
+                row_count = float("inf")
+            return (row_count, len(cuboid.attributes))
+
+        return min(candidates, key=cost)
+
+    def cuboid_cube(self, cuboid):
+        """Returns a cube for browsing the aggregate table of `cuboid`. The
+        cube has the same dimensions as the original cube, stored aggregates
+        are measures and they are aggregated with their roll-up functions.
+        Post-aggregation calculations are kept. Cuboid attributes are mapped
+        to the aggregate table columns."""
+
+        measures = []
+        aggregates = []
+
+        for agg in self.cube.aggregates:
+            if agg.name in cuboid.aggregates:
+                measures.append(Measure(agg.name, label=agg.label))
+                function = rollup_function_name(agg.function)
+                rolled = MeasureAggregate(agg.name,
+                                          label=agg.label,
+                                          description=agg.description,
+                                          order=agg.order,
+                                          info=agg.info,
+                                          format=agg.format,
+                                          missing_value=agg.missing_value,
+                                          measure=agg.name,
+                                          function=function)
+                aggregates.append(rolled)
+            elif not self.browser.is_builtin_function(agg.function, agg):
+                aggregates.append(agg)
+
+        # All dimension attributes have to be mapped to the aggregate table,
+        # including those that are not in the cuboid. They are never used,
+        # since the cuboid covers all attributes of the query.
+        mapper = self.browser.mapper
+        refs = []
+        for dim in self.cube.dimensions:
+            for attr in dim.all_attributes:
+                refs.append(mapper.logical(attr))
+                for locale in attr.locales or []:
+                    refs.append(mapper.logical(attr, locale))
+
+        mappings = {}
+        for ref in refs:
+            mappings[ref] = {
+                "schema": cuboid.schema,
+                "table": cuboid.table,
+                "column": ref
+            }
+
+        cube = Cube(self.cube.name,
+                    dimensions=self.cube.dimensions,
+                    measures=measures,
+                    aggregates=aggregates,
+                    label=self.cube.label,
+                    mappings=mappings,
+                    fact=cuboid.table,
+                    locale=self.cube.locale,
+                    info=self.cube.info)
+
+        return cube
+
+    def cuboid_browser(self, cuboid):
+        """Returns a browser of the `cuboid` aggregate table. Browsers are
+        created once per cuboid."""
+
+        key = (cuboid.schema, cuboid.table)
+        try:
+            return self._browsers[key]
+        except KeyError:
+            pass
+
+        cube = self.cuboid_cube(cuboid)
+        browser = self.browser.__class__(cube,
+                                         store=self.browser.store,
+                                         locale=self.browser.locale,
+                                         schema=cuboid.schema,
+                                         use_denormalization=False,
+                                         use_aggregates=False)
+        self._browsers[key] = browser
+
+        return browser
@@ -0,0 +1,174 @@
+# -*- coding=utf -*-
+"""Fact tables partitioned into multiple tables by a dimension."""
+
+from ...browser import PointCut, SetCut, RangeCut
+from ...errors import *
+
+from collections import OrderedDict
+from string import Formatter
+import re
+
+
+__all__ = [
+    "FactPartitions"
+]
+
+
+class FactPartitions(object):
+    def __init__(self, template, dimension, level=None, hierarchy=None):
+        """Partitions of a fact table split by levels of `dimension`, such
+        as monthly fact tables. Names of the partition tables are created
+        from the `template` – a format string with names of the levels as
+        fields, for example ``fact_sales_{year}_{month:02d}``.
+
+        Partitions are split by levels of the `hierarchy` down to the
+        `level`, which is by default the deepest level in the template.
+        Every one of the levels has to be in the template."""
+
+        self.template = template
+        self.dimension = dimension
+        self.hierarchy = dimension.hierarchy(hierarchy)
+
+        names = [str(item) for item in self.hierarchy.levels]
+
+        parts = list(Formatter().parse(template))
+        fields = [field for _, field, _, _ in parts if field is not None]
+
+        for field in fields:
+            if field not in names:
+                raise ModelError("Unknown level '%s' of dimension '%s' in "
+                                 "fact partition template '%s'"
+                                 % (field, dimension.name, template))
+
+        if level:
+            try:
+                depth = names.index(str(level)) + 1
+            except ValueError:
+                raise ModelError("Unknown partition level '%s' of dimension "
+                                 "'%s'" % (level, dimension.name))
+        elif fields:
+            depth = max(names.index(field) for field in fields) + 1
+        else:
+            raise ModelError("Fact partition template '%s' has no level "
+                             "field" % (template, ))
+
+        self.levels = self.hierarchy.levels[0:depth]
+
+        missing = [name for name in names[0:depth] if name not in fields]
+        if missing:
+            raise ModelError("Levels %s of dimension '%s' are missing in "
+                             "fact partition template '%s'"
+                             % (missing, dimension.name, template))
+
+        # Regular expression matching names of the partitions – one group
+        # for every field of the template
+        pattern = ""
+        self.fields = []
+        for literal, field, spec, conversion in parts:
+            pattern += re.escape(literal)
+            if field is not None:
+                if spec and spec[-1] == "d":
+                    pattern += r"(\d+)"
+                else:
+                    pattern += r"(.+?)"
+                self.fields.append(field)
+
+        self.pattern = re.compile("^%s$" % pattern)
+
+        # Partition table names by partition keys – tuples of values of the
+        # partition levels
+        self.tables = OrderedDict()
+
+    def key(self, table_name):
+        """Returns partition key of table `table_name` or ``None`` if the
+        table is not a partition."""
+
+        match = self.pattern.match(table_name)
+        if not match:
+            return None
+
+        values = {}
+        for field, value in zip(self.fields, match.groups()):
+            value = _partition_value(value)
+            if values.setdefault(field, value) != value:
+                return None
+
+        return tuple(values[str(level)] for level in self.levels)
+
+    def discover(self, table_names):
+        """Collects partitions from the list of `table_names`, ordered by
+        their keys. Returns the partitions dictionary: keys are partition
+        keys and values are table names."""
+
+        tables = []
+        for name in table_names:
+            key = self.key(name)
+            if key is not None:
+                tables.append((key, name))
+
+        self.tables = OrderedDict(sorted(tables))
+        return self.tables
+
+    def select(self, cell):
+        """Returns list of names of the partition tables which might contain
+        facts of the `cell`. Only cuts of the partitioning dimension and
+        hierarchy prune the partitions."""
+
+        cuts = []
+        if cell is not None:
+            for cut in cell.cuts:
+                if str(cut.dimension) != self.dimension.name:
+                    continue
+                if self.dimension.hierarchy(cut.hierarchy).name \
+                        != self.hierarchy.name:
+                    continue
+                cuts.append(cut)
+
+        return [table for key, table in self.tables.items()
+                if all(self.contains(key, cut) for cut in cuts)]
+
+    def contains(self, key, cut):
+        """Returns ``True`` if the partition with `key` might contain facts
+        of the `cut`."""
+
+        if cut.invert:
+            return True
+
+        if isinstance(cut, PointCut):
+            return self._contains_path(key, cut.path)
+
+        elif isinstance(cut, SetCut):
+            return any(self._contains_path(key, path) for path in cut.paths)
+
+        elif isinstance(cut, RangeCut):
+            if cut.from_path:
+                path = _partition_path(cut.from_path[0:len(key)])
+                if key[0:len(path)] < path:
+                    return False
+            if cut.to_path:
+                path = _partition_path(cut.to_path[0:len(key)])
+                if key[0:len(path)] > path:
+                    return False
+            return True
+
+        return True
+
+    def _contains_path(self, key, path):
+        path = _partition_path((path or [])[0:len(key)])
+        return key[0:len(path)] == path
+
+    def __len__(self):
+        return len(self.tables)
+
+
+def _partition_value(value):
+    """Returns integer `value` for strings of digits, otherwise the value
+    as it is."""
+
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _partition_path(path):
+    return tuple(_partition_value(value) for value in path)
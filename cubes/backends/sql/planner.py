@@ -0,0 +1,292 @@
+# -*- coding=utf -*-
+"""Cost-based selection of cuboids to be materialized."""
+
+from ...browser import Cell
+from ...computation import *
+from ...logging import get_logger
+from ...errors import *
+from .browser import SnowflakeBrowser
+from .query import QueryBuilder
+
+from collections import namedtuple, Counter
+import math
+
+try:
+    import sqlalchemy
+    import sqlalchemy.sql as sql
+except ImportError:
+    from cubes.common import MissingPackage
+    sqlalchemy = sql = MissingPackage("sqlalchemy", "SQL aggregate planner")
+
+
+__all__ = [
+    "CuboidPlanner",
+    "AggregationPlan",
+    "PlannedCuboid",
+    "estimate_distinct_count"
+]
+
+
+PlannedCuboid = namedtuple("PlannedCuboid",
+                           ["levels", "estimated_rows", "benefit"])
+
+
+def estimate_distinct_count(frequencies, sample_size, population):
+    """Estimates number of distinct values in a `population` of rows from
+    `frequencies` – counts of the distinct values in a random sample of
+    `sample_size` rows. The GEE estimator by Charikar et al. is used: values
+    seen once in the sample are scaled by square root of the sampling ratio,
+    values seen more than once are assumed to be all there is."""
+
+    distinct = len(frequencies)
+
+    if not sample_size or sample_size >= population:
+        return distinct
+
+    singletons = sum(1 for count in frequencies if count == 1)
+    estimate = math.sqrt(float(population) / sample_size) * singletons \
+                + (distinct - singletons)
+
+    return int(round(max(distinct, min(estimate, population))))
+
+
+class AggregationPlan(object):
+    def __init__(self, cube, cuboids, fact_count=None, budget=None):
+        """List of cuboids of `cube` chosen to be materialized. `cuboids` is
+        a list of `PlannedCuboid` tuples in order of their importance,
+        `fact_count` is number of facts and `budget` is maximal number of
+        aggregated rows the plan was created for.
+
+        Pass the plan to `SQLStore.create_cube_aggregate()` to materialize
+        the cuboids."""
+
+        self.cube = str(cube)
+        self.cuboids = list(cuboids)
+        self.fact_count = fact_count
+        self.budget = budget
+
+    @property
+    def estimated_rows(self):
+        """Estimated number of rows of all planned cuboids."""
+        return sum(cuboid.estimated_rows for cuboid in self.cuboids)
+
+    def levels(self):
+        """Returns list of cuboid levels – lists of (`dimension`, `level`)
+        tuples."""
+        return [cuboid.levels for cuboid in self.cuboids]
+
+    def to_dict(self):
+        return {
+            "cube": self.cube,
+            "fact_count": self.fact_count,
+            "budget": self.budget,
+            "estimated_rows": self.estimated_rows,
+            "cuboids": [cuboid._asdict() for cuboid in self.cuboids]
+        }
+
+    def __len__(self):
+        return len(self.cuboids)
+
+    def __iter__(self):
+        return iter(self.cuboids)
+
+
+class CuboidPlanner(object):
+    def __init__(self, store, cube, dimensions=None, linked_dimensions=None,
+                 sample_size=10000, max_dimensions=3):
+        """Chooses cuboids of `cube` in `store` to be materialized.
+
+        Candidates are cuboids of queries from a request log and all
+        hierarchical cuboids of at most `max_dimensions` of `dimensions`
+        (default are all cube dimensions). Every candidate has to contain
+        all `linked_dimensions`. Size of a candidate is estimated from
+        distinct level keys in a sample of `sample_size` facts.
+        """
+
+        self.store = store
+        self.cube = cube
+        self.logger = get_logger()
+
+        if dimensions:
+            self.dimensions = [cube.dimension(dim) for dim in dimensions]
+        else:
+            self.dimensions = cube.dimensions
+
+        if linked_dimensions:
+            self.linked_dimensions = [cube.dimension(dim)
+                                        for dim in linked_dimensions]
+        else:
+            self.linked_dimensions = []
+
+        self.sample_size = sample_size
+        self.max_dimensions = max_dimensions
+
+        self.browser = SnowflakeBrowser(cube, store, use_aggregates=False)
+
+    def depths(self, levels):
+        """Returns a dictionary of level depths of cuboid `levels` in the
+        default hierarchies."""
+
+        depths = {}
+        for dim, level in levels:
+            dim = self.cube.dimension(dim)
+            names = [str(l) for l in dim.hierarchy().levels]
+            depths[str(dim)] = names.index(str(level)) + 1
+
+        return depths
+
+    def levels(self, depths):
+        """Returns cuboid levels for dictionary of level `depths`, in order
+        of cube dimensions."""
+
+        levels = []
+        for dim in self.cube.dimensions:
+            depth = depths.get(dim.name)
+            if depth:
+                level = dim.hierarchy().levels[depth - 1]
+                levels.append((dim.name, level.name))
+
+        return levels
+
+    def logged_queries(self, request_log):
+        """Returns list of (`depths`, `frequency`) of aggregation queries in
+        the `request_log` (`SQLRequestLogHandler` with dimensions table).
+        Queries using levels of non-default hierarchies are ignored."""
+
+        queries = []
+        for uses, count in request_log.level_usage(self.cube.name):
+            depths = {}
+            for dim, hier, level in uses:
+                try:
+                    dim = self.cube.dimension(dim)
+                except NoSuchDimensionError:
+                    depths = None
+                    break
+
+                if hier and hier != dim.hierarchy().name:
+                    depths = None
+                    break
+
+                if level:
+                    names = [str(l) for l in dim.hierarchy().levels]
+                    if level not in names:
+                        depths = None
+                        break
+                    depth = names.index(level) + 1
+                    depths[dim.name] = max(depths.get(dim.name, 0), depth)
+
+            if depths is not None:
+                queries.append((depths, count))
+
+        return queries
+
+    def candidates(self, queries=None):
+        """Returns list of candidate cuboids – level `depths` dictionaries."""
+
+        linked = dict((dim.name, 1) for dim in self.linked_dimensions)
+
+        candidates = []
+        cuboids = hierarchical_cuboids(self.dimensions,
+                                       required=self.linked_dimensions,
+                                       max_dimensions=self.max_dimensions)
+        for levels in cuboids:
+            candidates.append(self.depths(levels))
+
+        for depths, count in queries or []:
+            depths = dict(depths)
+            for dim, depth in linked.items():
+                depths.setdefault(dim, depth)
+            if depths and depths not in candidates:
+                candidates.append(depths)
+
+        return candidates
+
+    def fact_count(self):
+        """Returns number of facts."""
+        builder = QueryBuilder(self.browser)
+        statement = sql.expression.select([sql.functions.count()],
+                                    from_obj=builder.snowflake.fact_table)
+        return self.store.connectable.execute(statement).scalar()
+
+    def sample(self, attributes, fact_count):
+        """Returns list of `attributes` values tuples of a sample of about
+        `sample_size` facts. Facts with fact key divisible by sampling step
+        are taken if the key is an integer, otherwise first `sample_size`
+        facts are taken."""
+
+        builder = QueryBuilder(self.browser)
+        statement = builder.denormalized_statement(Cell(self.cube),
+                                                   attributes,
+                                                   include_fact_key=False)
+
+        if fact_count > self.sample_size:
+            key = builder.snowflake.fact_table.c.get(builder.snowflake.fact_key)
+            step = fact_count // self.sample_size
+
+            if key is not None \
+                    and isinstance(key.type, sqlalchemy.types.Integer):
+                statement = statement.where(key % step == 0)
+            else:
+                statement = statement.limit(self.sample_size)
+
+        statement = builder.route_partitions(statement)
+
+        return [tuple(row) for row in
+                        self.store.connectable.execute(statement)]
+
+    def estimate_sizes(self, candidates, fact_count):
+        """Returns list of estimated row counts of `candidates`."""
+
+        positions = {}
+        attributes = []
+        for dim in self.cube.dimensions:
+            for level in dim.hierarchy().levels:
+                positions[(dim.name, level.name)] = len(attributes)
+                attributes.append(level.key)
+
+        rows = self.sample(attributes, fact_count)
+
+        sizes = []
+        for depths in candidates:
+            indexes = [positions[levels] for levels in self.levels(depths)]
+            counter = Counter(tuple(row[i] for i in indexes) for row in rows)
+            size = estimate_distinct_count(counter.values(), len(rows),
+                                           fact_count)
+            sizes.append(size)
+
+        return sizes
+
+    def plan(self, budget=None, request_log=None, max_cuboids=None):
+        """Returns an `AggregationPlan` with cuboids selected greedily by
+        their benefit per row within `budget` – maximal number of aggregated
+        rows. Queries from `request_log` are weighted by their frequency,
+        without the log all candidates are considered equally important."""
+
+        if request_log is not None:
+            queries = self.logged_queries(request_log)
+        else:
+            queries = None
+
+        candidates = self.candidates(queries)
+        fact_count = self.fact_count()
+        sizes = self.estimate_sizes(candidates, fact_count)
+
+        items = []
+        for i, (depths, size) in enumerate(zip(candidates, sizes)):
+            items.append((i, depths, size))
+
+        selected = greedy_cuboid_selection(items, fact_count,
+                                           queries=queries,
+                                           budget=budget,
+                                           max_cuboids=max_cuboids)
+
+        cuboids = []
+        for i, size, benefit in selected:
+            levels = self.levels(candidates[i])
+            self.logger.debug("planned cuboid %s (%s rows, benefit %s)"
+                              % (levels, size, benefit))
+            cuboids.append(PlannedCuboid(levels, size, benefit))
+
+        return AggregationPlan(self.cube, cuboids,
+                               fact_count=fact_count,
+                               budget=budget)
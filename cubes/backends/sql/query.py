@@ -5,9 +5,17 @@ from ...browser import SPLIT_DIMENSION_NAME
 from ...errors import *
 from ...logging import get_logger
 from collections import namedtuple, OrderedDict
-from .mapper import DEFAULT_KEY_FIELD
-from .utils import condition_conjunction, order_column
+from .mapper import DEFAULT_KEY_FIELD, DEFAULT_PARTITION_REFRESH
+from .utils import condition_conjunction, order_column, GroupingSets
+from .utils import SampledTable, tablesample_clause
+from .utils import supports_row_value_in, nulls_sort_first
+from .functions import get_rollup_function, rollup_function_name
+from .partitions import FactPartitions
+import threading
 import datetime
+import time
+import hashlib
+import json
 import re
 
 try:
@@ -21,7 +29,14 @@ except ImportError:
 
 __all__ = [
         "SnowflakeSchema",
-        "QueryBuilder"
+        "SnowflakeSchemaCache",
+        "StatementCache",
+        "MemberCache",
+        "CachedStatement",
+        "QueryBuilder",
+        "snowflake_schema_key",
+        "cell_shape",
+        "cell_parameters"
         ]
 
 
@@ -77,6 +92,12 @@ class SnowflakeSchema(object):
         self.mapper = mapper
         self.metadata = metadata
         self.safe_labels = safe_labels
+        self.label_counter = 1
+
+        # The schema might be shared between browsers (see
+        # `SnowflakeSchemaCache`), therefore lazy creation of columns has to
+        # be guarded.
+        self._lock = threading.RLock()
 
         # Initialize the shema information: tables, column maps, ...
         self.schema = self.mapper.schema
@@ -86,15 +107,26 @@ class SnowflakeSchema(object):
         self.fact_key = self.cube.key or DEFAULT_KEY_FIELD
         self.fact_name = self.mapper.fact_name
 
+        if getattr(self.mapper, "fact_partitions", None):
+            self.partitions = self._collect_partitions()
+        else:
+            self.partitions = None
+        self.partition_refresh = getattr(self.mapper, "partition_refresh",
+                                         DEFAULT_PARTITION_REFRESH)
+        self.partitions_discovered = time.time()
+
         try:
             self.fact_table = sqlalchemy.Table(self.fact_name,
                                                self.metadata,
                                                autoload=True,
                                                schema=self.schema)
         except sqlalchemy.exc.NoSuchTableError:
-            in_schema = (" in schema '%s'" % self.schema) if self.schema else ""
-            msg = "No such fact table '%s'%s." % (self.fact_name, in_schema)
-            raise WorkspaceError(msg)
+            if self.partitions:
+                self.fact_table = self._partitioned_fact_table()
+            else:
+                in_schema = (" in schema '%s'" % self.schema) if self.schema else ""
+                msg = "No such fact table '%s'%s." % (self.fact_name, in_schema)
+                raise WorkspaceError(msg)
 
         try:
             self.fact_key_column = self.fact_table.c[self.fact_key].label(self.fact_key)
@@ -130,6 +162,114 @@ class SnowflakeSchema(object):
         self._collect_tables()
         self._analyse_table_relationships()
 
+    def _collect_partitions(self):
+        """Returns `FactPartitions` of the fact table with partition tables
+        found in the database schema."""
+
+        if not self.mapper.partition_dimension:
+            raise ModelError("No partition dimension specified for "
+                             "partitioned facts of cube '%s'"
+                             % self.cube.name)
+
+        dimension = self.cube.dimension(self.mapper.partition_dimension)
+        partitions = FactPartitions(self.mapper.fact_partitions,
+                                    dimension,
+                                    level=self.mapper.partition_level,
+                                    hierarchy=self.mapper.partition_hierarchy)
+
+        self._discover_partitions(partitions)
+
+        return partitions
+
+    def _discover_partitions(self, partitions):
+        inspector = sqlalchemy.inspect(self.metadata.bind)
+        partitions.discover(inspector.get_table_names(schema=self.schema))
+
+        get_logger().debug("found %d partitions of fact table '%s'"
+                           % (len(partitions), self.fact_name))
+
+    def refresh_partitions(self):
+        """Discovers the fact partition tables again, for example after
+        a new partition was created. Partitions are refreshed also
+        automatically every `partition_refresh` seconds."""
+
+        if self.partitions is None:
+            return
+
+        with self._lock:
+            self._discover_partitions(self.partitions)
+            self.partitions_discovered = time.time()
+
+    def _fact_partitions(self):
+        """Returns the fact partitions, discovered again if they are older
+        than `partition_refresh` seconds."""
+
+        if self.partition_refresh is not None \
+                and time.time() - self.partitions_discovered \
+                    >= self.partition_refresh:
+            with self._lock:
+                # Other thread might have refreshed them meanwhile
+                if time.time() - self.partitions_discovered \
+                        >= self.partition_refresh:
+                    self.refresh_partitions()
+
+        return self.partitions
+
+    def _partitioned_fact_table(self):
+        """Returns a table standing for the fact table when there is no
+        table of the fact name – with columns of the first partition. The
+        table is replaced by the partitions in the statements."""
+
+        first = list(self.partitions.tables.values())[0]
+        partition = sqlalchemy.Table(first, self.metadata, autoload=True,
+                                     schema=self.schema)
+
+        columns = [sqlalchemy.Column(column.name, column.type)
+                   for column in partition.columns]
+
+        return sqlalchemy.Table(self.fact_name, sqlalchemy.MetaData(),
+                                *columns, schema=self.schema)
+
+    def partition_tables(self, cell):
+        """Returns list of names of fact partitions to be queried for the
+        `cell` or ``None`` if the facts are not partitioned."""
+
+        if self.partitions is None:
+            return None
+        return self._fact_partitions().select(cell)
+
+    def partitioned_facts(self, cell):
+        """Returns a selectable with facts of partitions of the `cell`,
+        aliased as the fact table: one partition table or ``UNION ALL`` of
+        the partitions."""
+
+        names = self._fact_partitions().select(cell)
+        columns = list(self.fact_table.columns)
+
+        selects = []
+        for name in names:
+            table = sqlalchemy.Table(name, sqlalchemy.MetaData(),
+                                     *[sqlalchemy.Column(column.name,
+                                                         column.type)
+                                       for column in columns],
+                                     schema=self.schema)
+            selects.append(sql.expression.select(list(table.columns)))
+
+        if not selects:
+            # No partition contains the cell – select nothing, with columns
+            # of the fact table
+            nulls = []
+            for column in columns:
+                null = sql.expression.cast(sql.expression.null(), column.type)
+                nulls.append(null.label(column.name))
+            selection = sql.expression.select(nulls).where(sql.expression.false())
+        elif len(selects) == 1:
+            selection = selects[0]
+        else:
+            selection = sql.expression.union_all(*selects)
+
+        return selection.alias(self.fact_name)
+
     def _collect_tables(self):
         """Collect tables in the schema. Analyses their relationship towards
         the fact table.
@@ -313,7 +453,9 @@ class SnowflakeSchema(object):
         If `include_fact` is ``True`` (default) then fact table is considered
         as starting point. If it is ``False`` The first detail table is
         considered as starting point for joins. This might be useful when
-        getting values of a dimension without cell restrictions.
+        getting values of a dimension without cell restrictions. Joins of
+        the fact table are skipped in that case, unless some of the
+        `attributes` are stored in the fact table.
 
         `master_fact` is used for building a composed aggregated expression.
         `master_detail_keys` is a dictionary of aliased keys from the master
@@ -354,6 +496,11 @@ class SnowflakeSchema(object):
 
         fact_key = (self.schema, self.fact_name)
 
+        if not include_fact:
+            refs = [self.mapper.physical(attr) for attr in attributes]
+            if any((ref.schema, ref.table) == fact_key for ref in refs):
+                include_fact = True
+
         if include_fact:
             if master_fact is not None:
                 fact = master_fact
@@ -362,6 +509,17 @@ class SnowflakeSchema(object):
 
             joined_products[fact_key] = fact
             tables.append(self.tables[fact_key])
+        else:
+            # Start with the tables joined to the fact
+            fact_joins = [join for join in joins
+                          if (join.master.schema, join.master.table) == fact_key]
+            joins = [join for join in joins if join not in fact_joins]
+
+            for join in fact_joins:
+                key = (join.detail.schema, join.alias or join.detail.table)
+                joined_products[key] = self.table(join.detail.schema,
+                                                  join.alias or join.detail.table)
+                tables.append(self.tables[key])
 
         # Collect all the tables first:
         for join in joins:
@@ -489,8 +647,19 @@ class SnowflakeSchema(object):
         """
 
         logical = self.mapper.logical(attribute, locale)
-        if logical in self.logical_to_column:
+        try:
             return self.logical_to_column[logical]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if logical in self.logical_to_column:
+                return self.logical_to_column[logical]
+            return self._create_column(attribute, logical, locale)
+
+    def _create_column(self, attribute, logical, locale=None):
+        """Creates and registers a labelled column for `attribute` with
+        logical reference `logical`."""
 
         ref = self.mapper.physical(attribute, locale)
         table = self.table(ref.schema, ref.table)
@@ -594,6 +763,312 @@ class SnowflakeSchema(object):
                              % (key, self.cube.name) )
 
 
+def snowflake_schema_key(cube, mapper, safe_labels=False):
+    """Returns a key identifying a reflected `SnowflakeSchema` of `cube` as
+    seen through `mapper`. The key is a tuple (`cube name`, `locale`,
+    `fingerprint`) where `fingerprint` is a digest of the cube description,
+    mappings, joins and mapper configuration. Two browsers with equal keys
+    can share the same schema."""
+
+    joins = getattr(mapper, "joins", None) or []
+    description = {
+        "cube": cube.to_dict(expand_dimensions=True, with_mappings=True),
+        "key": cube.key,
+        "mapper": mapper.__class__.__name__,
+        "fact_name": mapper.fact_name,
+        "schema": mapper.schema,
+        "dimension_prefix": getattr(mapper, "dimension_prefix", None),
+        "dimension_suffix": getattr(mapper, "dimension_suffix", None),
+        "dimension_schema": getattr(mapper, "dimension_schema", None),
+        "joins": [tuple(join) for join in joins],
+        "fact_partitions": getattr(mapper, "fact_partitions", None),
+        "partition_dimension": getattr(mapper, "partition_dimension", None),
+        "partition_hierarchy": getattr(mapper, "partition_hierarchy", None),
+        "partition_level": getattr(mapper, "partition_level", None),
+        "partition_refresh": getattr(mapper, "partition_refresh", None),
+        "simplify": mapper.simplify_dimension_references,
+        "safe_labels": safe_labels
+    }
+
+    string = json.dumps(description, sort_keys=True, default=str)
+    fingerprint = hashlib.md5(string).hexdigest()
+
+    return (cube.name, mapper.locale, fingerprint)
+
+
+class SnowflakeSchemaCache(object):
+    def __init__(self):
+        """Thread-safe cache of reflected `SnowflakeSchema` objects. Schema
+        reflection and analysis – fact table loading, table collection and
+        relationship analysis – is performed only once for every key (see
+        `snowflake_schema_key()`). The cache is owned by a SQL store.
+        """
+        self.schemas = {}
+        self.lock = threading.RLock()
+        self.logger = get_logger()
+
+    def schema(self, key, factory):
+        """Returns a schema for `key`. If there is no such schema, then it is
+        created by calling `factory` without arguments."""
+
+        try:
+            return self.schemas[key]
+        except KeyError:
+            pass
+
+        # The reflection is done while holding the lock: SQLAlchemy metadata
+        # is not safe for concurrent reflection and we do not want to analyse
+        # the same schema more than once.
+        with self.lock:
+            try:
+                return self.schemas[key]
+            except KeyError:
+                self.logger.debug("reflecting snowflake schema for cube '%s' "
+                                  "(locale: %s)" % (key[0], key[1]))
+                schema = factory()
+                self.schemas[key] = schema
+                return schema
+
+    def refresh_partitions(self, cube=None):
+        """Discovers fact partitions of cached schemas of `cube` again (see
+        `SnowflakeSchema.refresh_partitions()`). If no cube is specified,
+        then partitions of all the schemas are discovered."""
+
+        with self.lock:
+            schemas = [schema for key, schema in self.schemas.items()
+                       if cube is None or key[0] == str(cube)]
+
+        for schema in schemas:
+            schema.refresh_partitions()
+
+    def invalidate(self, cube=None):
+        """Removes cached schemas of `cube`. If no cube is specified, then
+        the whole cache is flushed."""
+
+        with self.lock:
+            if cube is None:
+                self.schemas.clear()
+            else:
+                name = str(cube)
+                for key in self.schemas.keys():
+                    if key[0] == name:
+                        del self.schemas[key]
+
+    def __len__(self):
+        return len(self.schemas)
+
+
+def cell_shape(cell):
+    """Returns a hashable description of the `cell` without the cut values:
+    cut types, dimensions, hierarchies, inversion and path lengths. Cells
+    with the same shape have the same SQL condition, differing only in the
+    bound values (see `cell_parameters()`)."""
+
+    if not cell:
+        return ()
+
+    shape = []
+    for cut in cell.cuts:
+        if isinstance(cut, PointCut):
+            lengths = len(cut.path or [])
+        elif isinstance(cut, SetCut):
+            lengths = tuple(len(path or []) for path in cut.paths)
+        elif isinstance(cut, RangeCut):
+            lengths = (len(cut.from_path or []), len(cut.to_path or []))
+        else:
+            raise ArgumentError("Unknown cut type %s" % type(cut))
+
+        shape.append((cut.__class__.__name__, str(cut.dimension),
+                      str(cut.hierarchy) if cut.hierarchy else None,
+                      bool(cut.invert), lengths))
+
+    return tuple(shape)
+
+
+def cell_parameters(cell, prefix="c"):
+    """Returns a dictionary of values of bound parameters of conditions for
+    `cell` cuts built by `QueryBuilder.aggregation_statement()`. The
+    parameters are named ``<prefix><cut>_<level>``, ``<prefix><cut>_<path>_
+    <level>`` for set cuts and ``<prefix><cut>_from_<level>`` or
+    ``<prefix><cut>_to_<level>`` for range cuts. The split cell has prefix
+    ``s``."""
+
+    parameters = {}
+
+    if not cell:
+        return parameters
+
+    for i, cut in enumerate(cell.cuts):
+        name = "%s%d" % (prefix, i)
+        if isinstance(cut, PointCut):
+            paths = [(name, cut.path)]
+        elif isinstance(cut, SetCut):
+            paths = [("%s_%d" % (name, j), path)
+                     for j, path in enumerate(cut.paths)]
+        elif isinstance(cut, RangeCut):
+            paths = [("%s_from" % name, cut.from_path),
+                     ("%s_to" % name, cut.to_path)]
+        else:
+            raise ArgumentError("Unknown cut type %s" % type(cut))
+
+        for path_name, path in paths:
+            for j, value in enumerate(path or []):
+                parameters["%s_%d" % (path_name, j)] = value
+
+    return parameters
+
+
+class CachedStatement(object):
+    def __init__(self, statement, labels, dialect):
+        """A `statement` compiled for the `dialect`, with its logical
+        `labels`. Executing the compiled statement with new parameters skips
+        both building and compiling the statement."""
+
+        self.statement = statement
+        self.labels = labels
+        self.compiled = statement.compile(dialect=dialect)
+
+    def __str__(self):
+        return str(self.compiled)
+
+
+class StatementCache(object):
+    def __init__(self, size=100):
+        """Thread-safe least-recently-used cache of prepared statements keyed
+        by query shape. At most `size` items are kept, size ``0`` disables
+        the cache. Keys are tuples where the first item is a snowflake schema
+        key (see `snowflake_schema_key()`). The cache is owned by a SQL
+        store."""
+
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns cached item for `key` or ``None``."""
+
+        with self.lock:
+            try:
+                item = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.items[key] = item
+            self.hits += 1
+            return item
+
+    def set(self, key, item):
+        """Stores `item` under `key`. The least recently used item is
+        removed if the cache is full."""
+
+        if not self.size:
+            return
+
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = item
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, cube=None):
+        """Removes cached statements of `cube`. If no cube is specified,
+        then the whole cache is flushed."""
+
+        with self.lock:
+            if cube is None:
+                self.items.clear()
+            else:
+                name = str(cube)
+                for key in self.items.keys():
+                    if key[0][0] == name:
+                        del self.items[key]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class MemberCache(object):
+    def __init__(self, ttl):
+        """Thread-safe cache of dimension members loaded from the dimension
+        tables. Members of a level are reloaded when they are older than
+        `ttl` seconds. Keys are tuples where the first item is a snowflake
+        schema key (see `snowflake_schema_key()`). The cache is owned by a
+        SQL store."""
+
+        self.ttl = ttl
+        self.items = {}
+        self.lock = threading.RLock()
+        self.logger = get_logger()
+
+        self._key_locks = {}
+        self._generation = 0
+
+    def _fresh(self, key):
+        """Returns cached members for `key` or ``None`` if there are no
+        members or they expired."""
+        try:
+            (loaded, members) = self.items[key]
+        except KeyError:
+            return None
+
+        if time.time() - loaded < self.ttl:
+            return members
+        else:
+            return None
+
+    def get(self, key, factory):
+        """Returns members for `key`. If there are no members or they
+        expired, then they are loaded by calling `factory` without
+        arguments."""
+
+        members = self._fresh(key)
+        if members is not None:
+            return members
+
+        with self.lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Members are loaded while holding only the lock of the key, so that
+        # concurrent requests do not load the same level more than once and
+        # a slow load does not block requests for other levels
+        with key_lock:
+            members = self._fresh(key)
+            if members is not None:
+                return members
+
+            generation = self._generation
+            self.logger.debug("loading members of %s" % (key[1:], ))
+            members = factory()
+
+            with self.lock:
+                # Members loaded before the cache was invalidated might be
+                # stale – they are returned, but not kept
+                if generation == self._generation:
+                    self.items[key] = (time.time(), members)
+
+            return members
+
+    def invalidate(self, cube=None):
+        """Removes cached members of `cube`. If no cube is specified, then
+        the whole cache is flushed."""
+
+        with self.lock:
+            self._generation += 1
+            if cube is None:
+                self.items.clear()
+            else:
+                name = str(cube)
+                for key in self.items.keys():
+                    if key[0][0] == name:
+                        del self.items[key]
+
+    def __len__(self):
+        return len(self.items)
+
+
 class _StatementConfiguration(object):
     def __init__(self):
         self.attributes = []
@@ -650,9 +1125,7 @@ class QueryBuilder(object):
         self.mapper = browser.mapper
         self.cube = browser.cube
 
-        self.snowflake = SnowflakeSchema(self.cube, self.mapper,
-                                         self.browser.metadata,
-                                         safe_labels=browser.safe_labels)
+        self.snowflake = browser.snowflake_schema()
 
         self.master_fact = None
 
@@ -664,6 +1137,32 @@ class QueryBuilder(object):
         self.statement = None
         self.labels = []
 
+        # Properties of the last aggregation statement
+        self.coalesce_measures = False
+        self.is_semiadditive = False
+
+        # Sampling of the last aggregation statement: ``tablesample`` or
+        # ``modulo``, fraction of facts that were aggregated and additive
+        # aggregates with labels of sums of squares (see `sample_facts()`)
+        self.sample_method = None
+        self.sample_fraction = None
+        self.sample_squares = []
+
+        # Cell of the last statement, which selects fact partitions
+        self.partition_cell = None
+
+        # Keyset pagination: list of tuples (`name`, `index`) of the order
+        # keys and indexes of their values in a result row (see `order()`)
+        self.keyset = None
+        self._keyset_columns = []
+        self._keyset_having = False
+
+        # Names of bound parameters of cuts (see `cell_parameters()`) by cut
+        # object id. Statement can be cached if its conditions do not
+        # depend on anything else than the cut values.
+        self.cut_parameters = {}
+        self.cacheable = True
+
         # Semi-additive dimension
         # TODO: move this to model (this is ported from the original
         # SnapshotBrowser)
@@ -681,7 +1180,8 @@ class QueryBuilder(object):
             self.semiadditive_dimension = None
 
     def aggregation_statement(self, cell, drilldown=None, aggregates=None,
-                              split=None, attributes=None, summary_only=False):
+                              split=None, attributes=None, summary_only=False,
+                              sample=None):
         """Builds a statement to aggregate the `cell`.
 
         * `cell` – `Cell` to aggregate
@@ -691,6 +1191,10 @@ class QueryBuilder(object):
         * `summary_only` – do not perform GROUP BY for the drilldown. The
         * drilldown is used only for choosing tables to join and affects outer
           detail joins in the result
+        * `sample` – fraction of facts to be aggregated, see
+          `sample_facts()`. Sums of squared measure values of the sampled
+          facts are appended to the selection after the labelled columns,
+          see `sample_squares`.
 
         Algorithm description:
 
@@ -733,8 +1237,16 @@ class QueryBuilder(object):
         if not aggregates:
             raise ArgumentError("List of aggregates sohuld not be empty")
 
+        self.partition_cell = cell
+
         drilldown = drilldown or Drilldown()
 
+        # Cut values are bound parameters, see `cell_parameters()`
+        for prefix, cut_cell in (("c", cell), ("s", split)):
+            cuts = cut_cell.cuts if cut_cell else []
+            for i, cut in enumerate(cuts):
+                self.cut_parameters[id(cut)] = "%s%d" % (prefix, i)
+
         # Configuraion of statement parts
         master = _StatementConfiguration()
         detail = _StatementConfiguration()
@@ -846,6 +1358,10 @@ class QueryBuilder(object):
 
         master_conditions = self.conditions_for_cuts(master.cuts)
 
+        sample_condition = self.sample_facts(sample)
+        if sample_condition is not None:
+            master_conditions.append(sample_condition)
+
         if simple_method:
             self.logger.debug("statement: simple")
 
@@ -1046,13 +1562,25 @@ class QueryBuilder(object):
         else:
             selection += aggregate_selection
 
+        if self.sample_method:
+            squares, square_selection = self._sample_squares(aggregates)
+            self.sample_squares = squares
+        else:
+            square_selection = []
+
         # condition = None
-        statement = sql.expression.select(selection,
+        statement = sql.expression.select(selection + square_selection,
                                           from_obj=join_expression,
                                           use_labels=True,
                                           whereclause=condition,
                                           group_by=group_by)
 
+        if self.sample_method == "tablesample":
+            fact_table = self.snowflake.fact_table
+            sampled = SampledTable(fact_table,
+                                   tablesample_clause(self.dialect, sample))
+            statement = statement.replace_selectable(fact_table, sampled)
+
         self.statement = statement
         self.labels = self.snowflake.logical_labels(selection)
 
@@ -1060,8 +1588,218 @@ class QueryBuilder(object):
         self.drilldown = drilldown
         self.split = split
 
+        # Used by the window totals
+        self.coalesce_measures = coalesce_measures
+        self.is_semiadditive = bool(semiadditive_attribute)
+
+        return self.statement
+
+    def grouping_sets_statement(self, cell, drilldowns, aggregates):
+        """Builds one statement that aggregates the `cell` by every drilldown
+        from the list `drilldowns` and the grand total using ``GROUPING
+        SETS``. The selection contains attributes of all the drilldowns,
+        aggregates and one ``GROUPING()`` indicator for every attribute,
+        labelled ``__grouping<i>``, which is 1 for the attributes that are
+        not grouped in the row. The indicators are not in the `labels`.
+
+        Returns ``None`` if the statement can not be composed: when there
+        are outer detail attributes, a semi-additive dimension or
+        period-to-date conditions."""
+
+        if self.semiadditive_dimension \
+                or self.cube.browser_options.get("ptd_master_required"):
+            return None
+
+        attributes = []
+        sets = []
+        for drilldown in drilldowns:
+            drilldown_attributes = drilldown.all_attributes()
+            for attribute in drilldown_attributes:
+                if attribute not in attributes:
+                    attributes.append(attribute)
+            if drilldown_attributes not in sets:
+                sets.append(drilldown_attributes)
+
+            if self._ptd_attributes(cell, drilldown):
+                return None
+
+        cell_attributes = self.attributes_for_cell(cell)
+        for attribute in set(attributes) | cell_attributes:
+            if self.snowflake.is_outer_detail(attribute):
+                return None
+
+        self.partition_cell = cell
+
+        selection = [self.column(a) for a in attributes]
+        aggregate_selection = self.builtin_aggregate_expressions(aggregates)
+
+        grouping = []
+        for i, column in enumerate(selection):
+            function = sql.expression.func.grouping(column.element)
+            grouping.append(function.label("__grouping%d" % i))
+
+        grouping_sets = [[self.column(a).element for a in attrs]
+                         for attrs in sets]
+        if [] not in grouping_sets:
+            grouping_sets.append([])
+
+        join = self.snowflake.join_expression(set(aggregates)
+                                              | set(attributes)
+                                              | cell_attributes)
+        condition = self.condition_for_cell(cell)
+
+        self.statement = sql.expression.select(selection
+                                                + aggregate_selection
+                                                + grouping,
+                                           from_obj=join.expression,
+                                           use_labels=True,
+                                           whereclause=condition,
+                                           group_by=[GroupingSets(grouping_sets)])
+        self.labels = self.snowflake.logical_labels(selection
+                                                    + aggregate_selection)
+
         return self.statement
 
+    def window_totals(self, aggregates, include_summary=True,
+                      include_cell_count=True):
+        """Appends window expressions to the aggregation statement that
+        compute totals over all the drilled-down cells, regardless of
+        pagination: total cell count as ``COUNT(*) OVER ()`` and summary of
+        aggregates, such as ``SUM(SUM(amount)) OVER ()``. The expressions are
+        not included in the `labels`, they are appended after the labelled
+        columns.
+
+        Returns a list of labels of the appended totals: ``None`` for the
+        cell count followed by aggregate names. Summary is included only if
+        all the aggregates computed in the statement can be rolled-up and the
+        statement is not semi-additive, otherwise the list contains only the
+        cell count (if requested).
+
+        Requires a database engine with window functions."""
+
+        totals = []
+        labels = []
+
+        if include_cell_count:
+            totals.append(sql.functions.count().over())
+            labels.append(None)
+
+        if include_summary and not self.is_semiadditive:
+            summary = []
+            for aggregate in aggregates:
+                if not aggregate.function:
+                    summary = None
+                    break
+
+                name = aggregate.function.lower()
+                function = self.browser.builtin_function(name, aggregate)
+                if not function:
+                    # Post-aggregation calculation, not in the statement
+                    continue
+
+                rollup = get_rollup_function(name)
+                if not rollup:
+                    summary = None
+                    break
+
+                expression = function.apply(aggregate, self,
+                                            self.coalesce_measures)
+                summary.append((aggregate.name, rollup(expression).over()))
+
+            if summary:
+                for label, expression in summary:
+                    totals.append(expression)
+                    labels.append(label)
+
+        for i, expression in enumerate(totals):
+            label = "__total%d" % i
+            self.statement = self.statement.column(expression.label(label))
+
+        return labels
+
+    @property
+    def dialect(self):
+        return self.browser.connectable.dialect
+
+    def sample_facts(self, fraction):
+        """Prepares aggregation of about `fraction` of facts. The fact table
+        is sampled with ``TABLESAMPLE`` where the database supports it
+        (see `tablesample_clause()`). Otherwise facts with integer key
+        divisible by ``round(1 / fraction)`` are aggregated and the condition
+        is returned. Raises `ArgumentError` if the fact key is not an
+        integer in that case.
+
+        Sets `sample_method` and `sample_fraction` – the fraction that is
+        actually sampled. Nothing is sampled if `fraction` is ``None`` or
+        1."""
+
+        self.sample_squares = []
+
+        if not fraction or fraction >= 1:
+            self.sample_method = None
+            self.sample_fraction = None
+            return None
+
+        # Partitions replacing the fact table can not be sampled by the
+        # database
+        if tablesample_clause(self.dialect, fraction) \
+                and self.snowflake.partitions is None:
+            self.sample_method = "tablesample"
+            self.sample_fraction = fraction
+            return None
+
+        table = self.snowflake.fact_table
+        try:
+            key = table.c[self.snowflake.fact_key]
+        except KeyError:
+            key = list(table.columns)[0]
+
+        # Modulo of other types is computed from coerced values, such as 0
+        # for most strings in SQLite and MySQL
+        if not isinstance(key.type, sqlalchemy.types.Integer) \
+                and not (isinstance(key.type, sqlalchemy.types.Numeric)
+                         and key.type.scale == 0):
+            raise ArgumentError("Facts of cube '%s' can not be sampled: "
+                                "fact key '%s' is not an integer"
+                                % (self.cube.name, key.name))
+
+        modulus = max(int(round(1.0 / fraction)), 1)
+        self.sample_method = "modulo"
+        self.sample_fraction = 1.0 / modulus
+
+        return (key % modulus) == 0
+
+    def _sample_squares(self, aggregates):
+        """Returns a tuple (`squares`, `columns`) where `columns` are sums of
+        squared measure values of sampled facts, one for every ``sum``
+        aggregate, and `squares` is a list of tuples (`aggregate`, `label`)
+        of additive aggregates – aggregates rolled-up by ``sum``, such as
+        ``sum`` or ``count``. `label` is the label of the sum of squares of
+        the aggregate or ``None`` for counts."""
+
+        squares = []
+        columns = []
+        for aggregate in aggregates:
+            if not aggregate.function:
+                continue
+
+            name = aggregate.function.lower()
+            if rollup_function_name(name) != "sum":
+                continue
+
+            if name != "sum":
+                squares.append((aggregate, None))
+                continue
+
+            function = self.browser.builtin_function(name, aggregate)
+            column = function.measure_column(aggregate, self)
+            label = "__square%d" % len(columns)
+            expression = sql.functions.sum(column * column)
+            columns.append(expression.label(label))
+            squares.append((aggregate, label))
+
+        return (squares, columns)
+
     def _split_attributes_by_relationship(self, attributes):
         """Returns a tuple (`master`, `detail`) where `master` is a list of
         attributes that have master/match relationship towards the fact and
@@ -1204,6 +1942,8 @@ class QueryBuilder(object):
         if attributes is None:
             attributes = self.cube.all_attributes()
 
+        self.partition_cell = cell
+
         join_attributes = set(attributes) | self.attributes_for_cell(cell)
 
         join_product = self.snowflake.join_expression(attributes)
@@ -1235,6 +1975,77 @@ class QueryBuilder(object):
         self.statement = self.statement.group_by(*self.statement.columns)
         return self.statement
 
+    def dimension_members_statement(self, attributes):
+        """Prepares a statement that selects distinct values of dimension
+        `attributes` from the dimension tables, without joining the fact
+        table. All members are selected, including those without any fact.
+        If the dimension tables can not be joined on their own, then the
+        members are selected through the fact table as in
+        `members_statement()`."""
+
+        try:
+            join = self.snowflake.join_expression(attributes,
+                                                  include_fact=False)
+        except ModelError as e:
+            self.logger.debug("members can not be selected from dimension "
+                              "tables only: %s" % e)
+            return self.members_statement(None, attributes)
+
+        columns = self.snowflake.columns(attributes)
+        self.statement = sql.expression.select(columns,
+                                               from_obj=join.expression,
+                                               use_labels=True,
+                                               distinct=True)
+        self.labels = self.snowflake.logical_labels(self.statement.columns)
+
+        return self.statement
+
+    def paths_details_statement(self, dim, paths, hierarchy=None):
+        """Prepares a statement that selects attributes of levels of `paths`
+        of dimension `dim`, one row for each path. All the paths should have
+        the same length."""
+
+        hierarchy = dim.hierarchy(hierarchy)
+
+        attributes = []
+        for level in hierarchy.levels[0:len(paths[0])]:
+            attributes += level.attributes
+
+        self.members_statement(None, attributes)
+        self.append_condition(self.condition_for_paths(dim, paths, hierarchy))
+
+        return self.statement
+
+    def route_partitions(self, statement=None):
+        """Returns the `statement` (default is the prepared statement) with
+        the fact table replaced by the fact partitions containing the cell
+        of the statement (see `SnowflakeSchema.partitioned_facts()`). The
+        statement is returned as it is if the facts are not partitioned.
+
+        Use this on a complete statement, conditions appended later would
+        refer to the fact table."""
+
+        if statement is None:
+            statement = self.statement
+
+        if self.snowflake.partitions is None:
+            return statement
+
+        fact_table = self.snowflake.fact_table
+        facts = self.snowflake.partitioned_facts(self.partition_cell)
+
+        # The partitions do not derive from the fact table, therefore
+        # `replace_selectable()` would not find their corresponding columns
+        def replace(element):
+            if element is fact_table:
+                return facts
+            elif isinstance(element, sqlalchemy.Column) \
+                    and element.table is fact_table:
+                return facts.c[element.name]
+            return None
+
+        return sql.visitors.replacement_traverse(statement, {}, replace)
+
     def fact(self, id_):
         """Selects only fact with given id"""
         condition = self.snowflake.fact_key_column == id_
@@ -1363,19 +2174,25 @@ class QueryBuilder(object):
 
         for cut in cuts:
             dim = self.cube.dimension(cut.dimension)
+            parameter = self.cut_parameters.get(id(cut))
 
             if isinstance(cut, PointCut):
                 path = cut.path
                 condition = self.condition_for_point(dim, path, cut.hierarchy,
-                                                     cut.invert)
+                                                     cut.invert, parameter)
 
             elif isinstance(cut, SetCut):
                 set_conds = []
 
-                for path in cut.paths:
+                for i, path in enumerate(cut.paths):
+                    if parameter:
+                        path_parameter = "%s_%d" % (parameter, i)
+                    else:
+                        path_parameter = None
                     condition = self.condition_for_point(dim, path,
                                                          cut.hierarchy,
-                                                         cut.invert)
+                                                         cut.invert,
+                                                         path_parameter)
                     set_conds.append(condition)
 
                 condition = sql.expression.or_(*set_conds)
@@ -1387,7 +2204,8 @@ class QueryBuilder(object):
                 condition = self.range_condition(cut.dimension,
                                                  cut.hierarchy,
                                                  cut.from_path,
-                                                 cut.to_path, cut.invert)
+                                                 cut.to_path, cut.invert,
+                                                 parameter)
 
             else:
                 raise ArgumentError("Unknown cut type %s" % type(cut))
@@ -1396,11 +2214,13 @@ class QueryBuilder(object):
 
         return conditions
 
-    def condition_for_point(self, dim, path, hierarchy=None, invert=False):
+    def condition_for_point(self, dim, path, hierarchy=None, invert=False,
+                            parameter=None):
         """Returns a `Condition` tuple (`attributes`, `conditions`,
         `group_by`) dimension `dim` point at `path`. It is a compound
         condition - one equality condition for each path element in form:
-        ``level[i].key = path[i]``"""
+        ``level[i].key = path[i]``. If `parameter` is specified, then the
+        path values are bound parameters named ``<parameter>_<i>``."""
 
         conditions = []
 
@@ -1410,10 +2230,11 @@ class QueryBuilder(object):
             raise ArgumentError("Path has more items (%d: %s) than there are levels (%d) "
                                 "in dimension %s" % (len(path), path, len(levels), dim.name))
 
-        for level, value in zip(levels, path):
+        for i, (level, value) in enumerate(zip(levels, path)):
 
             # Prepare condition: dimension.level_key = path_value
             column = self.column(level.key)
+            value = self._bound_value(parameter, i, value)
             conditions.append(column == value)
 
         condition = sql.expression.and_(*conditions)
@@ -1423,14 +2244,46 @@ class QueryBuilder(object):
 
         return condition
 
-    def range_condition(self, dim, hierarchy, from_path, to_path, invert=False):
+    def condition_for_paths(self, dim, paths, hierarchy=None):
+        """Returns a condition matching any of `paths` of dimension `dim`.
+        All the paths should have the same length. Level keys are compared
+        with ``IN`` – as row values if the database supports it (see
+        `supports_row_value_in()`), otherwise the condition is a
+        disjunction of point conditions."""
+
+        depth = len(paths[0])
+        levels = dim.hierarchy(hierarchy).levels[0:depth]
+        columns = [self.column(level.key) for level in levels]
+
+        if len(columns) == 1:
+            return columns[0].in_([path[0] for path in paths])
+        elif supports_row_value_in(self.dialect):
+            row = sql.expression.tuple_(*columns)
+            return row.in_([tuple(path) for path in paths])
+        else:
+            conditions = [self.condition_for_point(dim, path, hierarchy)
+                          for path in paths]
+            return sql.expression.or_(*conditions)
+
+    def range_condition(self, dim, hierarchy, from_path, to_path, invert=False,
+                        parameter=None):
         """Return a condition for a hierarchical range (`from_path`,
-        `to_path`). Return value is a `Condition` tuple."""
+        `to_path`). Return value is a `Condition` tuple. If `parameter` is
+        specified, then the path values are bound parameters named
+        ``<parameter>_from_<i>`` and ``<parameter>_to_<i>``."""
 
         dim = self.cube.dimension(dim)
 
-        lower = self._boundary_condition(dim, hierarchy, from_path, 0)
-        upper = self._boundary_condition(dim, hierarchy, to_path, 1)
+        if parameter:
+            from_parameter = "%s_from" % parameter
+            to_parameter = "%s_to" % parameter
+        else:
+            from_parameter = to_parameter = None
+
+        lower = self._boundary_condition(dim, hierarchy, from_path, 0,
+                                         parameter=from_parameter)
+        upper = self._boundary_condition(dim, hierarchy, to_path, 1,
+                                         parameter=to_parameter)
 
         conditions = []
         if lower is not None:
@@ -1445,7 +2298,8 @@ class QueryBuilder(object):
 
         return condition
 
-    def _boundary_condition(self, dim, hierarchy, path, bound, first=True):
+    def _boundary_condition(self, dim, hierarchy, path, bound, first=True,
+                            parameter=None):
         """Return a `Condition` tuple for a boundary condition. If `bound` is
         1 then path is considered to be upper bound (operators < and <= are
         used), otherwise path is considered as lower bound (operators > and >=
@@ -1457,7 +2311,8 @@ class QueryBuilder(object):
         last = self._boundary_condition(dim, hierarchy,
                                         path[:-1],
                                         bound,
-                                        first=False)
+                                        first=False,
+                                        parameter=parameter)
 
         levels = dim.hierarchy(hierarchy).levels_for_path(path)
 
@@ -1467,8 +2322,9 @@ class QueryBuilder(object):
 
         conditions = []
 
-        for level, value in zip(levels[:-1], path[:-1]):
+        for i, (level, value) in enumerate(zip(levels[:-1], path[:-1])):
             column = self.column(level.key)
+            value = self._bound_value(parameter, i, value)
             conditions.append(column == value)
 
         # Select required operator according to bound
@@ -1482,7 +2338,8 @@ class QueryBuilder(object):
             operator = sql.operators.ge if first else sql.operators.gt
 
         column = self.column(levels[-1].key)
-        conditions.append(operator(column, path[-1]))
+        value = self._bound_value(parameter, len(path) - 1, path[-1])
+        conditions.append(operator(column, value))
         condition = condition_conjunction(conditions)
 
         if last is not None:
@@ -1490,6 +2347,15 @@ class QueryBuilder(object):
 
         return condition
 
+    def _bound_value(self, parameter, index, value):
+        """Returns `value` as a bound parameter named ``<parameter>_<index>``
+        if `parameter` is specified, otherwise returns the `value`."""
+        if parameter:
+            return sql.expression.bindparam("%s_%d" % (parameter, index),
+                                            value)
+        else:
+            return value
+
     def _ptd_attributes(self, cell, drilldown):
         """Return attributes that are used for the PTD condition. Output of
         this function is used for master/detail fact composition and for the
@@ -1555,6 +2421,9 @@ class QueryBuilder(object):
             condition = function(column)
             conditions.append(condition)
 
+            # The condition might depend on current time
+            self.cacheable = False
+
         # TODO: What about invert?
         return condition_conjunction(conditions)
 
@@ -1592,7 +2461,7 @@ class QueryBuilder(object):
 
         return self.statement
 
-    def order(self, order):
+    def order(self, order, keyset=False):
         """Returns a SQL statement which is ordered according to the `order`. If
         the statement contains attributes that have natural order specified, then
         the natural order is used, if not overriden in the `order`.
@@ -1603,6 +2472,12 @@ class QueryBuilder(object):
         `dimension_levels` is list of considered dimension levels in form of
         tuples (`dimension`, `hierarchy`, `levels`). For each level it's sort
         key is used.
+
+        If `keyset` is ``True`` then the order is made unique for keyset
+        pagination (see `seek()`): the fact key or all the selected
+        attributes are appended to the order. The order keys are stored in
+        `keyset`. Order keys that are not selected are appended to the
+        selection after the labelled columns.
         """
 
         # Each attribute mentioned in the order should be present in the selection
@@ -1633,10 +2508,13 @@ class QueryBuilder(object):
                 order.append((lvl_attr, lvl_order))
 
         order_by = OrderedDict()
+        # Unordered columns and directions of the order keys
+        keys = OrderedDict()
 
         if self.split:
             split_column = sql.expression.column(SPLIT_DIMENSION_NAME)
             order_by[SPLIT_DIMENSION_NAME] = split_column
+            keys[SPLIT_DIMENSION_NAME] = (split_column, None)
 
         # Collect the corresponding attribute columns
         for attribute, order_dir in order:
@@ -1646,10 +2524,9 @@ class QueryBuilder(object):
                 attribute = self.mapper.attribute(attribute.ref())
                 column = self.column(attribute)
 
-            column = order_column(column, order_dir)
-
             if attribute.ref() not in order_by:
-                order_by[attribute.ref()] = column
+                order_by[attribute.ref()] = order_column(column, order_dir)
+                keys[attribute.ref()] = (column, order_dir)
 
         # Collect natural order for selected columns
         for (name, column) in selection.items():
@@ -1668,11 +2545,146 @@ class QueryBuilder(object):
 
             if attribute and attribute.order and name not in order_by.keys():
                 order_by[name] = order_column(column, attribute.order)
+                keys[name] = (column, attribute.order)
+
+        if keyset:
+            for name in self._unique_keys():
+                if name not in order_by:
+                    order_by[name] = selection[name]
+                    keys[name] = (selection[name], None)
+
+            self._prepare_keyset(keys)
 
         self.statement = self.statement.order_by(*order_by.values())
 
         return self.statement
 
+    def _unique_keys(self):
+        """Returns labels of selected columns that identify a result row:
+        the fact key, if selected, otherwise all selected attributes."""
+
+        if self.snowflake.fact_key in self.labels:
+            return [self.snowflake.fact_key]
+
+        names = []
+        for name in self.labels:
+            if name == SPLIT_DIMENSION_NAME:
+                names.append(name)
+                continue
+            try:
+                self.mapper.attribute(name)
+            except KeyError:
+                # Aggregate
+                continue
+            names.append(name)
+
+        return names
+
+    def _prepare_keyset(self, keys):
+        """Stores the order `keys` – dictionary of (`column`, `direction`)
+        tuples by label – for keyset pagination."""
+
+        inner = list(self.statement.inner_columns)
+        positions = dict((name, i) for i, name in enumerate(self.labels))
+
+        self.keyset = []
+        self._keyset_columns = []
+        self._keyset_having = False
+
+        for name, (column, direction) in keys.items():
+            try:
+                index = positions[name]
+            except KeyError:
+                # Not selected
+                index = len(inner)
+                label = "__order%d" % index
+                self.statement = self.statement.column(column.label(label))
+                inner.append(column)
+            else:
+                column = inner[index]
+
+            if name not in (self.snowflake.fact_key, SPLIT_DIMENSION_NAME):
+                try:
+                    self.mapper.attribute(name)
+                except KeyError:
+                    # Aggregates can be compared only after grouping
+                    self._keyset_having = True
+
+            self.keyset.append((name, index))
+            self._keyset_columns.append((column, direction))
+
+    def seek(self):
+        """Appends a condition to the statement that selects only rows
+        following a row with order key values passed as bound parameters
+        ``k0``, ``k1``, … in order of the `keyset` prepared by `order()`.
+        The condition is an expanded lexicographic comparison, such as
+        ``a > :k0 OR (a = :k0 AND b > :k1)``, since the keys might be
+        ordered in different directions.
+
+        Keys might be ``NULL``: parameters ``n0``, ``n1``, … are 1 if the
+        respective key value is ``NULL``, otherwise 0 (see
+        `seek_parameters()`). ``NULL`` values are compared in the order of
+        the database dialect – as the smallest or as the largest values.
+
+        Use instead of the offset of `paginate()`."""
+
+        if self.keyset is None:
+            raise InternalError("Order keyset is not prepared, use "
+                                "order(..., keyset=True)")
+
+        smallest = nulls_sort_first(self.dialect)
+
+        conditions = []
+        equal = []
+        for i, (column, direction) in enumerate(self._keyset_columns):
+            parameter = sql.expression.bindparam("k%d" % i, type_=column.type)
+            is_null = sql.expression.bindparam("n%d" % i,
+                                               type_=sqlalchemy.Integer) == 1
+            not_null = sql.expression.bindparam("n%d" % i,
+                                                type_=sqlalchemy.Integer) == 0
+
+            descending = direction and direction.lower().startswith("desc")
+            if descending:
+                following = column < parameter
+            else:
+                following = column > parameter
+
+            if smallest != bool(descending):
+                # NULLs first: any value follows NULL
+                condition = sql.expression.or_(
+                    sql.expression.and_(is_null, column != None),
+                    sql.expression.and_(not_null, following))
+            else:
+                # NULLs last: only NULLs follow NULL, which is not greater
+                condition = sql.expression.and_(
+                    not_null, sql.expression.or_(following, column == None))
+
+            conditions.append(sql.expression.and_(*(equal + [condition])))
+            equal.append(sql.expression.or_(
+                sql.expression.and_(is_null, column == None),
+                sql.expression.and_(not_null, column == parameter)))
+
+        condition = sql.expression.or_(*conditions)
+
+        if self._keyset_having:
+            self.statement = self.statement.having(condition)
+        else:
+            self.statement = self.statement.where(condition)
+
+        return self.statement
+
+    @staticmethod
+    def seek_parameters(values):
+        """Returns dictionary of bound parameters of the `seek()` condition
+        for order key `values`."""
+
+        parameters = {}
+        for i, value in enumerate(values):
+            parameters["k%d" % i] = value
+            parameters["n%d" % i] = 1 if value is None else 0
+
+        return parameters
+
 
 
 # Used as a workaround for "condition" attribute mapping property
@@ -0,0 +1,144 @@
+# -*- coding=utf -*-
+"""Routing of read queries to database replicas."""
+
+from ...logging import get_logger
+
+import threading
+import time
+
+try:
+    import sqlalchemy
+    import sqlalchemy.sql as sql
+except ImportError:
+    from cubes.common import MissingPackage
+    sqlalchemy = sql = MissingPackage("sqlalchemy", "SQL replicas")
+
+
+__all__ = [
+    "ReplicaSet",
+    "pool_statistics"
+]
+
+
+# Number of seconds a failed replica is not used before it is checked again
+DEFAULT_RETRY_INTERVAL = 30
+
+
+def pool_statistics(engine):
+    """Returns a dictionary with utilization of the connection pool of
+    `engine`: `size`, `checked_in`, `checked_out` and `overflow` for pools
+    with a limited size (such as the default `QueuePool`), otherwise just
+    `pool` – class name of the pool."""
+
+    pool = engine.pool
+    stats = {"pool": pool.__class__.__name__}
+
+    if isinstance(pool, sqlalchemy.pool.QueuePool):
+        stats["size"] = pool.size()
+        stats["checked_in"] = pool.checkedin()
+        stats["checked_out"] = pool.checkedout()
+        stats["overflow"] = pool.overflow()
+
+    return stats
+
+
+class ReplicaSet(object):
+    def __init__(self, primary, replicas=None,
+                 retry_interval=DEFAULT_RETRY_INTERVAL):
+        """Set of `replicas` – SQLAlchemy engines of read-only copies of the
+        `primary` database. Reads are balanced across the replicas in
+        round-robin order. A replica that failed is skipped for
+        `retry_interval` seconds, then it is checked with a simple query
+        before it is used again – by one caller, the others skip it until
+        the check is done. The primary is used when no replica is
+        available."""
+
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.retry_interval = retry_interval
+
+        # Time of the last failure by replica index
+        self.failed = {}
+
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.logger = get_logger()
+
+    def connectables(self):
+        """Returns list of engines to be tried for a read query in order:
+        available replicas starting with the next one in the round-robin
+        order, followed by the primary."""
+
+        if not self.replicas:
+            return [self.primary]
+
+        with self.lock:
+            start = self.counter % len(self.replicas)
+            self.counter += 1
+
+        indexes = range(start, len(self.replicas)) + range(0, start)
+        now = time.time()
+
+        engines = []
+        for index in indexes:
+            with self.lock:
+                failed = self.failed.get(index)
+                if failed is not None:
+                    if now - failed < self.retry_interval:
+                        continue
+                    # Claim the check, other callers skip the replica for
+                    # another interval or until the check succeeds
+                    self.failed[index] = now
+
+            if failed is not None and not self.check(index):
+                continue
+            engines.append(self.replicas[index])
+
+        engines.append(self.primary)
+        return engines
+
+    def check(self, index):
+        """Checks whether replica at `index` responds. Returns ``True`` and
+        marks the replica as available if it does."""
+
+        engine = self.replicas[index]
+        try:
+            engine.execute(sql.expression.select([sql.expression.literal(1)]))
+        except sqlalchemy.exc.DBAPIError as e:
+            self.logger.warn("replica %s is still not available: %s"
+                             % (repr(engine.url), e))
+            with self.lock:
+                self.failed[index] = time.time()
+            return False
+
+        self.logger.info("replica %s is available again"
+                         % (repr(engine.url), ))
+        with self.lock:
+            self.failed.pop(index, None)
+        return True
+
+    def mark_failed(self, engine, error=None):
+        """Marks replica `engine` as failed. Does nothing for the primary."""
+        for index, replica in enumerate(self.replicas):
+            if replica is engine:
+                self.logger.warn("replica %s failed: %s"
+                                 % (repr(engine.url), error))
+                with self.lock:
+                    self.failed[index] = time.time()
+
+    def statistics(self):
+        """Returns a list of dictionaries with connection pool statistics of
+        the replicas (see `pool_statistics()`) with additional keys `url`
+        (without password) and `available`."""
+
+        result = []
+        for index, engine in enumerate(self.replicas):
+            stats = pool_statistics(engine)
+            stats["url"] = repr(engine.url)
+            stats["available"] = index not in self.failed
+            result.append(stats)
+
+        return result
+
+    def __len__(self):
+        return len(self.replicas)
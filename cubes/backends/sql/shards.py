@@ -0,0 +1,655 @@
+# -*- coding=utf -*-
+"""Aggregation of facts sharded across multiple SQL databases."""
+
+from ...browser import *
+from ...browser import SPLIT_DIMENSION_NAME
+from ...logging import get_logger
+from ...model import Cube, MeasureAggregate
+from ...statutils import calculators_for_aggregates
+from ...stores import Store
+from ...errors import *
+from .browser import SnowflakeBrowser
+from .functions import rollup_function_name, available_aggregate_functions
+from .functions import merge_records
+from .mapper import DEFAULT_KEY_FIELD
+from .store import SQLStore
+
+from collections import OrderedDict
+from functools import total_ordering
+import heapq
+import itertools
+import threading
+
+try:
+    import sqlalchemy
+except ImportError:
+    from cubes.common import MissingPackage
+    sqlalchemy = MissingPackage("sqlalchemy", "sharded SQL store")
+
+
+__all__ = [
+    "ShardedSQLStore",
+    "ShardedBrowser",
+    "merge_records"
+]
+
+
+# Labels of the partial aggregates of an average aggregate
+AVERAGE_SUM_LABEL = "__%s_sum"
+AVERAGE_COUNT_LABEL = "__%s_count"
+
+
+@total_ordering
+class _Descending(object):
+    """Sort key wrapper of a value in descending order."""
+
+    __slots__ = ("value", )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+
+def _sort_key(order):
+    """Returns a function that returns sort key of a record ordered by
+    `order` – list of (`label`, `direction`) tuples."""
+
+    def key(record):
+        values = []
+        for label, direction in order:
+            value = record.get(label)
+            if direction and direction.lower() == "desc":
+                value = _Descending(value)
+            values.append(value)
+        return tuple(values)
+
+    return key
+
+
+def _page(records, page, page_size):
+    """Returns records of `page` of the list `records`."""
+    if page_size and page is not None:
+        return records[page * page_size:(page + 1) * page_size]
+    else:
+        return records
+
+
+class ShardedSQLStore(Store):
+    __identifier__ = "sharded_sql"
+
+    def model_provider_name(self):
+        return 'default'
+
+    default_browser_name = "sharded"
+
+    def __init__(self, shards=None, stores=None, **options):
+        """Store of facts sharded across multiple databases with the same
+        schema, such as by customer. Every shard is a `SQLStore`.
+
+        Options:
+
+        * `shards` – list of database URLs of the shards (or a string of
+          whitespace separated URLs)
+        * `stores` – list of `SQLStore` objects, instead of `shards`
+
+        Other options, such as ``schema``, ``fact_prefix`` or SQLAlchemy
+        options, are passed to the store of every shard.
+        """
+
+        if shards and stores:
+            raise ArgumentError("Both shards and stores specified. Use only "
+                                "one.")
+
+        if isinstance(shards, basestring):
+            shards = shards.split()
+
+        if stores:
+            self.stores = list(stores)
+        else:
+            self.stores = [SQLStore(url=url, **options)
+                           for url in shards or []]
+
+        if not self.stores:
+            raise ArgumentError("No shards specified for the sharded store")
+
+        self.logger = get_logger()
+        self.options = self.stores[0].options
+
+    def flush_cache(self, cube=None):
+        """Flushes caches of the stores of all the shards."""
+        for store in self.stores:
+            store.flush_cache(cube)
+
+    def statistics(self):
+        """Returns a dictionary with key ``shards`` – list of statistics of
+        the shard stores (see `SQLStore.statistics()`)."""
+        return {"shards": [store.statistics() for store in self.stores]}
+
+
+class ShardedBrowser(AggregationBrowser):
+    __identifier__ = "sharded"
+
+    def __init__(self, cube, store, locale=None, **options):
+        """Browser of a cube with facts sharded across the stores of a
+        `ShardedSQLStore`. Every query is executed by a `SnowflakeBrowser`
+        of every shard and the shard results are merged.
+
+        Aggregates with functions ``sum``, ``count``, ``count_nonempty``,
+        ``min`` and ``max`` are merged by their roll-up function.
+        Averages are computed from sums and counts of their measures
+        aggregated by the shards. Post-aggregation calculations are computed
+        from the merged cells. Other aggregates, such as
+        ``count_distinct``, can not be merged.
+        """
+
+        super(ShardedBrowser, self).__init__(cube, store, locale=locale)
+
+        self.logger = get_logger()
+        self.cube = cube
+        self.store = store
+        self.locale = locale or cube.locale
+
+        the_options = {}
+        the_options.update(store.options)
+        the_options.update(options)
+        options = the_options
+
+        self.include_summary = options.get("include_summary", True)
+        self.include_cell_count = options.get("include_cell_count", True)
+        self.timeout = options.get("timeout")
+
+        self.shard_cube = self._shard_cube()
+        self.browsers = [SnowflakeBrowser(self.shard_cube, shard,
+                                          locale=locale, **options)
+                         for shard in store.stores]
+
+        # Connections of single-connection pools can not be used by
+        # multiple threads
+        self.concurrent = True
+        for shard in store.stores:
+            pool = getattr(shard.connectable, "pool", None)
+            if isinstance(pool, (sqlalchemy.pool.SingletonThreadPool,
+                                 sqlalchemy.pool.StaticPool)):
+                self.concurrent = False
+
+    def _shard_cube(self):
+        """Returns the cube aggregated by the shards – the browsed cube with
+        aggregates that can be merged. Averages are replaced by sums and
+        counts of their measures (see `AVERAGE_SUM_LABEL` and
+        `AVERAGE_COUNT_LABEL`)."""
+
+        aggregates = []
+        for agg in self.cube.aggregates:
+            if agg.function and rollup_function_name(agg.function):
+                aggregates.append(agg)
+            elif agg.function == "avg" and agg.measure:
+                aggregates.append(MeasureAggregate(AVERAGE_SUM_LABEL
+                                                        % agg.name,
+                                                   measure=agg.measure,
+                                                   function="sum"))
+                aggregates.append(MeasureAggregate(AVERAGE_COUNT_LABEL
+                                                        % agg.name,
+                                                   measure=agg.measure,
+                                                   function="count_nonempty"))
+
+        cube = self.cube
+        return Cube(cube.name,
+                    dimensions=cube.dimensions,
+                    measures=cube.measures,
+                    aggregates=aggregates,
+                    label=cube.label,
+                    details=cube.details,
+                    mappings=cube.mappings,
+                    joins=cube.joins,
+                    fact=cube.fact,
+                    key=cube.key,
+                    browser_options=cube.browser_options,
+                    info=cube.info,
+                    locale=cube.locale,
+                    datastore=cube.datastore)
+
+    def features(self):
+        """Returns features of the shard browsers without sampling and page
+        tokens."""
+        features = self.browsers[0].features()
+        features.pop("sampling", None)
+        features["query_options"] = [option for option
+                                     in features.get("query_options", [])
+                                     if option != "after"]
+        return features
+
+    def is_builtin_function(self, name, aggregate):
+        return self.browsers[0].is_builtin_function(name, aggregate)
+
+    def scatter(self, function):
+        """Calls `function` with the browser of every shard and returns list
+        of the results in the order of the shards. The function is called
+        concurrently, one thread for every shard, unless the shards use
+        single-connection pools. The first exception raised by the function
+        is raised."""
+
+        if not self.concurrent or len(self.browsers) == 1:
+            return [function(browser) for browser in self.browsers]
+
+        results = [None] * len(self.browsers)
+        errors = [None] * len(self.browsers)
+
+        def run(index, browser):
+            try:
+                results[index] = function(browser)
+            except Exception as e:
+                self.logger.debug("shard %d failed: %s" % (index, e))
+                errors[index] = e
+
+        threads = []
+        for index, browser in enumerate(self.browsers):
+            thread = threading.Thread(target=run, args=(index, browser))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+
+        return results
+
+    def _shard_cell(self, browser, cell):
+        if cell is None:
+            return None
+        return Cell(browser.cube, cell.cuts)
+
+    def _shard_aggregates(self, aggregates):
+        """Returns a tuple (`names`, `functions`, `averages`): `names` of
+        aggregates of the shard cube for `aggregates`, dictionary of their
+        roll-up `functions` and list of `averages` – tuples (`name`, `sum
+        label`, `count label`)."""
+
+        names = []
+        functions = {}
+        averages = []
+
+        for agg in aggregates:
+            if agg.function and rollup_function_name(agg.function):
+                names.append(agg.name)
+                functions[agg.name] = rollup_function_name(agg.function)
+            elif agg.function == "avg" and agg.measure:
+                sum_label = AVERAGE_SUM_LABEL % agg.name
+                count_label = AVERAGE_COUNT_LABEL % agg.name
+                names += [sum_label, count_label]
+                functions[sum_label] = "sum"
+                functions[count_label] = "sum"
+                averages.append((agg.name, sum_label, count_label))
+            elif agg.function and not self.is_builtin_function(agg.function,
+                                                               agg):
+                # Post-aggregation calculation of the merged cells
+                continue
+            else:
+                raise ArgumentError("Aggregate '%s' can not be merged from "
+                                    "shards of cube '%s'"
+                                    % (agg.name, self.cube.name))
+
+        return (names, functions, averages)
+
+    def _finish_record(self, record, averages):
+        """Computes `averages` of a merged `record` and removes their partial
+        aggregates."""
+
+        for name, sum_label, count_label in averages:
+            total = record.pop(sum_label, None)
+            count = record.pop(count_label, None)
+            if total is None or not count:
+                record[name] = None
+            else:
+                record[name] = float(total) / count
+
+        return record
+
+    def aggregate(self, cell=None, measures=None, drilldown=None, split=None,
+                  attributes=None, page=None, page_size=None, order=None,
+                  include_summary=None, include_cell_count=None,
+                  aggregates=None, **options):
+        """Returns aggregation result merged from the aggregations of every
+        shard, see `SnowflakeBrowser.aggregate()`. The shards are aggregated
+        concurrently.
+
+        Cells of the shards are merged by their drill-down attributes. The
+        summary is merged from the shard summaries.
+
+        Paginated queries ordered only by the drill-down attributes (such as
+        the default order) fetch only the first ``(page + 1) * page_size``
+        cells from every shard and merge the ordered shard cells by a k-way
+        merge; `total_cell_count` is not known then. Cells of other queries
+        are all fetched from the shards, then ordered and paginated, and
+        `total_cell_count` is the number of merged cells. Queries ordered by
+        aggregates can not be paginated through high-cardinality levels.
+
+        Options `sample` and `after` are not supported."""
+
+        if not cell:
+            cell = Cell(self.cube)
+
+        if options.get("sample"):
+            raise ArgumentError("Sampled aggregation is not supported by "
+                                "sharded stores")
+        if options.get("after") is not None:
+            raise ArgumentError("Page tokens are not supported by sharded "
+                                "stores")
+
+        aggregates = self.prepare_aggregates(aggregates, measures)
+        drilldown = Drilldown(drilldown, cell)
+        order = self.prepare_order(order, is_aggregate=True)
+
+        if include_summary is None:
+            include_summary = self.include_summary
+        if include_cell_count is None:
+            include_cell_count = self.include_cell_count
+
+        (names, functions, averages) = self._shard_aggregates(aggregates)
+        timeout = options.get("timeout")
+
+        # Order of the cells: split, requested order and the drill-down
+        # levels, the same as in the shards
+        cell_order = self._cell_order(drilldown, split, order)
+
+        paginated = bool(page_size and page is not None)
+        merged_pages = bool(drilldown or split) and paginated \
+                        and self._is_key_order(drilldown, order)
+
+        if drilldown and not merged_pages:
+            if not paginated:
+                self.assert_low_cardinality(cell, drilldown)
+            elif drilldown.high_cardinality_levels(cell):
+                raise ArgumentError("Cells ordered by aggregates can not be "
+                                    "paginated through high-cardinality "
+                                    "levels of sharded cube '%s'"
+                                    % (self.cube.name, ))
+
+        if merged_pages:
+            shard_order = [item for item in cell_order
+                           if item[0] != SPLIT_DIMENSION_NAME]
+            shard_page = {"order": shard_order, "page": 0,
+                          "page_size": (page + 1) * page_size}
+        else:
+            shard_page = {}
+
+        def aggregate(browser):
+            result = browser.aggregate(self._shard_cell(browser, cell),
+                                       aggregates=names,
+                                       drilldown=drilldown.items_as_strings(),
+                                       split=self._shard_cell(browser, split),
+                                       attributes=attributes,
+                                       include_summary=include_summary,
+                                       include_cell_count=False,
+                                       timeout=timeout,
+                                       **shard_page)
+            # Fetch the cells within the thread
+            return (result, list(result.cells))
+
+        shard_results = self.scatter(aggregate)
+
+        result = AggregationResult(cell=cell, aggregates=aggregates)
+
+        # Summary
+        # -------
+
+        summaries = [r.summary for r, cells in shard_results if r.summary]
+        if summaries:
+            summary = merge_records(summaries, functions)
+            result.summary = self._finish_record(summary, averages)
+        else:
+            result.summary = None
+
+        # Cells
+        # -----
+
+        if drilldown or split:
+            result.levels = drilldown.result_levels(include_split=bool(split))
+
+            (first, rows) = shard_results[0]
+            keys = [label for label in first.labels
+                    if label not in functions]
+
+            def cell_key(row):
+                return tuple(row.get(label) for label in keys)
+
+            if merged_pages:
+                sort_key = _sort_key(cell_order)
+
+                def decorated(index, rows):
+                    for row in rows:
+                        yield (sort_key(row), index, row)
+
+                merged = heapq.merge(*[decorated(index, rows)
+                                       for index, (shard_result, rows)
+                                       in enumerate(shard_results)])
+                merged = (row for key, index, row in merged)
+
+                # Cells with the same key are adjacent, because the drill-down
+                # keys are part of the order
+                groups = (list(rows) for key, rows
+                          in itertools.groupby(merged, cell_key))
+                groups = itertools.islice(groups, page * page_size,
+                                          (page + 1) * page_size)
+
+                records = [self._finish_record(merge_records(rows, functions),
+                                               averages)
+                           for rows in groups]
+            else:
+                cells = OrderedDict()
+                for shard_result, rows in shard_results:
+                    for row in rows:
+                        cells.setdefault(cell_key(row), []).append(row)
+
+                records = [self._finish_record(merge_records(rows, functions),
+                                               averages)
+                           for rows in cells.values()]
+
+                records.sort(key=_sort_key(cell_order))
+
+                if include_cell_count:
+                    result.total_cell_count = len(records)
+
+                records = _page(records, page, page_size)
+
+            result.calculators = calculators_for_aggregates(self.cube,
+                                                            aggregates,
+                                                            drilldown,
+                                                            split,
+                                                            available_aggregate_functions())
+            result.cells = records
+
+            result.labels = keys + [agg.name for agg in aggregates
+                                    if agg.name in functions
+                                        or agg.function == "avg"]
+            result.types = dict((label, first.types.get(label))
+                                for label in result.labels)
+            for name, sum_label, count_label in averages:
+                result.types[name] = float
+
+        elif result.summary is not None:
+            calculators = calculators_for_aggregates(self.cube,
+                                                     aggregates,
+                                                     drilldown,
+                                                     split,
+                                                     available_aggregate_functions())
+            for calc in calculators:
+                calc(result.summary)
+
+        return result
+
+    def _cell_order(self, drilldown, split, order):
+        """Returns order of the aggregated cells as a list of (`label`,
+        `direction`) tuples: the split, prepared `order` and the order
+        attributes and keys of the drill-down levels."""
+
+        cell_order = []
+        if split:
+            cell_order.append((SPLIT_DIMENSION_NAME, None))
+        for attribute, direction in order:
+            cell_order.append((attribute.ref(), direction))
+        for dditem in drilldown:
+            for level in dditem.levels:
+                direction = level.order or "asc"
+                attribute = level.order_attribute or level.key
+                cell_order.append((attribute.ref(), direction))
+                if level.key.ref() != attribute.ref():
+                    cell_order.append((level.key.ref(), direction))
+
+        return cell_order
+
+    def _is_key_order(self, drilldown, order):
+        """Returns `True` if prepared `order` contains only attributes of
+        the `drilldown` levels, therefore the shards order their cells the
+        same way as the merged cells are ordered."""
+
+        refs = set(attribute.ref() for attribute
+                   in drilldown.all_attributes())
+        return all(attribute.ref() in refs for attribute, direction in order)
+
+    def facts(self, cell=None, fields=None, order=None, page=None,
+              page_size=None, timeout=None, after=None):
+        """Returns facts of the `cell` from all the shards. Facts of ordered
+        or paginated queries are merged from the ordered facts of the shards
+        by a k-way merge – the order of facts with equal order keys is given
+        by the fact key. Only the first ``(page + 1) * page_size`` facts are
+        fetched from every shard for a page. Facts of other queries are
+        returned shard by shard.
+
+        Order attributes should be selected in `fields`. Option `after` is
+        not supported."""
+
+        if after is not None:
+            raise ArgumentError("Page tokens are not supported by sharded "
+                                "stores")
+
+        cell = cell or Cell(self.cube)
+        prepared = self.prepare_order(order, is_aggregate=False)
+
+        if page_size:
+            page = page or 0
+            limit = (page + 1) * page_size
+
+            def facts(browser):
+                return list(browser.facts(self._shard_cell(browser, cell),
+                                          fields=fields,
+                                          order=order,
+                                          page=0,
+                                          page_size=limit,
+                                          timeout=timeout))
+
+            shard_facts = self.scatter(facts)
+        else:
+            # Facts are streamed, the cursors are consumed in this thread
+            shard_facts = [browser.facts(self._shard_cell(browser, cell),
+                                         fields=fields,
+                                         order=order,
+                                         timeout=timeout)
+                           for browser in self.browsers]
+
+        if not (prepared or page_size):
+            return itertools.chain(*shard_facts)
+
+        fact_order = [(attribute.ref(), direction)
+                      for attribute, direction in prepared]
+        fact_order.append((self.cube.key or DEFAULT_KEY_FIELD, "asc"))
+
+        sort_key = _sort_key(fact_order)
+
+        def decorated(index, facts):
+            for fact in facts:
+                yield (sort_key(fact), index, fact)
+
+        merged = heapq.merge(*[decorated(index, facts)
+                               for index, facts in enumerate(shard_facts)])
+        merged = (fact for key, index, fact in merged)
+
+        if page_size:
+            return list(itertools.islice(merged, page * page_size, limit))
+        else:
+            return merged
+
+    def fact(self, key, fields=None, timeout=None):
+        """Returns fact with `key` from the first shard that has it."""
+        for browser in self.browsers:
+            fact = browser.fact(key, fields=fields, timeout=timeout)
+            if fact is not None:
+                return fact
+        return None
+
+    def members(self, cell, dimension, depth=None, hierarchy=None, page=None,
+                page_size=None, order=None, timeout=None, after=None):
+        """Returns distinct members of `dimension` in the `cell` of all the
+        shards, ordered by `order` and by the level order. Option `after` is
+        not supported."""
+
+        if after is not None:
+            raise ArgumentError("Page tokens are not supported by sharded "
+                                "stores")
+
+        cell = cell or Cell(self.cube)
+        prepared = self.prepare_order(order, is_aggregate=False)
+
+        dimension = self.cube.dimension(dimension)
+        hierarchy = dimension.hierarchy(hierarchy)
+
+        def members(browser):
+            return list(browser.members(self._shard_cell(browser, cell),
+                                        dimension.name,
+                                        depth=depth,
+                                        hierarchy=hierarchy.name,
+                                        order=order,
+                                        timeout=timeout))
+
+        unique = OrderedDict()
+        for shard_members in self.scatter(members):
+            for member in shard_members:
+                unique.setdefault(tuple(sorted(member.items())), member)
+
+        levels = hierarchy.levels[0:depth] if depth else hierarchy.levels
+        member_order = [(attribute.ref(), direction)
+                        for attribute, direction in prepared]
+        for level in levels:
+            attribute = level.order_attribute or level.key
+            member_order.append((attribute.ref(), level.order or "asc"))
+
+        records = sorted(unique.values(), key=_sort_key(member_order))
+
+        return _page(records, page, page_size)
+
+    def path_details(self, dimension, path, hierarchy=None):
+        """Returns details of `path` from the first shard that has it."""
+        for browser in self.browsers:
+            details = browser.path_details(dimension, path, hierarchy)
+            if details is not None:
+                return details
+        return None
+
+    def paths_details(self, dimension, paths, hierarchy=None):
+        """Returns details of `paths`. Paths not found in a shard are
+        looked up in the next one."""
+
+        details = [None] * len(paths)
+        missing = range(len(paths))
+
+        for browser in self.browsers:
+            found = browser.paths_details(dimension,
+                                          [paths[i] for i in missing],
+                                          hierarchy)
+            for i, member in zip(missing, found):
+                details[i] = member
+            missing = [i for i in missing if details[i] is None]
+            if not missing:
+                break
+
+        return details
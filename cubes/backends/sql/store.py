@@ -1,15 +1,29 @@
 # -*- coding=utf -*-
 from .browser import SnowflakeBrowser
 from .mapper import SnowflakeMapper
+from .query import SnowflakeSchemaCache, StatementCache, MemberCache
+from .query import QueryBuilder
+from .navigator import AggregateRegistry, AggregateNavigator
+from .navigator import MaterializedCuboid
+from .navigator import cuboid_table_name, rollup_aggregates
+from .navigator import DEFAULT_AGGREGATES_REFRESH
+from .functions import rollup_function_name, register_sqlite_functions
+from .functions import merge_records
+from .planner import CuboidPlanner
+from .indexes import IndexAdvisor
+from .replicas import ReplicaSet, pool_statistics, DEFAULT_RETRY_INTERVAL
 from ...logging import get_logger
 from ...common import coalesce_options
 from ...stores import Store
+from ...statutils import DEFAULT_HLL_PRECISION
 from ...errors import *
 from ...browser import *
 from ...computation import *
 
 from .utils import CreateTableAsSelect, InsertIntoAsSelect
 
+from collections import OrderedDict
+
 try:
     import sqlalchemy
     import sqlalchemy.sql as sql
@@ -24,6 +38,14 @@ __all__ = [
 ]
 
 
+# Default number of cached compiled aggregation statements
+DEFAULT_STATEMENT_CACHE_SIZE = 100
+
+# Number of aggregated rows merged into a cuboid table by one delete and
+# insert
+CUBOID_MERGE_CHUNK_SIZE = 500
+
+
 # Data types of options passed to sqlalchemy.create_engine
 # This is used to coalesce configuration string values into appropriate types
 SQLALCHEMY_OPTION_TYPES = {
@@ -45,7 +67,17 @@ OPTION_TYPES = {
         "include_summary": "bool",
         "include_cell_count": "bool",
         "use_denormalization": "bool",
-        "safe_labels": "bool"
+        "safe_labels": "bool",
+        "single_pass_aggregation": "bool",
+        "use_aggregates": "bool",
+        "stream_results": "bool",
+        "fetch_size": "int",
+        "statement_cache_size": "int",
+        "hll_precision": "int",
+        "sample_confidence": "float",
+        "member_cache_ttl": "float",
+        "aggregates_refresh": "float",
+        "replica_retry_interval": "float"
 }
 
 ####
@@ -113,6 +145,19 @@ class SQLStore(Store):
           ``option1=value1[&option2=value2]...``
         * `engine` - SQLAlchemy engine - either this or URL should be provided
 
+        Connection pool of every engine is configured with the SQLAlchemy
+        options, such as ``sqlalchemy_pool_size``,
+        ``sqlalchemy_max_overflow`` and ``sqlalchemy_pool_recycle``.
+
+        Options for read replicas:
+
+        * `replicas` – list of URLs (or a string of whitespace separated
+          URLs) of read-only replicas of the database. Queries of browsers
+          are balanced across the replicas, everything else uses the primary
+          database (`url` or `engine`).
+        * `replica_retry_interval` – number of seconds a failed replica is
+          not used, default is 30
+
         Optional:
 
         * `schema` - default schema, where all tables are located (if not
@@ -137,6 +182,38 @@ class SQLStore(Store):
         * `denormalized_view_schema` - schema wehere denormalized views are
           located (use this if the views are in different schema than fact tables,
           otherwise default schema is going to be used)
+
+        Options for aggregate tables:
+
+        * `use_aggregates` – browser will answer aggregation queries from the
+          smallest materialized cuboid that contains required data
+        * `aggregates_prefix` – prefix of aggregate table names
+        * `aggregates_schema` – schema where aggregate tables are stored
+        * `aggregates_registry` – name of the table with list of materialized
+          cuboids, default is ``cubes_aggregates``
+        * `aggregates_refresh` – seconds after which the list of materialized
+          cuboids is read from the registry again, default is 60
+
+        Options for fetching facts:
+
+        * `stream_results` – facts are fetched through a server-side cursor
+          (if the database driver supports it, such as psycopg2) instead of
+          buffering whole result in the client
+        * `fetch_size` – number of rows fetched from the cursor at once,
+          default is 1000
+
+        Other options:
+
+        * `statement_cache_size` – number of compiled aggregation statements
+          kept for reuse by queries of the same shape, default is 100,
+          ``0`` disables the cache
+        * `hll_precision` – number of HyperLogLog registers (as a power of
+          two) of the ``approx_count_distinct`` aggregate function computed
+          in SQLite, default is 14 – relative error about 0.8%
+        * `member_cache_ttl` – dimension members are loaded from the
+          dimension tables and kept for this number of seconds to answer
+          `members()`, `path_details()` and `cell_details()` without
+          querying the fact table. Not set by default – no member cache.
         """
         if not engine and not url:
             raise ArgumentError("No URL or engine specified in options, "
@@ -147,6 +224,14 @@ class SQLStore(Store):
         # Create a copy of options, because we will be popping from it
         options = dict(options)
 
+        replica_urls = options.pop("replicas", None) or []
+        if isinstance(replica_urls, basestring):
+            replica_urls = replica_urls.split()
+
+        # Replicas are created with the same SQLAlchemy options
+        replicas = [create_sqlalchemy_engine(replica_url, dict(options))
+                    for replica_url in replica_urls]
+
         if not engine:
             # Process SQLAlchemy options
             engine = create_sqlalchemy_engine(url, options)
@@ -167,6 +252,89 @@ class SQLStore(Store):
 
         self.options = coalesce_options(options, OPTION_TYPES)
 
+        # Read queries of browsers are balanced across the replicas
+        retry_interval = self.options.get("replica_retry_interval")
+        if retry_interval is None:
+            retry_interval = DEFAULT_RETRY_INTERVAL
+        self.replicas = ReplicaSet(self.connectable, replicas,
+                                   retry_interval=retry_interval)
+
+        # Reflected and analysed cube schemas shared by the browsers
+        self.schema_cache = SnowflakeSchemaCache()
+
+        # Compiled aggregation statements by query shape
+        cache_size = self.options.get("statement_cache_size")
+        if cache_size is None:
+            cache_size = DEFAULT_STATEMENT_CACHE_SIZE
+        self.statement_cache = StatementCache(cache_size)
+
+        # Dimension members loaded from the dimension tables
+        member_ttl = self.options.get("member_cache_ttl")
+        if member_ttl:
+            self.member_cache = MemberCache(member_ttl)
+        else:
+            self.member_cache = None
+
+        # Materialized cuboids
+        registry = self.options.get("aggregates_registry") or "cubes_aggregates"
+        registry_schema = self.options.get("aggregates_schema") or self.schema
+        registry_refresh = self.options.get("aggregates_refresh",
+                                            DEFAULT_AGGREGATES_REFRESH)
+        self.aggregate_registry = AggregateRegistry(self.connectable,
+                                                    registry,
+                                                    schema=registry_schema,
+                                                    refresh=registry_refresh)
+
+        self.hll_precision = self.options.get("hll_precision") \
+                                or DEFAULT_HLL_PRECISION
+        if self.connectable.dialect.name == "sqlite":
+            self._register_sqlite_functions()
+
+    def _register_sqlite_functions(self):
+        """Registers functions implemented in Python into every SQLite
+        connection, including the already opened ones."""
+
+        precision = self.hll_precision
+
+        def register(dbapi_connection, connection_record):
+            register_sqlite_functions(dbapi_connection, precision)
+
+        sqlalchemy.event.listen(self.connectable, "connect", register)
+
+        connection = self.connectable.raw_connection()
+        try:
+            register_sqlite_functions(connection.connection, precision)
+        finally:
+            connection.close()
+
+    def flush_cache(self, cube=None):
+        """Flushes reflected cube schemas, cached statements, cached
+        dimension members and cached list of materialized cuboids. If `cube`
+        is specified, then only schemas, statements, members and cuboids of
+        that cube are removed. Should be called when the model or the
+        database schema changes."""
+        self.schema_cache.invalidate(cube)
+        self.statement_cache.invalidate(cube)
+        if self.member_cache is not None:
+            self.member_cache.invalidate(cube)
+        self.aggregate_registry.invalidate(cube)
+
+    def refresh_partitions(self, cube=None):
+        """Discovers fact partition tables of `cube` (or of all cubes) again.
+        Should be called after a partition table is created, otherwise the
+        new partition is found within the `partition_refresh` interval of
+        the cube."""
+        self.schema_cache.refresh_partitions(cube)
+
+    def statistics(self):
+        """Returns a dictionary with connection pool statistics of the
+        primary database (``primary``, see `pool_statistics()`) and of the
+        read replicas (``replicas``)."""
+        return {
+            "primary": pool_statistics(self.connectable),
+            "replicas": self.replicas.statistics()
+        }
+
     def browser(self, cube, locale=None):
         """Returns a browser for a `cube`."""
         model = self.localized_model(locale)
@@ -180,21 +348,22 @@ class SQLStore(Store):
         """Drops `table` in `schema`. If table exists, exception is raised
         unless `force` is ``True``"""
 
-        view_name = str(table)
-        preparer = self.engine.dialect.preparer(self.engine.dialect)
+        view_name = table.name
+        dialect = self.connectable.dialect
+        preparer = dialect.preparer(dialect)
         full_name = preparer.format_table(table)
 
         if table.exists() and not force:
             raise WorkspaceError("View or table %s (schema: %s) already exists." % \
                                (view_name, schema))
 
-        inspector = sqlalchemy.engine.reflection.Inspector.from_engine(self.engine)
+        inspector = sqlalchemy.engine.reflection.Inspector.from_engine(self.connectable)
         view_names = inspector.get_view_names(schema=schema)
 
         if view_name in view_names:
             # Table reflects a view
             drop_statement = "DROP VIEW %s" % full_name
-            self.engine.execute(drop_statement)
+            self.connectable.execute(drop_statement)
         else:
             # Table reflects a table
             table.drop(checkfirst=False)
@@ -457,93 +626,404 @@ class SQLStore(Store):
 
         return table
 
+    def plan_cube_aggregate(self, cube, budget=None, request_log=None,
+                            dimensions=None, linked_dimensions=None,
+                            max_cuboids=None, sample_size=10000,
+                            max_dimensions=3):
+        """Returns an `AggregationPlan` – cuboids of `cube` that are worth
+        materializing within `budget` (maximal number of aggregated rows).
+        Sizes of cuboids are estimated from a sample of `sample_size` facts,
+        queries are weighted by their frequency in `request_log` – a
+        `SQLRequestLogHandler` with dimensions table. See `CuboidPlanner` for
+        more information.
+
+        Pass the plan to `create_cube_aggregate()` to materialize it."""
+
+        planner = CuboidPlanner(self, cube,
+                                dimensions=dimensions,
+                                linked_dimensions=linked_dimensions,
+                                sample_size=sample_size,
+                                max_dimensions=max_dimensions)
+
+        return planner.plan(budget=budget,
+                            request_log=request_log,
+                            max_cuboids=max_cuboids)
+
+    def recommend_indexes(self, cube, request_log, limit=None,
+                          method="aggregate"):
+        """Returns a list of `RecommendedIndex` tuples – composite indexes of
+        fact and dimension tables of `cube` ranked by total elapsed time of
+        the `method` queries in `request_log` (a `SQLRequestLogHandler` with
+        dimensions table) that would use them. See `IndexAdvisor` for more
+        information, `IndexAdvisor.ddl()` returns the ``CREATE INDEX``
+        statement of a recommended index."""
+
+        cube = self.model.cube(cube) if isinstance(cube, basestring) else cube
+        advisor = IndexAdvisor(self, cube, method=method)
+        return advisor.recommend(request_log, limit=limit)
+
     def create_cube_aggregate(self, cube, table_name=None, dimensions=None,
                                 linked_dimensions=None, schema=None,
-                                replace=False):
-        """Creates an aggregate table. If dimensions is `None` then all cube's
-        dimensions are considered.
+                                replace=False, plan=None):
+        """Creates aggregate tables for all hierarchical cuboids of
+        `dimensions` (see `hierarchical_cuboids()`) or for cuboids of a
+        `plan` created by `plan_cube_aggregate()`. Every cuboid is stored in
+        a separate table and registered, so the browsers with
+        `use_aggregates` option can use it. Returns list of created
+        `MaterializedCuboid` objects.
 
         Arguments:
 
+        * `cube`: `Cube` object to be aggregated
+        * `table_name`: base name of the aggregate tables, cuboid levels are
+          appended to it. Default is `aggregates_prefix` option + cube name
         * `dimensions`: list of dimensions to use in the aggregated cuboid, if
           `None` then all cube dimensions are used
         * `linked_dimensions`: list of dimensions that are required for each
           aggregation (for example a date dimension in most of the cases). The
           list should be a subsed of `dimensions`.
-        * `aggregates_prefix`: aggregated table prefix
-        * `aggregates_schema`: schema where aggregates are stored
-
+        * `schema`: schema of the aggregate tables, default is
+          `aggregates_schema` option or the store's schema
+        * `replace`: if ``True`` then existing tables are replaced
+        * `plan`: `AggregationPlan` with cuboids to be created, `dimensions`
+          and `linked_dimensions` are ignored
         """
 
-        schema = schema or self.options.get("aggregates_schema") or self.schema
-        prefix = self.options.get("aggregates_prefix","")
+        prefix = self.options.get("aggregates_prefix", "")
         table_name = table_name or prefix + cube.name
 
-        cube = self.model.cube(cube)
-        dimensions = dimensions or cube.dimensions
+        if plan is not None:
+            if plan.cube != cube.name:
+                raise ArgumentError("Aggregation plan is for cube '%s', not "
+                                    "'%s'" % (plan.cube, cube.name))
+            all_levels = plan.levels()
+        else:
+            if dimensions:
+                dimensions = [cube.dimension(dim) for dim in dimensions]
+            else:
+                dimensions = cube.dimensions
 
-        # Collect keys that are going to be used for aggregations
-        keys = []
-        for dimension in dimensions:
-            keys += [level.key for level in dimension.hierarchy().levels]
+            if linked_dimensions:
+                linked_dimensions = [cube.dimension(dim)
+                                        for dim in linked_dimensions]
 
-        mapper = SnowflakeMapper(cube, cube.mappings, schema=schema, **self.options)
-        context = QueryContext(cube, mapper, schema=schema, metadata=self.metadata)
+            all_levels = hierarchical_cuboids(dimensions,
+                                              required=linked_dimensions)
 
-        if mapper.fact_name == table_name and schema == mapper.schema:
-            raise WorkspaceError("target is the same as source fact table")
+        cuboids = []
+        for levels in all_levels:
+
+            # 'levels' is described as a list of ('dimension', 'level') tuples
+            # where 'level' is deepest level to be considered
 
-        drilldown = {}
+            self.logger.info("aggregating cuboid %s" % (levels, ) )
+            cuboid = self.create_cuboid(cube, levels,
+                                table_name=cuboid_table_name(table_name, levels),
+                                schema=schema,
+                                replace=replace)
+            cuboids.append(cuboid)
 
-        for dim in dimensions:
-            level = dim.hierarchy().levels[-1]
-            drilldown[str(dim)] = level
+        return cuboids
+
+    def create_cuboid(self, cube, levels, table_name=None, schema=None,
+                      aggregates=None, replace=False):
+        """Materializes a cuboid of `cube` into an aggregate table and
+        registers it. Returns a `MaterializedCuboid`.
+
+        Arguments:
+
+        * `levels`: list of (`dimension`, `level`) tuples – deepest levels of
+          the cuboid dimensions in their default hierarchies. Empty list
+          creates an apex cuboid with just totals.
+        * `table_name`: name of the aggregate table, default is composed of
+          `aggregates_prefix` option, cube name and the levels
+        * `schema`: schema of the aggregate table
+        * `aggregates`: list of aggregate names to be materialized. Default
+          are all aggregates that can be rolled up (see `rollup_aggregates()`)
+        * `replace`: if ``True`` then existing table is replaced, otherwise
+          an exception is raised
+        """
+
+        schema = schema or self.options.get("aggregates_schema") or self.schema
+        levels = [(str(dim), str(level)) for dim, level in levels]
+
+        if not table_name:
+            prefix = self.options.get("aggregates_prefix", "")
+            table_name = cuboid_table_name(prefix + cube.name, levels)
+
+        aggregates = rollup_aggregates(cube, aggregates)
+        if not aggregates:
+            raise ArgumentError("Cube '%s' has no aggregates that can be "
+                                "materialized" % cube.name)
+
+        browser = SnowflakeBrowser(cube, self, use_aggregates=False)
+
+        if browser.mapper.fact_name == table_name \
+                and browser.mapper.schema == schema:
+            raise WorkspaceError("target is the same as source fact table")
 
         cell = Cell(cube)
-        drilldown = coalesce_drilldown(cell, drilldown)
+        drilldown = Drilldown([(dim, None, level) for dim, level in levels],
+                              cell)
+
+        builder = QueryBuilder(browser)
+        builder.aggregation_statement(cell,
+                                      drilldown=drilldown,
+                                      aggregates=aggregates)
 
-        # Create dummy statement of all dimension level keys for
-        # getting structure for table creation
-        statement = context.aggregation_statement(cell,
-                                                  attributes=keys,
-                                                  drilldown=drilldown)
+        # Facts loaded after this point are merged by the next refresh
+        watermark_column = self._watermark_column(builder)
+        watermark = self._current_watermark(watermark_column)
+        if watermark is not None:
+            builder.append_condition(watermark_column <= watermark)
 
+        statement = builder.route_partitions()
 
         #
         # Create table
         #
-        table = self._create_table_from_statement(table_name, statement,
-                                schema=schema, replace=replace, insert=False)
+        metadata = sqlalchemy.MetaData(bind=self.connectable)
+        table = sqlalchemy.Table(table_name, metadata, schema=schema)
 
-        connection = self.engine.connect()
+        if table.exists():
+            self._drop_table(table, schema, force=replace)
 
-        cuboids = hierarchical_cuboids(dimensions,
-                                        required=linked_dimensions)
+        for label, column in zip(builder.labels, statement.columns):
+            type_ = column.type
+            if isinstance(type_, sqlalchemy.types.NullType):
+                type_ = sqlalchemy.types.Numeric()
+            table.append_column(sqlalchemy.Column(label, type_))
 
-        for cuboid in cuboids:
+        self.logger.info("creating aggregate table '%s'" % table_name)
+        table.create()
 
-            # 'cuboid' is described as a list of ('dimension', 'level') tuples
-            # where 'level' is deepest level to be considered
+        # Forget previously reflected table structure
+        for existing in self.metadata.sorted_tables:
+            if existing.name == table_name and existing.schema == schema:
+                self.metadata.remove(existing)
+        self.schema_cache.invalidate(cube)
+        self.statement_cache.invalidate(cube)
+
+        insert = table.insert().from_select(builder.labels, statement)
+        self.connectable.execute(insert)
+
+        count = sql.expression.select([sql.functions.count()],
+                                      from_obj=table)
+        row_count = self.connectable.execute(count).scalar()
+
+        agg_names = [agg.name for agg in aggregates]
+        attributes = [label for label in builder.labels
+                            if label not in agg_names]
+
+        cuboid = MaterializedCuboid(cube.name, table_name, levels,
+                                    attributes, agg_names,
+                                    schema=schema,
+                                    row_count=row_count)
+
+        self.aggregate_registry.register(cuboid)
+        self.aggregate_registry.set_watermark(cube, table_name, watermark)
+
+        return cuboid
+
+    def refresh_cube_aggregate(self, cube, cell=None, watermark=None):
+        """Incrementally refreshes all registered cuboids of `cube` (see
+        `refresh_cuboid()`). Returns list of refreshed cuboids."""
+
+        # Get the watermark once, so all cuboids are consistent
+        if cell is None and watermark is None:
+            browser = SnowflakeBrowser(cube, self, use_aggregates=False)
+            column = self._watermark_column(QueryBuilder(browser))
+            watermark = self._current_watermark(column)
+
+        cuboids = []
+        for cuboid in list(self.aggregate_registry.cuboids(cube)):
+            self.logger.info("refreshing cuboid %s" % (cuboid.levels, ))
+            cuboid = self.refresh_cuboid(cube, cuboid, cell=cell,
+                                         watermark=watermark)
+            cuboids.append(cuboid)
+
+        return cuboids
+
+    def refresh_cuboid(self, cube, cuboid, cell=None, watermark=None):
+        """Incrementally refreshes the aggregate table of a materialized
+        `cuboid` of `cube`. Returns refreshed `MaterializedCuboid`.
+
+        There are two kinds of refresh:
+
+        * facts were appended – facts with watermark column value greater
+          facts with watermark column value greater
+          than the last processed watermark of the cuboid and less than or
+          equal to `watermark` are aggregated and merged into existing cuboid
+          rows: ``sum`` and ``count`` are added, ``min`` and ``max`` are
+          compared. Affected rows are replaced by the merged rows, new rows
+          are inserted. Default `watermark` is the
+          current maximum. The watermark column is the fact key or a fact
+          table column specified in the cube's `browser_options` as
+          ``aggregates_watermark`` (for example a load date).
+        * facts in a `cell` were changed (for example a date range was
+          reloaded) – rows of the cell are deleted and re-aggregated from the
+          facts. If the cuboid does not contain all attributes of the cell
+          cuts, the whole table is rebuilt.
+
+        The processed watermark is stored in the registry state table in the
+        same transaction as the cuboid rows.
+        """
+
+        registry = self.aggregate_registry
+        last = registry.watermark(cube, cuboid.table)
+
+        browser = SnowflakeBrowser(cube, self, use_aggregates=False)
+        builder = QueryBuilder(browser)
+        aggregates = cube.get_aggregates(cuboid.aggregates)
+        column = self._watermark_column(builder)
+
+        metadata = sqlalchemy.MetaData(bind=self.connectable)
+        table = sqlalchemy.Table(cuboid.table, metadata,
+                                 autoload=True,
+                                 schema=cuboid.schema)
+
+        if cell is not None or last is None:
+            # Delete-insert: re-aggregate already processed facts in the cell
+            if last is None:
+                if watermark is None:
+                    watermark = self._current_watermark(column)
+                last = watermark
+
+            cell = cell or Cell(cube)
+            condition = self._cuboid_cell_condition(browser, cuboid, cell)
+
+            if condition is None:
+                cell = Cell(cube)
+                delete = table.delete()
+            else:
+                delete = table.delete(condition)
+
+            drilldown = Drilldown([(dim, None, level)
+                                   for dim, level in cuboid.levels], cell)
+            builder.aggregation_statement(cell,
+                                          drilldown=drilldown,
+                                          aggregates=aggregates)
+            if last is not None:
+                builder.append_condition(column <= last)
+            insert = table.insert().from_select(builder.labels,
+                                                builder.route_partitions())
+
+            with self.connectable.begin() as connection:
+                connection.execute(delete)
+                connection.execute(insert)
+                registry.set_watermark(cube, cuboid.table, last,
+                                       connection=connection)
+        else:
+            # Upsert: merge aggregated new facts
+            if watermark is None:
+                watermark = self._current_watermark(column)
+
+            if watermark is None or watermark <= last:
+                return cuboid
+
+            cell = Cell(cube)
+            drilldown = Drilldown([(dim, None, level)
+                                   for dim, level in cuboid.levels], cell)
+            builder.aggregation_statement(cell,
+                                          drilldown=drilldown,
+                                          aggregates=aggregates)
+            builder.append_condition(sql.expression.and_(column > last,
+                                                         column <= watermark))
+
+            with self.connectable.begin() as connection:
+                rows = connection.execute(builder.route_partitions()).fetchall()
+                records = [dict(zip(builder.labels, row)) for row in rows]
+                self._merge_cuboid_rows(connection, table, cuboid,
+                                        aggregates, records)
+                registry.set_watermark(cube, cuboid.table, watermark,
+                                       connection=connection)
+
+        count = sql.expression.select([sql.functions.count()],
+                                      from_obj=table)
+        cuboid.row_count = self.connectable.execute(count).scalar()
+        registry.register(cuboid)
+
+        return cuboid
+
+    def _watermark_column(self, builder):
+        """Returns the fact table column used as the aggregates watermark."""
+
+        cube = builder.cube
+        name = cube.browser_options.get("aggregates_watermark") \
+                    or builder.snowflake.fact_key
+
+        try:
+            return builder.snowflake.fact_table.c[name]
+        except KeyError:
+            raise ModelError("Fact table of cube '%s' has no watermark "
+                             "column '%s'" % (cube.name, name))
+
+    def _current_watermark(self, column):
+        """Returns the maximal value of the watermark `column`."""
+        statement = sql.expression.select([sql.functions.max(column)])
+        return self.connectable.execute(statement).scalar()
+
+    def _cuboid_cell_condition(self, browser, cuboid, cell):
+        """Returns condition of `cell` on the aggregate table of `cuboid` or
+        ``None`` if the cuboid does not contain all attributes of the cell
+        cuts."""
+
+        navigator = AggregateNavigator(browser, self.aggregate_registry)
+        required = navigator.required_attributes(cell, Drilldown([], cell), [])
+
+        if required is None or not cuboid.covers(required[0], []):
+            return None
+
+        cuboid_browser = navigator.cuboid_browser(cuboid)
+        cuboid_cell = Cell(cuboid_browser.cube, cell.cuts)
+
+        return QueryBuilder(cuboid_browser).condition_for_cell(cuboid_cell)
+
+    def _merge_cuboid_rows(self, connection, table, cuboid, aggregates,
+                           records):
+        """Merges aggregated `records` into cuboid rows with the same
+        attribute values. Existing rows of the records are selected, merged
+        with the records and replaced by the merged rows with one delete and
+        one insert for every `CUBOID_MERGE_CHUNK_SIZE` records."""
+
+        functions = {}
+        for agg in aggregates:
+            function = rollup_function_name(agg.function)
+            if function not in ("sum", "min", "max"):
+                raise ArgumentError("Unable to merge aggregate '%s' with "
+                                    "roll-up function '%s'"
+                                    % (agg.name, function))
+            functions[agg.name] = function
+
+        attributes = cuboid.attributes
+
+        for start in range(0, len(records), CUBOID_MERGE_CHUNK_SIZE):
+            chunk = records[start:start + CUBOID_MERGE_CHUNK_SIZE]
+
+            merged = OrderedDict()
+            for record in chunk:
+                key = tuple(record[attr] for attr in attributes)
+                merged[key] = record
+
+            if attributes:
+                # Comparison with None is IS NULL
+                conditions = []
+                for key in merged.keys():
+                    keys = [table.c[attr] == value
+                            for attr, value in zip(attributes, key)]
+                    conditions.append(sql.expression.and_(*keys))
+                condition = sql.expression.or_(*conditions)
+            else:
+                condition = None
+
+            for row in connection.execute(table.select(condition)):
+                key = tuple(row[attr] for attr in attributes)
+                record = merged.get(key)
+                if record is not None:
+                    merged[key] = merge_records([dict(row), record],
+                                                functions)
 
-            self.logger.info("aggregating cuboid %s" % (cuboid, ) )
-
-            dd = {}
-            keys = None
-            for dim, level in cuboid:
-                dd[str(dim)] = level
-                dim = cube.dimension(dim)
-                hier = dim.hierarchy()
-                levels = hier.levels_for_depth(hier.level_index(level)+1)
-                keys = [l.key for l in levels]
-
-            dd = coalesce_drilldown(cell, dd)
-
-            statement = context.aggregation_statement(cell,
-                                                      attributes=keys,
-                                                      drilldown=drilldown)
-            self.logger.info("inserting")
-            insert = InsertIntoAsSelect(table, statement,
-                                  columns=statement.columns)
-            connection.execute(str(insert))
+            connection.execute(table.delete(condition))
+            connection.execute(table.insert(), merged.values())
 
 
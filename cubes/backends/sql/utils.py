@@ -1,16 +1,39 @@
 """Cubes SQL backend utilities, mostly to be used by the slicer command."""
 
-from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.sql.expression import Executable, ClauseElement, Alias
 from sqlalchemy.ext.compiler import compiles
+import sqlalchemy
 import sqlalchemy.sql as sql
+import threading
 
 __all__ = [
     "CreateTableAsSelect",
     "InsertIntoAsSelect",
     "condition_conjunction",
-    "order_column"
+    "order_column",
+    "supports_window_functions",
+    "supports_grouping_sets",
+    "GroupingSets",
+    "SampledTable",
+    "tablesample_clause",
+    "column_python_types",
+    "statement_canceller",
+    "supports_statement_timeout",
+    "limit_session_timeout",
+    "is_session_timeout_error"
 ]
 
+
+# MySQL and MariaDB error codes of statements interrupted by the session
+# execution time limit
+SESSION_TIMEOUT_ERRORS = (3024, 1969)
+
+# Key of the connection info with the statement that removes the session
+# time limit
+SESSION_TIMEOUT_RESET = "cubes_session_timeout_reset"
+
+_session_timeout_lock = threading.Lock()
+
 class CreateTableAsSelect(Executable, ClauseElement):
     def __init__(self, table, select):
         self.table = table
@@ -51,6 +74,40 @@ def visit_insert_into_as_select(element, compiler, **kw):
 
     return stmt
 
+class GroupingSets(ClauseElement):
+    def __init__(self, sets):
+        """``GROUPING SETS`` clause of ``GROUP BY``. `sets` is a list of
+        lists of grouped columns, an empty list is the grand total."""
+        self.sets = sets
+
+@compiles(GroupingSets)
+def visit_grouping_sets(element, compiler, **kw):
+    sets = []
+    for columns in element.sets:
+        columns = [compiler.process(c) for c in columns]
+        sets.append("(%s)" % ", ".join(columns))
+
+    return "GROUPING SETS (%s)" % ", ".join(sets)
+
+class SampledTable(Alias):
+    __visit_name__ = "sampled_table"
+
+    def __init__(self, table, clause, name=None):
+        """Aliased `table` followed by a sampling `clause`, such as
+        ``TABLESAMPLE BERNOULLI (1)``. The alias has the table's name by
+        default, therefore it can replace the table in a statement with
+        `Select.replace_selectable()`."""
+        super(SampledTable, self).__init__(table, name or table.name)
+        self.clause = clause
+
+@compiles(SampledTable)
+def visit_sampled_table(element, compiler, **kw):
+    alias = compiler.visit_alias(element, **kw)
+    if kw.get("asfrom"):
+        return "%s %s" % (alias, element.clause)
+    else:
+        return alias
+
 def condition_conjunction(conditions):
     """Do conjuction of conditions if there are more than one, otherwise just
     return the single condition."""
@@ -74,3 +131,207 @@ def order_column(column, order):
     else:
         raise ArgumentError("Unknown order %s for column %s") % (order, column)
 
+
+def supports_window_functions(dialect):
+    """Returns `True` if the SQL `dialect` (of an engine) is known to support
+    window functions, such as ``COUNT(*) OVER ()``."""
+
+    if dialect.name in ("postgresql", "oracle", "mssql"):
+        return True
+    elif dialect.name == "sqlite":
+        dbapi = dialect.dbapi
+        return dbapi is not None and dbapi.sqlite_version_info >= (3, 25)
+    elif dialect.name == "mysql":
+        version = getattr(dialect, "server_version_info", None)
+        return bool(version) and version >= (8, 0)
+    else:
+        return False
+
+
+def supports_grouping_sets(dialect):
+    """Returns `True` if the SQL `dialect` (of an engine) is known to support
+    ``GROUP BY GROUPING SETS`` and the ``GROUPING()`` function."""
+
+    if dialect.name in ("oracle", "mssql", "ibm_db_sa"):
+        return True
+    elif dialect.name == "postgresql":
+        version = getattr(dialect, "server_version_info", None)
+        return bool(version) and version >= (9, 5)
+    else:
+        return False
+
+
+def supports_row_value_in(dialect):
+    """Returns `True` if the SQL `dialect` (of an engine) is known to support
+    comparison of row values with ``IN``, such as ``(a, b) IN ((1, 2), (3,
+    4))``."""
+
+    if dialect.name in ("postgresql", "mysql", "oracle", "ibm_db_sa"):
+        return True
+    elif dialect.name == "sqlite":
+        version = getattr(dialect, "dbapi", None)
+        version = getattr(version, "sqlite_version_info", None)
+        return bool(version) and version >= (3, 15, 0)
+    else:
+        return False
+
+
+def nulls_sort_first(dialect):
+    """Returns `True` if the SQL `dialect` sorts ``NULL`` values before all
+    other values in ascending order (as the smallest values), `False` if it
+    sorts them after all other values. PostgreSQL, Oracle and their
+    derivatives treat ``NULL`` as the largest value."""
+
+    return dialect.name not in ("postgresql", "oracle", "firebird",
+                                "redshift", "vertica", "exasol")
+
+
+def tablesample_clause(dialect, fraction):
+    """Returns a ``TABLESAMPLE`` clause that samples about `fraction` of
+    table rows in SQL `dialect` or ``None`` if the dialect is not known to
+    support row sampling.
+
+    SQL Server's ``TABLESAMPLE`` samples whole table pages, therefore the
+    rows are not sampled independently and it is not used."""
+
+    percent = "%.6g" % (fraction * 100)
+
+    if dialect.name == "postgresql":
+        version = getattr(dialect, "server_version_info", None)
+        if version and version >= (9, 5):
+            return "TABLESAMPLE BERNOULLI (%s)" % percent
+
+    return None
+
+
+def statement_canceller(dialect, dbapi_connection):
+    """Returns a function that cancels a statement being executed on DB-API
+    connection `dbapi_connection` of SQL `dialect`. The function is meant to
+    be called from another thread. Returns ``None`` if the driver can not
+    cancel statements.
+
+    SQLite statements are interrupted, PostgreSQL (psycopg2) statements are
+    cancelled by the server the same way as by ``statement_timeout``."""
+
+    if dialect.name == "sqlite":
+        return getattr(dbapi_connection, "interrupt", None)
+    elif dialect.name == "postgresql":
+        return getattr(dbapi_connection, "cancel", None)
+    else:
+        return None
+
+
+def supports_statement_timeout(dialect):
+    """Returns `True` if execution time of statements of SQL `dialect` can be
+    limited: statements are cancelled (see `statement_canceller()`) or
+    limited by a session setting (see `limit_session_timeout()`)."""
+
+    if dialect.name == "postgresql":
+        return dialect.driver == "psycopg2"
+    else:
+        return dialect.name in ("sqlite", "mysql")
+
+
+def session_timeout_statements(dialect, timeout):
+    """Returns a tuple of SQL statements (`limit`, `reset`) that limit
+    execution time of the following statements of a session to `timeout`
+    seconds and remove the limit. Returns ``None`` if the `dialect` has no
+    such setting. MySQL 5.7.8 and newer limits ``SELECT`` statements with
+    ``max_execution_time``, MariaDB 10.1 and newer with
+    ``max_statement_time``."""
+
+    if dialect.name != "mysql":
+        return None
+
+    version = getattr(dialect, "server_version_info", None) or ()
+    numbers = tuple(part for part in version if isinstance(part, int))
+
+    if any("mariadb" in str(part).lower() for part in version):
+        # MariaDB might report itself as 5.5.5-10.x
+        if numbers[0:3] == (5, 5, 5) and len(numbers) > 3:
+            numbers = numbers[3:]
+        if numbers >= (10, 1):
+            return ("SET SESSION max_statement_time = %.3f" % timeout,
+                    "SET SESSION max_statement_time = 0")
+    elif numbers >= (5, 7, 8):
+        milliseconds = max(int(timeout * 1000), 1)
+        return ("SET SESSION max_execution_time = %d" % milliseconds,
+                "SET SESSION max_execution_time = 0")
+
+    return None
+
+
+def limit_session_timeout(connection, timeout):
+    """Limits execution time of statements executed on SQLAlchemy
+    `connection` to `timeout` seconds with a session setting (see
+    `session_timeout_statements()`). The limit is removed when the
+    connection is returned to the pool. Returns `False` if the dialect has
+    no such setting."""
+
+    statements = session_timeout_statements(connection.dialect, timeout)
+    if not statements:
+        return False
+
+    (limit, reset) = statements
+
+    pool = connection.engine.pool
+    with _session_timeout_lock:
+        if not sqlalchemy.event.contains(pool, "checkin",
+                                         _reset_session_timeout):
+            sqlalchemy.event.listen(pool, "checkin", _reset_session_timeout)
+
+    # Use DB-API cursor: the SQLAlchemy connection might be closed with the
+    # first result
+    fairy = connection.connection
+    cursor = fairy.cursor()
+    try:
+        cursor.execute(limit)
+    finally:
+        cursor.close()
+
+    fairy.info[SESSION_TIMEOUT_RESET] = reset
+    return True
+
+
+def _reset_session_timeout(dbapi_connection, connection_record):
+    if connection_record is None:
+        return
+
+    reset = connection_record.info.pop(SESSION_TIMEOUT_RESET, None)
+    if not reset or dbapi_connection is None:
+        return
+
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(reset)
+        finally:
+            cursor.close()
+    except Exception as e:
+        # The connection should not be used with the limit
+        connection_record.invalidate(e)
+
+
+def is_session_timeout_error(error):
+    """Returns `True` if SQLAlchemy DB-API `error` was raised because
+    a statement exceeded the session time limit set by
+    `limit_session_timeout()`."""
+
+    orig = getattr(error, "orig", None)
+    args = getattr(orig, "args", None)
+    return bool(args) and args[0] in SESSION_TIMEOUT_ERRORS
+
+
+def column_python_types(columns):
+    """Returns list of Python types of values of SQL expressions `columns`.
+    The type is ``None`` if it is not known, for example for results of
+    untyped functions."""
+
+    types = []
+    for column in columns:
+        try:
+            types.append(column.type.python_type)
+        except (NotImplementedError, AttributeError):
+            types.append(None)
+
+    return types
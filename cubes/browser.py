@@ -1,7 +1,15 @@
 # -*- coding=utf -*-
 
+import itertools
+import threading
+import Queue
+import time
 import copy
 import re
+import json
+import base64
+import datetime
+import decimal
 from collections import namedtuple
 
 try:
@@ -42,6 +50,10 @@ __all__ = [
     "TableRow",
     "CrossTable",
     "cross_table",
+    "column_batches",
+    "page_token",
+    "page_token_values",
+    "run_report_queries",
     "SPLIT_DIMENSION_NAME",
 ]
 
@@ -61,6 +73,16 @@ class AggregationBrowser(object):
 
     builtin_functions = []
 
+    """Number of report queries executed concurrently and the report
+    deadline in seconds (see `report()`). Browsers set them from options
+    ``report_workers`` and ``report_timeout``."""
+    report_workers = 1
+    report_timeout = None
+
+    """Time limit of a single query in seconds (see `query_timeout()`).
+    Browsers set it from option ``timeout``."""
+    timeout = None
+
     def __init__(self, cube, store=None, locale=None, metadata=None, **options):
         """Creates and initializes the aggregation browser. Subclasses should
         override this method. """
@@ -72,6 +94,19 @@ class AggregationBrowser(object):
         self.cube = cube
         self.calendar = None
 
+    def query_timeout(self, timeout=None):
+        """Returns time limit of a query in seconds: `timeout` requested for
+        the query, but at most the browser's `timeout`. Returns ``None`` if
+        there is no limit. Backends that support the limit cancel the query
+        when it is reached and raise `QueryTimeoutError`."""
+
+        if timeout and self.timeout:
+            return min(float(timeout), self.timeout)
+        elif timeout:
+            return float(timeout)
+        else:
+            return self.timeout
+
     def features(self):
         """Returns a dictionary of available features for the browsed cube.
         Default implementation returns an empty dictionary.
@@ -82,6 +117,8 @@ class AggregationBrowser(object):
           ``facts``, ``aggregate``, ``members``, ...
         * `post_processed_aggregates` – list of aggregates that are computed
           after the result is fetched from the source (not natively).
+        * `query_options` – list of supported query options of `aggregate()`,
+          `facts()` and `members()`, such as ``timeout`` or ``after``.
 
         Subclasses are advised to override this method.
         """
@@ -278,7 +315,7 @@ class AggregationBrowser(object):
         self.logger.warn("values() is depreciated, use members()")
         return self.members(*args, **kwargs)
 
-    def report(self, cell, queries):
+    def report(self, cell, queries, workers=None, timeout=None):
         """Bundle multiple requests from `queries` into a single one.
 
         Keys of `queries` are custom names of queries which caller can later
@@ -342,12 +379,22 @@ class AggregationBrowser(object):
             * a dictionary where keys are dimension names and values are
               levels to be rolled up-to
 
-        *Future*
-
-        In the future there might be optimisations added to this method,
-        therefore it will become faster than subsequent separate requests.
-        Also when used with Slicer OLAP service server number of HTTP call
-        overhead is reduced.
+        *Concurrency*
+
+        If `workers` (default is browser's `report_workers`) is more than
+        one, then the queries are executed concurrently by at most `workers`
+        threads, each query using its own connection. Results are fetched
+        completely within the threads. Failure of one query does not fail
+        the whole report: result of the failed query is a dictionary with
+        keys ``error`` (error type) and ``message``. The report waits at most
+        `timeout` seconds (default is browser's `report_timeout`), queries
+        that did not finish in time have error type ``timeout``. Time left
+        until the deadline is the query ``timeout`` option, if the browser
+        supports it, so the backend cancels the queries that did not finish.
+
+        Queries are executed one after another if `workers` is one, with the
+        same error handling and deadline. Also when used with Slicer OLAP
+        service server number of HTTP call overhead is reduced.
         """
 
         # TODO: add this: cell_details=True, cell_details_key="_details"
@@ -357,72 +404,141 @@ class AggregationBrowser(object):
         # `AggregationBrowser.cell_details() for more information). Default key
         # name is ``_cell``.
 
+        jobs = self.report_jobs(cell, queries)
+
+        if workers is None:
+            workers = self.report_workers
+        if timeout is None:
+            timeout = self.report_timeout
+
+        if len(jobs) == 1:
+            workers = 1
+        results = run_report_queries(jobs, workers, timeout)
+
+        # Unpack results of bundled queries
         report_result = {}
+        for name, result in results.items():
+            if not isinstance(name, tuple):
+                report_result[name] = result
+            elif isinstance(result, dict) and "error" in result:
+                for result_name in name:
+                    report_result[result_name] = result
+            else:
+                report_result.update(result)
 
-        for result_name, query in queries.items():
-            query_type = query.get("query")
-            if not query_type:
-                raise ArgumentError("No report query for '%s'" % result_name)
+        return report_result
 
-            # FIXME: add: cell = query.get("cell")
+    def report_jobs(self, cell, queries):
+        """Returns list of (`name`, `function`) tuples of report `queries`,
+        where `function` performs the query. The function has one optional
+        argument `timeout` – seconds left until the report deadline, see
+        `report_query_timeout()`. Raises `ArgumentError` if a query is not
+        valid.
 
-            args = dict(query)
-            del args["query"]
+        Backends might bundle several queries into one job: the `name` is
+        then a tuple of query names and the function returns a dictionary of
+        results by query name."""
 
-            # Note: we do not just convert name into function from symbol for possible future
-            # more fine-tuning of queries as strings
+        jobs = []
+        for result_name, query in queries.items():
+            function = self._report_query(cell, result_name, query)
+            jobs.append((result_name, function))
 
-            # Handle rollup
-            rollup = query.get("rollup")
-            if rollup:
-                query_cell = cell.rollup(rollup)
-            else:
-                query_cell = cell
+        return jobs
+
+    def report_query_timeout(self, timeout, requested=None):
+        """Returns the ``timeout`` query option of a report query with
+        `timeout` seconds left until the report deadline and `requested`
+        time limit of the query itself. Returns ``None`` if there is no limit
+        or if the browser does not support the option."""
 
-            if query_type == "aggregate":
-                result = self.aggregate(query_cell, **args)
+        options = self.features().get("query_options", [])
+        if "timeout" not in options:
+            return None
+        elif timeout is not None and requested:
+            return min(float(requested), timeout)
+        elif timeout is not None:
+            return timeout
+        else:
+            return requested
 
-            elif query_type == "facts":
-                result = self.facts(query_cell, **args)
+    def _report_query(self, cell, result_name, query):
+        """Returns a function that performs the report `query`, see
+        `report_jobs()`. Raises `ArgumentError` if the query is not
+        valid."""
 
-            elif query_type == "fact":
-                # Be more tolerant: by default we want "key", but "id" might be common
-                key = args.get("key")
-                if not key:
-                    key = args.get("id")
-                result = self.fact(key)
+        query_type = query.get("query")
+        if not query_type:
+            raise ArgumentError("No report query for '%s'" % result_name)
 
-            elif query_type == "values":
-                result = self.values(query_cell, **args)
+        # FIXME: add: cell = query.get("cell")
 
-            elif query_type == "details":
-                # FIXME: depreciate this raw form
-                result = self.cell_details(query_cell, **args)
+        args = dict(query)
+        del args["query"]
 
-            elif query_type == "cell":
+        # Note: we do not just convert name into function from symbol for possible future
+        # more fine-tuning of queries as strings
+
+        # Handle rollup
+        rollup = query.get("rollup")
+        if rollup:
+            query_cell = cell.rollup(rollup)
+        else:
+            query_cell = cell
+
+        def timed_args(timeout):
+            limit = self.report_query_timeout(timeout, args.get("timeout"))
+            if limit is None:
+                return args
+            return dict(args, timeout=limit)
+
+        if query_type == "aggregate":
+            function = lambda timeout=None: \
+                self.aggregate(query_cell, **timed_args(timeout))
+
+        elif query_type == "facts":
+            function = lambda timeout=None: \
+                self.facts(query_cell, **timed_args(timeout))
+
+        elif query_type == "fact":
+            # Be more tolerant: by default we want "key", but "id" might be common
+            key = args.get("key")
+            if not key:
+                key = args.get("id")
+            function = lambda timeout=None: self.fact(key)
+
+        elif query_type == "values":
+            function = lambda timeout=None: \
+                self.values(query_cell, **timed_args(timeout))
+
+        elif query_type == "details":
+            # FIXME: depreciate this raw form
+            function = lambda timeout=None: \
+                self.cell_details(query_cell, **args)
+
+        elif query_type == "cell":
+            def function(timeout=None):
                 details = self.cell_details(query_cell, **args)
                 cell_dict = query_cell.to_dict()
 
                 for cut, detail in zip(cell_dict["cuts"], details):
                     cut["details"] = detail
 
-                result = cell_dict
-            else:
-                raise ArgumentError("Unknown report query '%s' for '%s'" %
-                                    (query_type, result_name))
-
-            report_result[result_name] = result
+                return cell_dict
+        else:
+            raise ArgumentError("Unknown report query '%s' for '%s'" %
+                                (query_type, result_name))
 
-        return report_result
+        return function
 
     def cell_details(self, cell=None, dimension=None):
         """Returns details for the `cell`. Returned object is a list with one
         element for each cell cut. If `dimension` is specified, then details
         only for cuts that use the dimension are returned.
 
-        Default implemenatation calls `AggregationBrowser.cut_details()` for
-        each cut. Backends might customize this method to make it more
-        efficient.
+        Details of all paths of one dimension hierarchy are fetched by one
+        `AggregationBrowser.paths_details()` call, see `cut_details()` for
+        the structure of the details of each cut.
 
         .. warning:
 
@@ -443,7 +559,8 @@ class AggregationBrowser(object):
         else:
             cuts = cell.cuts
 
-        details = [self.cut_details(cut) for cut in cuts]
+        paths = self._cuts_path_details(cuts)
+        details = [self._cut_details(cut, paths) for cut in cuts]
 
         return details
 
@@ -457,26 +574,93 @@ class AggregationBrowser(object):
 
         """
 
-        dimension = self.cube.dimension(cut.dimension)
+        paths = self._cuts_path_details([cut])
+        return self._cut_details(cut, paths)
 
-        if isinstance(cut, PointCut):
-            details = self._path_details(dimension, cut.path, cut.hierarchy)
+    def path_details(self, dimension, path, hierarchy=None):
+        """Returns details for `path` in `dimension` as a dictionary with
+        attributes of the path levels, or ``None`` if there is no such
+        path."""
+        raise NotImplementedError
 
-        elif isinstance(cut, SetCut):
-            details = [self._path_details(dimension, path, cut.hierarchy) for path in cut.paths]
+    def paths_details(self, dimension, paths, hierarchy=None):
+        """Returns a list of details of `paths` of one `dimension`
+        `hierarchy`, one item for each path in the same order – a dictionary
+        as returned by `path_details()` or ``None``.
 
-        elif isinstance(cut, RangeCut):
-            details = {
-                "from": self._path_details(dimension, cut.from_path,
-                                           cut.hierarchy),
-                "to": self._path_details(dimension, cut.to_path, cut.hierarchy)
-            }
+        Default implementation calls `path_details()` for each path.
+        Backends should fetch details of all the paths at once.
+        """
+        return [self.path_details(dimension, path, hierarchy)
+                for path in paths]
 
+    def _cut_paths(self, cut):
+        """Returns list of paths of `cut`."""
+        if isinstance(cut, PointCut):
+            return [cut.path]
+        elif isinstance(cut, SetCut):
+            return cut.paths
+        elif isinstance(cut, RangeCut):
+            return [cut.from_path, cut.to_path]
         else:
             raise Exception("Unknown cut type %s" % cut)
 
+    def _cuts_path_details(self, cuts):
+        """Returns a dictionary of details of all paths of `cuts`. Keys are
+        tuples (`dimension name`, `hierarchy name`, `path`). Details of
+        paths of one dimension hierarchy are fetched with one
+        `paths_details()` call."""
+
+        groups = OrderedDict()
+
+        for cut in cuts:
+            dimension = self.cube.dimension(cut.dimension)
+            hierarchy = dimension.hierarchy(cut.hierarchy)
+
+            key = (dimension.name, hierarchy.name)
+            if key not in groups:
+                groups[key] = (dimension, hierarchy, [])
+            paths = groups[key][2]
+
+            for path in self._cut_paths(cut):
+                # Path of an open range is not specified
+                if path is not None and path not in paths:
+                    paths.append(path)
+
+        details = {}
+        for key, (dimension, hierarchy, paths) in groups.items():
+            result = self.paths_details(dimension, paths, hierarchy)
+            for path, path_details in zip(paths, result):
+                details[key + (tuple(path), )] = path_details
+
         return details
 
+    def _cut_details(self, cut, paths):
+        """Returns details of `cut` as described in `cut_details()`. `paths`
+        is a dictionary of path details from `_cuts_path_details()`."""
+
+        dimension = self.cube.dimension(cut.dimension)
+        hierarchy = dimension.hierarchy(cut.hierarchy)
+
+        def details(path):
+            if path is None:
+                return None
+            key = (dimension.name, hierarchy.name, tuple(path))
+            return self._levels_details(dimension, hierarchy, path,
+                                        paths.get(key))
+
+        if isinstance(cut, PointCut):
+            return details(cut.path)
+        elif isinstance(cut, SetCut):
+            return [details(path) for path in cut.paths]
+        elif isinstance(cut, RangeCut):
+            return {
+                "from": details(cut.from_path),
+                "to": details(cut.to_path)
+            }
+        else:
+            raise Exception("Unknown cut type %s" % cut)
+
     def _path_details(self, dimension, path, hierarchy=None):
         """Returns a list of details for a path. Each element of the list
         corresponds to one level of the path and is represented by a
@@ -495,6 +679,12 @@ class AggregationBrowser(object):
         hierarchy = dimension.hierarchy(hierarchy)
         details = self.path_details(dimension, path, hierarchy)
 
+        return self._levels_details(dimension, hierarchy, path, details)
+
+    def _levels_details(self, dimension, hierarchy, path, details):
+        """Splits path `details` returned by `path_details()` into a list of
+        level details as described in `_path_details()`."""
+
         if not details:
             return None
 
@@ -1418,6 +1608,211 @@ class CalculatedResultIterator(object):
         return item
 
 
+def column_batches(records, labels, size=1000):
+    """Yields `records` in batches of at most `size` records. Every batch
+    is an ordered dictionary where keys are `labels` and values are lists of
+    record values. If `records` provide a `column_batches()` method, such as
+    the SQL result iterator, it is used instead."""
+
+    if hasattr(records, "column_batches"):
+        for batch in records.column_batches(size):
+            yield batch
+        return
+
+    iterator = iter(records)
+    while True:
+        columns = OrderedDict((label, []) for label in labels)
+        count = 0
+        for record in itertools.islice(iterator, size):
+            for label, column in columns.items():
+                column.append(record.get(label))
+            count += 1
+
+        if not count:
+            break
+
+        yield columns
+
+        if count < size:
+            break
+
+
+def _encode_token_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    else:
+        raise TypeError("Value %r can not be in a page token" % (value, ))
+
+
+def _decode_token_value(obj):
+    if "datetime" in obj:
+        value = obj["datetime"]
+        format_ = "%Y-%m-%dT%H:%M:%S.%f" if "." in value \
+                        else "%Y-%m-%dT%H:%M:%S"
+        return datetime.datetime.strptime(value, format_)
+    elif "date" in obj:
+        return datetime.datetime.strptime(obj["date"], "%Y-%m-%d").date()
+    elif "decimal" in obj:
+        return decimal.Decimal(obj["decimal"])
+    else:
+        return obj
+
+
+def page_token(keys, values):
+    """Returns an opaque continuation token of keyset pagination: the order
+    `keys` (names) and their `values` in the last row of a page. The next
+    page starts after the row, see `page_token_values()`."""
+
+    data = json.dumps([list(keys), list(values)], default=_encode_token_value,
+                      separators=(",", ":"))
+    return base64.urlsafe_b64encode(data)
+
+
+def page_token_values(token, keys):
+    """Returns list of values of order `keys` from a page `token` created by
+    `page_token()`. Raises `ArgumentError` if the token is not valid or if
+    it was created for a query with different order keys."""
+
+    try:
+        data = base64.urlsafe_b64decode(str(token))
+        (token_keys, values) = json.loads(data,
+                                          object_hook=_decode_token_value)
+    except (TypeError, ValueError):
+        raise ArgumentError("Invalid page token")
+
+    if list(token_keys) != list(keys):
+        raise ArgumentError("Page token does not match order of the query")
+
+    return values
+
+
+def run_report_queries(jobs, workers, timeout=None):
+    """Executes report `jobs` – list of (`name`, `function`) tuples –
+    concurrently in at most `workers` threads, or one after another in the
+    calling thread if `workers` is one. Returns a dictionary of function
+    results by name. Results are fetched completely within the threads, so
+    lazy iterators do not hold a connection of a finished thread.
+
+    Exceptions raised by a function are not propagated, the result is
+    a dictionary with keys ``error`` and ``message`` instead. Internal errors
+    are logged and their messages are not included. If `timeout` is
+    specified, then jobs that did not finish within `timeout` seconds have
+    error ``timeout``; the jobs that did not start yet are cancelled. The
+    functions get the time left until the deadline as argument `timeout`
+    and are expected to cancel their queries when it runs out."""
+
+    if not jobs:
+        return {}
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+    else:
+        deadline = None
+
+    if workers <= 1:
+        return dict((name, _run_report_job(name, function, deadline))
+                    for name, function in jobs)
+
+    logger = get_logger()
+    results = {}
+    lock = threading.Lock()
+    finished = threading.Event()
+    queue = Queue.Queue()
+
+    for job in jobs:
+        queue.put(job)
+
+    def worker():
+        while not finished.is_set():
+            try:
+                name, function = queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            result = _run_report_job(name, function, deadline)
+
+            with lock:
+                results[name] = result
+                if len(results) == len(jobs):
+                    finished.set()
+
+    for i in range(min(workers, len(jobs))):
+        thread = threading.Thread(target=worker, name="report-%d" % i)
+        thread.daemon = True
+        thread.start()
+
+    if timeout is not None:
+        finished.wait(timeout)
+    else:
+        while not finished.is_set():
+            # Wait in intervals to remain responsive to interrupts
+            finished.wait(1)
+
+    with lock:
+        finished.set()
+        report_result = dict(results)
+
+    for name, function in jobs:
+        if name not in report_result:
+            logger.warn("report query '%s' did not finish in %s seconds"
+                        % (name, timeout))
+            report_result[name] = _report_timeout_result(name)
+
+    return report_result
+
+
+def _run_report_job(name, function, deadline=None):
+    """Calls report job `function` with the time left until `deadline`
+    (as returned by `time.time()`) and returns its fetched result or an
+    error dictionary, see `run_report_queries()`."""
+
+    if deadline is not None:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            return _report_timeout_result(name)
+    else:
+        timeout = None
+
+    try:
+        result = function(timeout=timeout)
+        if isinstance(name, tuple):
+            result = dict((key, _fetched_result(value))
+                          for key, value in result.items())
+        else:
+            result = _fetched_result(result)
+    except UserError as e:
+        result = {"error": e.error_type, "message": str(e)}
+    except Exception as e:
+        get_logger().exception("report query '%s' failed" % (name, ))
+        result = {"error": "internal_error",
+                  "message": "Report query '%s' failed" % (name, )}
+
+    return result
+
+
+def _report_timeout_result(name):
+    return {"error": "timeout",
+            "message": "Report query '%s' did not finish in time" % (name, )}
+
+
+def _fetched_result(result):
+    """Fetches all rows of lazy `result`."""
+
+    if isinstance(result, AggregationResult):
+        if result.cells is not None \
+                and not isinstance(result.cells, (list, tuple)):
+            # Bypass the setter, the calculators were already applied
+            result._cells = list(result.cells)
+    elif hasattr(result, "next") and hasattr(result, "__iter__"):
+        result = list(result)
+
+    return result
+
+
 class AggregationResult(object):
     """Result of aggregation or drill down.
 
@@ -1432,6 +1827,15 @@ class AggregationResult(object):
     * `remainder` - summary of remaining cells (not yet implemented)
     * `levels` – aggregation levels for dimensions that were used to drill-
       down
+    * `types` – dictionary of Python types of cell values by label, if known
+      by the backend
+    * `sample` – ``None`` if all the facts were aggregated, otherwise a
+      dictionary describing the sampling of an approximate aggregation with
+      keys ``method``, ``fraction`` and ``confidence`` (level of the
+      confidence intervals)
+    * `next_page` – token of the page following a paginated drill-down
+      (see `page_token()`), ``None`` if this is the last page or the
+      backend does not support keyset pagination
 
     .. note::
 
@@ -1446,10 +1850,13 @@ class AggregationResult(object):
         self.levels = None
 
         self.summary = {}
+        self.types = {}
         self._cells = []
         self.total_cell_count = None
         self.remainder = {}
         self.labels = []
+        self.sample = None
+        self.next_page = None
 
         self.calculators = []
 
@@ -1476,15 +1883,85 @@ class AggregationResult(object):
         return self.aggregates
         # decorate iterable with calcs if needed
 
-    def to_dict(self):
+    def columns(self, limit=None):
+        """Returns the cells in columnar form: an ordered dictionary where
+        keys are result labels (including post-aggregation calculations) and
+        values are lists of the cell values. At most `limit` cells are
+        returned, if specified.
+
+        If the cells are provided by an iterator that supports `columns()`
+        (such as the SQL result iterator), rows are transposed directly
+        without creating a dictionary for every cell. Calculators that
+        support `apply_columns()`, such as the moving window functions, are
+        applied to whole columns instead of to every cell. The cells are
+        consumed – the cells iterator can not be used after this call."""
+
+        cells = self.cells
+        if not self.calculators and hasattr(cells, "columns"):
+            return cells.columns(limit)
+
+        batch = isinstance(cells, CalculatedResultIterator) \
+                    and all(hasattr(calc, "apply_columns")
+                            for calc in self.calculators)
+        if batch:
+            cells = cells.iterator
+
+        labels = self.column_labels()
+
+        if batch and hasattr(cells, "columns"):
+            columns = cells.columns(limit)
+        else:
+            columns = OrderedDict((name, []) for name in labels)
+
+            if limit:
+                cells = itertools.islice(cells, limit)
+
+            for cell in cells:
+                for name, column in columns.items():
+                    column.append(cell.get(name))
+
+        if batch:
+            for calc in self.calculators:
+                calc.apply_columns(columns)
+
+            count = len(columns.values()[0]) if columns else 0
+            columns = OrderedDict((name, columns.get(name) or [None] * count)
+                                  for name in labels)
+
+        return columns
+
+    def column_labels(self):
+        """Returns list of labels of cell values: result labels and names of
+        post-aggregation calculations."""
+
+        names = list(self.labels)
+        for agg in self.aggregates or []:
+            if str(agg) not in names:
+                names.append(str(agg))
+
+        return names
+
+    def column_batches(self, size=1000):
+        """Yields the cells in batches of at most `size` cells in columnar
+        form, see `column_batches()`. The cells are consumed."""
+
+        return column_batches(self.cells, self.column_labels(), size)
+
+    def to_dict(self, columnar=False, limit=None):
         """Return dictionary representation of the aggregation result. Can be
-        used for JSON serialisation."""
+        used for JSON serialisation. If `columnar` is ``True`` then the cells
+        are stored as `columns` (see `columns()`) with at most `limit`
+        values instead of `cells`."""
 
         d = IgnoringDictionary()
 
         d["summary"] = self.summary
         d["remainder"] = self.remainder
-        d["cells"] = self.cells
+        if columnar:
+            d["labels"] = self.column_labels()
+            d["columns"] = self.columns(limit)
+        else:
+            d["cells"] = self.cells
         d["total_cell_count"] = self.total_cell_count
 
         d["aggregates"] = [str(m) for m in self.aggregates]
@@ -1493,6 +1970,8 @@ class AggregationResult(object):
         d.set("cell", [cut.to_dict() for cut in self.cell.cuts])
 
         d["levels"] = self.levels
+        d["sample"] = self.sample
+        d["next_page"] = self.next_page
 
         return d
 
@@ -1582,6 +2061,8 @@ class AggregationResult(object):
         result.summary = self.summary
         result.total_cell_count = self.total_cell_count
         result.remainder = self.remainder
+        result.sample = self.sample
+        result.next_page = self.next_page
 
         # Cache cells from an iterator
         result.cells = list(self.cells)
@@ -4,14 +4,19 @@ import itertools
 __all__ = [
         "combined_cuboids",
         "combined_levels",
-        "hierarchical_cuboids"
+        "hierarchical_cuboids",
+        "cuboid_covers",
+        "greedy_cuboid_selection"
         ]
 
-def combined_cuboids(dimensions, required=None):
+def combined_cuboids(dimensions, required=None, max_dimensions=None):
     """Returns a list of all combinations of `dimensions` as tuples. For
     example, if `dimensions` is: ``['date', 'product']`` then it returs::
 
         ``[['date', 'cpv'], ['date'], ['cpv']]``
+
+    If `max_dimensions` is specified, then only combinations of at most that
+    number of dimensions (including the required ones) are returned.
     """
 
     required = tuple(required) if required else ()
@@ -24,7 +29,11 @@ def combined_cuboids(dimensions, required=None):
     cuboids = []
     to_combine = [dim for dim in dimensions if not dim in required]
 
-    for i in range(len(to_combine), 0, -1):
+    largest = len(to_combine)
+    if max_dimensions is not None:
+        largest = min(largest, max_dimensions - len(required))
+
+    for i in range(largest, 0, -1):
         combos = itertools.combinations(to_combine, i)
         combos = [required+combo for combo in combos]
 
@@ -48,9 +57,10 @@ def combined_levels(dimensions):
     return tuple(itertools.product(*groups))
 
 
-def hierarchical_cuboids(dimensions, required=None):
-    """Returns a list of cuboids with all hierarchical level combinations."""
-    cuboids = combined_cuboids(dimensions, required)
+def hierarchical_cuboids(dimensions, required=None, max_dimensions=None):
+    """Returns a list of cuboids with all hierarchical level combinations.
+    See `combined_cuboids()` for `max_dimensions`."""
+    cuboids = combined_cuboids(dimensions, required, max_dimensions)
 
     result = []
     for cuboid in cuboids:
@@ -58,3 +68,75 @@ def hierarchical_cuboids(dimensions, required=None):
 
     return result
 
+
+
+def cuboid_covers(cuboid, query):
+    """Returns ``True`` if `cuboid` can answer `query`. Both are dictionaries
+    where keys are dimension names and values are level depths."""
+    return all(cuboid.get(dim, 0) >= depth for dim, depth in query.items())
+
+
+def greedy_cuboid_selection(candidates, base_size, queries=None, budget=None,
+                            max_cuboids=None):
+    """Selects cuboids to be materialized using the greedy algorithm by
+    Harinarayan, Rajaraman and Ullman. A query is assumed to cost as many
+    rows as the smallest selected cuboid that covers it, or `base_size` (the
+    number of facts) if there is no such cuboid. In each step the cuboid with
+    the largest benefit - reduction of the cost of all queries weighted by
+    their frequency - per row is selected.
+
+    * `candidates` - list of tuples (`key`, `depths`, `size`) where `depths`
+      is a dictionary of dimension level depths and `size` is estimated
+      number of rows of the cuboid
+    * `queries` - list of tuples (`depths`, `frequency`), default is every
+      candidate queried once
+    * `budget` - maximal number of rows of all selected cuboids
+    * `max_cuboids` - maximal number of selected cuboids
+
+    Returns a list of tuples (`key`, `size`, `benefit`) in the order of
+    selection.
+    """
+
+    if queries is None:
+        queries = [(depths, 1) for key, depths, size in candidates]
+
+    costs = [base_size] * len(queries)
+    remaining = list(candidates)
+    selected = []
+    used = 0
+
+    while remaining:
+        if max_cuboids is not None and len(selected) >= max_cuboids:
+            break
+
+        best = None
+        best_ratio = 0
+
+        for candidate in remaining:
+            (key, depths, size) = candidate
+            if budget is not None and used + size > budget:
+                continue
+
+            benefit = 0
+            for i, (query, frequency) in enumerate(queries):
+                if costs[i] > size and cuboid_covers(depths, query):
+                    benefit += frequency * (costs[i] - size)
+
+            ratio = float(benefit) / max(size, 1)
+            if ratio > best_ratio:
+                best = (candidate, benefit)
+                best_ratio = ratio
+
+        if best is None:
+            break
+
+        ((key, depths, size), benefit) = best
+        for i, (query, frequency) in enumerate(queries):
+            if costs[i] > size and cuboid_covers(depths, query):
+                costs[i] = size
+
+        remaining.remove(best[0])
+        selected.append((key, size, benefit))
+        used += size
+
+    return selected
@@ -82,3 +82,7 @@ class HierarchyError(UserError):
     hierarchy"""
     error_type = "hierarchy"
 
+class QueryTimeoutError(UserError):
+    """Raised when a query did not finish within the time limit and was
+    cancelled."""
+    error_type = "timeout"
@@ -5,6 +5,7 @@ from collections import defaultdict
 _default_modules = {
     "stores": {
         "sql":"cubes.backends.sql.store",
+        "sharded_sql":"cubes.backends.sql.shards",
         "mongo":"cubes.backends.mongo",
         "mongo2":"cubes.backends.mongo2",
         "mixpanel":"cubes.backends.mixpanel.store",
@@ -14,6 +15,7 @@ _default_modules = {
     "browsers": {
         "snowflake":"cubes.backends.sql.browser",
         "snapshot": "cubes.backends.sql.browser",
+        "sharded": "cubes.backends.sql.shards",
         "mixpanel":"cubes.backends.mixpanel.browser",
         "slicer":"cubes.backends.slicer.browser",
         "ga":"cubes.backends.ga.browser",
@@ -46,6 +46,8 @@ class Mapper(object):
         # TODO: merge with mappings received as arguments
         self.mappings = self.cube.mappings
         self.locale = locale
+        self.schema = schema
+        self.fact_name = fact_name
 
         # TODO: remove this (should be in SQL only)
 
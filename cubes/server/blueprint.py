@@ -4,7 +4,7 @@ from flask import render_template
 from functools import wraps
 
 from ..workspace import Workspace, SLICER_INFO_KEYS
-from ..browser import Cell, SPLIT_DIMENSION_NAME
+from ..browser import Cell, cut_from_dict, SPLIT_DIMENSION_NAME
 from ..errors import *
 from .logging import configured_request_log_handlers, RequestLogger
 from .utils import *
@@ -12,6 +12,7 @@ from .errors import *
 from .decorators import *
 from .local import *
 from .auth import create_authenticator, NotAuthenticated
+from .caching import configured_cache
 
 from collections import OrderedDict
 
@@ -20,7 +21,6 @@ from cubes import __version__
 # TODO: missing features from the original Werkzeug Slicer:
 # * /locales and localization
 # * default cube: /aggregate
-# * caching
 # * root / index
 # * response.headers.add("Access-Control-Allow-Origin", "*")
 
@@ -40,6 +40,9 @@ __all__ = (
 
 API_VERSION = 2
 
+# Response header with the token of the next page of paginated facts
+NEXT_PAGE_HEADER = "X-Cubes-Next-Page"
+
 
 slicer = Blueprint("slicer", __name__, template_folder="templates")
 
@@ -115,6 +118,9 @@ def initialize_slicer(state):
         handlers = configured_request_log_handlers(config)
         current_app.slicer.request_logger = RequestLogger(handlers)
 
+        # Response cache
+        current_app.slicer.cache = configured_cache(config)
+
 # Before and After
 # ================
 
@@ -145,6 +151,14 @@ def prepare_authorization():
     # -------------
     g.auth_identity = identity
 
+    # Results without the record limit are allowed only to authorized
+    # identities
+    if str_to_bool(request.args.get("unlimited")):
+        authorizer = workspace.authorizer
+        if not authorizer or not authorizer.unlimited_export(identity):
+            raise NotAuthorizedError("Unlimited export is not allowed")
+        g.json_record_limit = None
+
 
 # Error Handler
 # =============
@@ -211,6 +225,17 @@ def get_info():
     info["first_weekday"] = workspace.calendar.first_weekday
     info["api_version"] = API_VERSION
 
+    if current_app.slicer.cache is not None:
+        info["cache"] = current_app.slicer.cache.statistics()
+
+    stores = {}
+    for name, store in workspace.stores.items():
+        statistics = store.statistics()
+        if statistics is not None:
+            stores[name] = statistics
+    if stores:
+        info["stores"] = stores
+
     return info
 
 @slicer.route("/info")
@@ -247,11 +272,13 @@ def cube_model(cube_name):
 @slicer.route("/cube/<cube_name>/aggregate")
 @requires_browser
 @log_request("aggregate", "aggregates")
+@cached_response("aggregate")
 def aggregate(cube_name):
     cube = g.cube
 
     output_format = validated_parameter(request.args, "format",
-                                        values=["json", "csv"],
+                                        values=["json", "json_columns", "csv",
+                                                "arrow", "parquet"],
                                         default="json")
 
     header_type = validated_parameter(request.args, "header",
@@ -280,13 +307,28 @@ def aggregate(cube_name):
 
     prepare_cell("split", "split")
 
+    options = dict(g.query_options)
+    if "sample" in request.args:
+        try:
+            sample = float(request.args.get("sample"))
+        except ValueError:
+            raise RequestError("'sample' should be a number")
+        if not 0 < sample <= 1:
+            raise RequestError("'sample' should be greater than 0 and at "
+                               "most 1")
+        if "sampling" not in g.browser.features():
+            raise RequestError("'sample' is not supported by the backend of "
+                               "cube '%s'" % (g.cube, ))
+        options["sample"] = sample
+
     result = g.browser.aggregate(g.cell,
                                  aggregates=aggregates,
                                  drilldown=drilldown,
                                  split=g.split,
                                  page=g.page,
                                  page_size=g.page_size,
-                                 order=g.order)
+                                 order=g.order,
+                                 **options)
 
     # Hide cuts that were generated internally (default: don't)
     if current_app.slicer.hide_private_cuts:
@@ -294,6 +336,22 @@ def aggregate(cube_name):
 
     if output_format == "json":
         return jsonify(result)
+    elif output_format == "json_columns":
+        return jsonify(result.to_dict(columnar=True,
+                                      limit=g.json_record_limit))
+    elif output_format in ("arrow", "parquet"):
+        types = dict(result.types)
+        for agg in result.aggregates or []:
+            if types.get(str(agg)) is None:
+                if agg.function in ("count", "count_nonempty"):
+                    types[str(agg)] = int
+                else:
+                    types[str(agg)] = float
+        types[SPLIT_DIMENSION_NAME] = bool
+
+        generator = ArrowGenerator(result, result.column_labels(), types,
+                                   format=output_format)
+        return arrow_response(generator, output_format, "aggregate")
     elif output_format != "csv":
         raise RequestError("unknown response format '%s'" % output_format)
 
@@ -326,10 +384,12 @@ def aggregate(cube_name):
 @slicer.route("/cube/<cube_name>/facts")
 @requires_browser
 @log_request("facts", "fields")
+@cached_response("facts")
 def cube_facts(cube_name):
     # Request parameters
     output_format = validated_parameter(request.args, "format",
-                                        values=["json", "json_lines", "csv"],
+                                        values=["json", "json_lines", "csv",
+                                                "arrow", "parquet"],
                                         default="json")
 
     header_type = validated_parameter(request.args, "header",
@@ -356,7 +416,8 @@ def cube_facts(cube_name):
                              fields=fields,
                              order=g.order,
                              page=g.page,
-                             page_size=g.page_size)
+                             page_size=g.page_size,
+                             **g.query_options)
 
     # Add cube key to the fields (it is returned in the result)
     fields.insert(0, g.cube.key)
@@ -373,6 +434,17 @@ def cube_facts(cube_name):
     # Get the facts iterator. `result` is expected to be an iterable Facts
     # object
 
+    response = facts_response(facts, output_format, fields, header)
+
+    next_page = getattr(facts, "next_page", None)
+    if next_page:
+        response.headers[NEXT_PAGE_HEADER] = next_page
+
+    return response
+
+
+def facts_response(facts, output_format, fields, header):
+    """Returns a response with `facts` in `output_format`."""
     if output_format == "json":
         return jsonify(facts)
     elif output_format == "json_lines":
@@ -392,6 +464,26 @@ def cube_facts(cube_name):
         return Response(generator.csvrows(),
                         mimetype='text/csv',
                         headers=headers)
+    elif output_format in ("arrow", "parquet"):
+        labels = getattr(facts, "labels", None) or fields
+        generator = ArrowGenerator(facts, labels,
+                                   getattr(facts, "types", None),
+                                   format=output_format)
+        return arrow_response(generator, output_format, "facts")
+
+
+def arrow_response(generator, output_format, name):
+    """Returns streamed response of Arrow or Parquet `generator` as an
+    attachment."""
+    if output_format == "arrow":
+        mimetype = "application/vnd.apache.arrow.stream"
+        filename = "%s.arrows" % name
+    else:
+        mimetype = "application/vnd.apache.parquet"
+        filename = "%s.parquet" % name
+
+    headers = {"Content-Disposition": 'attachment; filename="%s"' % filename}
+    return Response(generator, mimetype=mimetype, headers=headers)
 
 
 @slicer.route("/cube/<cube_name>/fact/<fact_id>")
@@ -409,6 +501,7 @@ def cube_fact(cube_name, fact_id):
 @slicer.route("/cube/<cube_name>/members/<dimension_name>")
 @requires_browser
 @log_request("members")
+@cached_response("members")
 def cube_members(cube_name, dimension_name):
     depth = request.args.get("depth")
 
@@ -432,7 +525,8 @@ def cube_members(cube_name, dimension_name):
                                depth=depth,
                                hierarchy=hierarchy,
                                page=g.page,
-                               page_size=g.page_size)
+                               page_size=g.page_size,
+                               **g.query_options)
 
     depth = depth or len(hierarchy)
 
@@ -443,11 +537,16 @@ def cube_members(cube_name, dimension_name):
         "data": values
     }
 
+    next_page = getattr(values, "next_page", None)
+    if next_page:
+        result["next_page"] = next_page
+
     return jsonify(result)
 
 
 @slicer.route("/cube/<cube_name>/cell")
 @requires_browser
+@cached_response("cell")
 def cube_cell(cube_name):
     details = g.browser.cell_details(g.cell)
     cell_dict = g.cell.to_dict()
@@ -458,10 +557,13 @@ def cube_cell(cube_name):
     return jsonify(cell_dict)
 
 
-@slicer.route("/cube/<cube>/report")
+@slicer.route("/cube/<cube_name>/report", methods=["GET", "POST"])
 @requires_browser
-def cube_report(cube):
-    report_request = self.json_request()
+@cached_response("report")
+def cube_report(cube_name):
+    report_request = request.get_json(force=True, silent=True)
+    if report_request is None:
+        raise RequestError("Report request should be a JSON object")
 
     try:
         queries = report_request["queries"]
@@ -472,10 +574,17 @@ def cube_report(cube):
 
     if cell_cuts:
         # Override URL cut with the one in report
-        cuts = [cut_from_dict(cut) for cut in cell_cuts]
+        cuts = [cut_from_dict(cut, g.cube) for cut in cell_cuts]
         cell = Cell(g.cube, cuts)
         logger.info("using cell from report specification (URL parameters "
                     "are ignored)")
+
+        # The URL cell was restricted by `requires_browser`, this one has to
+        # be restricted the same way
+        if workspace.authorizer:
+            cell = workspace.authorizer.restricted_cell(g.auth_identity,
+                                                        cube=g.cube,
+                                                        cell=cell)
     else:
         cell = g.cell
 
@@ -1,14 +1,43 @@
+# -*- coding=utf -*-
+from __future__ import absolute_import
 import json
 import logging
 from functools import update_wrapper, wraps
 from datetime import datetime, timedelta
 from exceptions import BaseException
+from collections import OrderedDict
 import cPickle as pickle
+import threading
+import sqlite3
+import time
 import types
 
 from werkzeug.routing import Rule
 from werkzeug.wrappers import Response
 
+from ..extensions import get_namespace, initialize_namespace
+from ..errors import *
+
+try:
+    import pymongo
+except ImportError:
+    from ..common import MissingPackage
+    pymongo = MissingPackage("pymongo", "Mongo server cache")
+
+__all__ = (
+    "create_cache",
+    "configured_cache",
+
+    "Cache",
+    "MemoryCache",
+    "FileCache",
+    "MongoCache",
+
+    "cacheable",
+    "response_dumps",
+    "response_loads"
+)
+
 
 def _make_key_str(name, *args, **kwargs):
     key_str = name
@@ -44,14 +73,19 @@ def _default_strategy(data):
 
 
 def response_dumps(response):
+    # Cubes headers, such as the next page token, are part of the response
+    headers = [(name, value) for name, value in response.headers
+               if name.lower().startswith("x-cubes-")]
     return {
         'data': response.data,
-        'mimetype': response.content_type
+        'mimetype': response.content_type,
+        'headers': headers
     }
 
 
 def response_loads(data):
-    return Response(data['data'], mimetype=data['mimetype'])
+    return Response(data['data'], mimetype=data['mimetype'],
+                    headers=data.get('headers'))
 
 
 
@@ -93,7 +127,63 @@ def cacheable(fn):
 
 
 
+def create_cache(type_, *args, **kwargs):
+    """Gets a new instance of a server cache of type `type_`: ``memory``,
+    ``file`` or ``mongo``."""
+
+    ns = get_namespace("caches")
+    if not ns:
+        ns = initialize_namespace("caches",
+                                  root_class=Cache,
+                                  suffix="_cache",
+                                  option_checking=True)
+    try:
+        factory = ns[type_]
+    except KeyError:
+        raise ConfigurationError("Unknown cache type '%s'" % type_)
+
+    return factory(*args, **kwargs)
+
+
+def configured_cache(config, section="cache"):
+    """Returns a cache configured in the `section` of the `config` or
+    ``None`` if there is no such section. Per-cube time to live in seconds can
+    be specified in the section ``[cache_ttl]`` where the option keys are
+    cube names, for example ``sales: 3600``."""
+
+    if not config.has_section(section):
+        return None
+
+    options = dict(config.items(section))
+    type_ = options.pop("type", "memory")
+
+    cache = create_cache(type_, **options)
+
+    ttl_section = "%s_ttl" % section
+    if config.has_section(ttl_section):
+        for cube, ttl in config.items(ttl_section):
+            cache.cube_ttl[cube] = int(ttl)
+
+    return cache
+
+
 class Cache(object):
+    """Base class for server caches. Subclasses should implement `get()`,
+    `set()`, `rem()` and `clear()` and count the lookups using `hit()` and
+    `miss()`.
+
+    Attributes:
+
+    * `ttl` – default time to live of cached values in seconds
+    * `cube_ttl` – dictionary of time to live per cube name
+    * `hits` – number of successful lookups
+    * `misses` – number of lookups of missing or expired keys
+    """
+
+    ttl = 60
+    hits = 0
+    misses = 0
+
     def __setitem__(self, key, value):
         return self.set(key, value)
 
@@ -103,6 +193,215 @@ class Cache(object):
     def __delitem__(self, key):
         return self.rem(key)
 
+    @property
+    def cube_ttl(self):
+        try:
+            return self._cube_ttl
+        except AttributeError:
+            self._cube_ttl = {}
+            return self._cube_ttl
+
+    def ttl_for_cube(self, cube):
+        """Returns time to live for values of `cube` (a name)."""
+        return self.cube_ttl.get(str(cube), self.ttl)
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+    def statistics(self):
+        """Returns a dictionary with cache lookup statistics: `hits`,
+        `misses` and `hit_ratio`."""
+        total = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / total if total else None
+        }
+
+    def clear(self):
+        """Removes all values from the cache."""
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    """In-process least-recently-used cache. Values are stored pickled, so
+    their size in bytes is known and the cache can be limited by `max_bytes`
+    in addition to `max_items`. Least recently used values are removed when
+    any of the limits is exceeded. Values larger than `max_bytes` are not
+    cached."""
+
+    __options__ = [
+        {
+            "name": "ttl",
+            "type": "int"
+        },
+        {
+            "name": "max_items",
+            "type": "int"
+        },
+        {
+            "name": "max_bytes",
+            "type": "int"
+        }
+    ]
+
+    def __init__(self, ttl=60, max_items=1000, max_bytes=64*1024*1024,
+                 **options):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                (expires, data) = self.items.pop(key)
+            except KeyError:
+                self.miss()
+                return None
+
+            if expires < time.time():
+                self.size -= len(data)
+                self.miss()
+                return None
+
+            # Move to the end as the most recently used
+            self.items[key] = (expires, data)
+            self.hit()
+
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes and len(data) > self.max_bytes:
+            return False
+
+        expires = time.time() + (ttl or self.ttl)
+
+        with self.lock:
+            self._remove(key)
+            self.items[key] = (expires, data)
+            self.size += len(data)
+
+            while self.items and \
+                    ((self.max_items and len(self.items) > self.max_items) \
+                        or (self.max_bytes and self.size > self.max_bytes)):
+                (_, (_, old)) = self.items.popitem(last=False)
+                self.size -= len(old)
+
+        return True
+
+    def rem(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        try:
+            (_, data) = self.items.pop(key)
+        except KeyError:
+            return False
+        self.size -= len(data)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+class FileCache(Cache):
+    """Cache stored in a local SQLite database file `path`. The file cache
+    survives server restarts and can be shared by server processes on the
+    same host."""
+
+    __options__ = [
+        {
+            "name": "path",
+            "type": "string"
+        },
+        {
+            "name": "ttl",
+            "type": "int"
+        },
+        {
+            "name": "table",
+            "type": "string"
+        }
+    ]
+
+    def __init__(self, path=None, ttl=60, table="cubes_cache", **options):
+        if not path:
+            raise ConfigurationError("File cache requires the 'path' option")
+
+        self.path = path
+        self.ttl = ttl
+        self.table = table
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS %s "
+                                    "(key TEXT PRIMARY KEY, expires REAL, "
+                                    "value BLOB)" % self.table)
+
+    def get(self, key):
+        with self.lock:
+            cursor = self.connection.execute("SELECT expires, value FROM %s "
+                                             "WHERE key = ?" % self.table,
+                                             (key, ))
+            row = cursor.fetchone()
+
+            if row is None:
+                self.miss()
+                return None
+
+            (expires, data) = row
+            if expires < time.time():
+                with self.connection:
+                    self.connection.execute("DELETE FROM %s WHERE key = ?"
+                                            % self.table, (key, ))
+                self.miss()
+                return None
+
+            self.hit()
+
+        return pickle.loads(str(data))
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = time.time() + (ttl or self.ttl)
+
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO %s "
+                                        "(key, expires, value) "
+                                        "VALUES (?, ?, ?)" % self.table,
+                                        (key, expires, sqlite3.Binary(data)))
+        return True
+
+    def rem(self, key):
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute("DELETE FROM %s WHERE key = ?"
+                                                 % self.table, (key, ))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM %s" % self.table)
+
 
 def trap(fn):
     def _trap(*args, **kwargs):
@@ -115,8 +414,33 @@ def trap(fn):
 
 
 class MongoCache(Cache):
+    """Cache stored in a MongoDB collection ``Caches.<name>`` of the database
+    `ds`. If no database is given, then it is connected using `url` and
+    `database` options."""
+
+    __options__ = [
+        {
+            "name": "name",
+            "type": "string"
+        },
+        {
+            "name": "url",
+            "type": "string"
+        },
+        {
+            "name": "database",
+            "type": "string"
+        },
+        {
+            "name": "ttl",
+            "type": "int"
+        }
+    ]
+
+    def __init__(self, name="cubes", ds=None, ttl=60, ttl_strategy=_default_strategy, dumps=_NOOP, loads=_NOOP, logger=logging.getLogger(), url=None, database="cubes", **kwargs):
+        if ds is None:
+            ds = pymongo.MongoClient(url)[database]
 
-    def __init__(self, name, ds, ttl=60, ttl_strategy=_default_strategy, dumps=_NOOP, loads=_NOOP, logger=logging.getLogger(), **kwargs):
         self.ttl = ttl
         self.store = ds.Caches[name]
         self.dumps = dumps
@@ -151,13 +475,16 @@ class MongoCache(Cache):
             exp = item['t']
             if exp >= n:
                 self.logger.debug('Hit: %s', key)
+                self.hit()
                 return item['d']
             else:
                 self.logger.debug('Stale: %s', key)
                 self.store.remove({'_id': key})
+                self.miss()
                 return None
         else:
             self.logger.debug('Miss: %s', key)
+            self.miss()
             return None
 
     def rem(self, key):
@@ -171,3 +498,6 @@ class MongoCache(Cache):
         else:
             self.logger.debug('Miss: %s', key)
             return False
+
+    def clear(self):
+        self.store.remove()
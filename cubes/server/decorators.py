@@ -10,9 +10,12 @@ from ..errors import *
 from .utils import *
 from .errors import *
 from .local import *
+from .caching import response_dumps, response_loads
 from ..calendar import CalendarMemberConverter
 
 from contextlib import contextmanager
+import hashlib
+import json
 
 # Utils
 # -----
@@ -61,7 +64,12 @@ def requires_cube(f):
 
 def requires_browser(f):
     """Prepares three global variables: `g.cube`, `g.browser` and `g.cell`.
-    Also athorizes the cube using `authorize()`."""
+    Also athorizes the cube using `authorize()`.
+
+    Other browser query arguments – the ``timeout`` in seconds and the
+    ``after`` page token – are in `g.query_options`, only if they were
+    requested. Options that the browser does not list in its
+    ``query_options`` feature are rejected."""
 
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -92,6 +100,29 @@ def requires_browser(f):
         else:
             g.page_size = None
 
+        g.query_options = {}
+        if "timeout" in request.args:
+            try:
+                timeout = float(request.args.get("timeout"))
+            except ValueError:
+                raise RequestError("'timeout' should be a number")
+            if timeout <= 0:
+                raise RequestError("'timeout' should be positive")
+            g.query_options["timeout"] = timeout
+
+        if "after" in request.args:
+            if not g.page_size:
+                raise RequestError("'after' requires 'pagesize'")
+            g.query_options["after"] = request.args.get("after")
+
+        if g.query_options:
+            supported = g.browser.features().get("query_options", [])
+            for option in g.query_options:
+                if option not in supported:
+                    raise RequestError("'%s' is not supported by the "
+                                       "backend of cube '%s'"
+                                       % (option, g.cube))
+
         # Collect orderings:
         # order is specified as order=<field>[:<direction>]
         #
@@ -161,3 +192,85 @@ def log_request(action, attrib_field="attributes"):
 
     return decorator
 
+
+# Response Caching
+# ================
+
+# Arguments that are already part of the normalized request in `g` or that
+# do not affect the response (timeout)
+_NORMALIZED_ARGS = ["cut", "page", "pagesize", "order", "timeout"]
+_LIST_ARGS = ["drilldown", "aggregates"]
+
+def request_cache_key(action):
+    """Returns a cache key for the current browser request. The key is
+    composed of the cube name, the cell, pagination and ordering as
+    normalized by `requires_browser` and the remaining request arguments
+    (drilldown, aggregates, format, ...). The cell is already restricted
+    by the authorizer, therefore identities with different restrictions get
+    different keys."""
+
+    args = {}
+    for name in request.args.keys():
+        if name in _NORMALIZED_ARGS:
+            continue
+        values = []
+        for value in request.args.getlist(name):
+            if name in _LIST_ARGS:
+                values += value.split("|")
+            else:
+                values.append(value)
+        args[name] = values
+
+    key = {
+        "view": request.view_args,
+        "cell": str(g.cell) if g.cell else None,
+        "page": g.page,
+        "page_size": g.page_size,
+        "order": g.order,
+        "args": args,
+        "data": request.data or None
+    }
+
+    digest = hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()
+
+    return "%s:%s:%s" % (action, g.cube.name, digest)
+
+
+def cached_response(action):
+    """Serves the response from the server cache, if configured. Only
+    successful JSON or non-streamed responses are stored, for the time to
+    live configured for the cube. Requests without the JSON record limit are
+    not cached."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache = current_app.slicer.cache
+
+            # Responses without record limit are streamed, never buffered
+            if cache is None or not g.json_record_limit:
+                return f(*args, **kwargs)
+
+            key = request_cache_key(action)
+            data = cache.get(key)
+
+            if data is not None:
+                return response_loads(data)
+
+            response = current_app.make_response(f(*args, **kwargs))
+
+            # JSON responses are generated by an iterative encoder and are
+            # limited by `json_record_limit`, therefore it is safe to buffer
+            # them. Other streams (CSV, JSON lines) are not cached.
+            if response.status_code == 200 \
+                    and (not response.is_streamed
+                         or response.mimetype == "application/json"):
+                response.get_data()
+                cache.set(key, response_dumps(response),
+                          ttl=cache.ttl_for_cube(g.cube.name))
+
+            return response
+
+        return wrapper
+
+    return decorator
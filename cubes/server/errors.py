@@ -4,7 +4,8 @@ import json
 
 server_error_codes = {
     "unknown": 400,
-    "missing_object": 404
+    "missing_object": 404,
+    "timeout": 503
 }
 
 try:
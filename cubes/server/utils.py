@@ -8,12 +8,22 @@ from datetime import datetime
 import ConfigParser
 import cStringIO
 import datetime
+import itertools
 import decimal
 import codecs
 import json
 import csv
 
 from .errors import *
+from ..browser import column_batches
+from ..errors import ArgumentError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    from ..common import MissingPackage
+    pyarrow = MissingPackage("pyarrow", "Arrow and Parquet export")
 
 tz_utc = pytz.timezone('UTC')
 default_tz = pytz.timezone(strftime("%Z", gmtime()))
@@ -73,14 +83,34 @@ class SlicerJSONEncoder(json.JSONEncoder):
         """Creates a JSON encoder that will convert some data values and also allows
         iterables to be used in the object graph.
 
+        `iterencode()` streams the output: iterables, such as result cursors,
+        are consumed lazily while the output is being written, therefore the
+        encoded objects are not held in memory. Only the containers of the
+        iterables are streamed, every row and every value without iterables
+        is encoded at once by the standard encoder.
+
         :Attributes:
         * `iterator_limit` - limits number of objects to be fetched from
-          iterator. Default: 1000.
+          iterator. ``None`` or ``0`` means no limit. Default: 1000.
+        * `chunk_size` - minimal size of strings yielded by `iterencode()`.
+          Default: 8192.
         """
 
         super(SlicerJSONEncoder, self).__init__(*args, **kwargs)
 
         self.iterator_limit = 1000
+        self.chunk_size = 8192
+
+        self._encoder = json.JSONEncoder(skipkeys=self.skipkeys,
+                                         ensure_ascii=self.ensure_ascii,
+                                         check_circular=self.check_circular,
+                                         allow_nan=self.allow_nan,
+                                         sort_keys=self.sort_keys,
+                                         indent=self.indent,
+                                         separators=(self.item_separator,
+                                                     self.key_separator),
+                                         encoding=self.encoding,
+                                         default=self.default)
 
     def default(self, o):
         if type(o) == decimal.Decimal:
@@ -93,13 +123,7 @@ class SlicerJSONEncoder(json.JSONEncoder):
             array = None
             try:
                 # If it is an iterator, then try to construct array and limit number of objects
-                iterator = iter(o)
-                count = self.iterator_limit
-                array = []
-                for i, obj in enumerate(iterator):
-                    array.append(obj)
-                    if i >= count:
-                        break
+                array = list(self._limited(iter(o)))
             except TypeError as e:
                 # not iterable
                 pass
@@ -109,6 +133,150 @@ class SlicerJSONEncoder(json.JSONEncoder):
             else:
                 return json.JSONEncoder.default(self, o)
 
+    def iterencode(self, o, _one_shot=False):
+        """Encodes `o` and yields the output in chunks of about `chunk_size`
+        characters."""
+
+        chunk = []
+        size = 0
+
+        for string in self._iterencode(o, 0):
+            chunk.append(string)
+            size += len(string)
+            if size >= self.chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            yield "".join(chunk)
+
+    def _limited(self, iterator):
+        """Yields at most `iterator_limit` objects from `iterator`."""
+        if self.iterator_limit:
+            return itertools.islice(iterator, self.iterator_limit)
+        else:
+            return iterator
+
+    def _iterencode(self, o, level):
+        if hasattr(o, "to_dict") and callable(getattr(o, "to_dict")):
+            for string in self._iterencode(o.to_dict(), level):
+                yield string
+
+        elif isinstance(o, dict) and self._streamed(o):
+            for string in self._iterencode_dict(o, level):
+                yield string
+
+        elif self._is_iterator(o):
+            for string in self._iterencode_items(self._limited(iter(o)),
+                                                 level):
+                yield string
+
+        else:
+            # Values without iterators are encoded at once
+            yield self._encode(o, level)
+
+    def _is_iterator(self, o):
+        """Returns `True` if `o` is a lazy iterable, such as a result
+        cursor, that is streamed."""
+        return hasattr(o, "__iter__") \
+                and not isinstance(o, (basestring, dict, list, tuple))
+
+    def _streamed(self, dct):
+        """Returns `True` if dictionary `dct` contains a value to be
+        streamed, directly or in a nested dictionary."""
+        for value in dct.itervalues():
+            if isinstance(value, dict):
+                if self._streamed(value):
+                    return True
+            elif self._is_iterator(value) or hasattr(value, "to_dict"):
+                return True
+        return False
+
+    def _encode(self, o, level):
+        """Encodes `o` by one call of the standard encoder – C-accelerated
+        if there is no indentation – indented to the nesting `level`."""
+        string = self._encoder.encode(o)
+        if self.indent is not None and level:
+            # Strings in JSON contain only escaped newlines
+            string = string.replace("\n", "\n" + " " * (self.indent * level))
+        return string
+
+    def _newline(self, level):
+        if self.indent is None:
+            return None
+        return "\n" + " " * (self.indent * level)
+
+    def _iterencode_items(self, iterator, level):
+        """Yields encoded items of `iterator` – rows, such as cells or facts
+        – each row encoded at once."""
+        newline = self._newline(level + 1)
+        if newline is None:
+            separator = self.item_separator
+        else:
+            separator = self.item_separator + newline
+
+        first = True
+        for item in iterator:
+            if first:
+                yield "[" if newline is None else "[" + newline
+                first = False
+            else:
+                yield separator
+
+            if hasattr(item, "to_dict") and callable(getattr(item, "to_dict")):
+                for string in self._iterencode(item, level + 1):
+                    yield string
+            else:
+                yield self._encode(item, level + 1)
+
+        if first:
+            yield "[]"
+        elif newline is None:
+            yield "]"
+        else:
+            yield self._newline(level) + "]"
+
+    def _iterencode_dict(self, dct, level):
+        newline = self._newline(level + 1)
+        if newline is None:
+            separator = self.item_separator
+        else:
+            separator = self.item_separator + newline
+
+        yield "{" if newline is None else "{" + newline
+
+        items = dct.items()
+        if self.sort_keys:
+            items = sorted(items, key=lambda item: item[0])
+
+        first = True
+        for key, value in items:
+            if isinstance(key, basestring):
+                pass
+            elif key is None or isinstance(key, (bool, int, long, float)):
+                # Keys are converted the same way as values
+                key = self._encoder.encode(key)
+            elif self.skipkeys:
+                continue
+            else:
+                raise TypeError("key %r is not a string" % (key, ))
+
+            if not first:
+                yield separator
+            first = False
+
+            yield self._encoder.encode(key)
+            yield self.key_separator
+
+            for string in self._iterencode(value, level + 1):
+                yield string
+
+        if newline is None:
+            yield "}"
+        else:
+            yield self._newline(level) + "}"
+
 
 class CSVGenerator(object):
     def __init__(self, records, fields, include_header=True,
@@ -168,6 +336,146 @@ class JSONLinesGenerator(object):
             string = self.encoder.encode(obj)
             yield "%s%s" % (string, self.separator)
 
+class _ChunkSink(object):
+    """File-like object collecting written data until it is taken."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ArrowGenerator(object):
+    def __init__(self, records, labels, types=None, format="arrow",
+                 batch_size=1000):
+        """Creates a generator of Arrow IPC stream (`format` ``arrow``) or
+        Parquet file (`format` ``parquet``) from `records` – a result
+        iterator or an iterable of dictionaries. Records are written in
+        batches of `batch_size` rows, one Parquet row group per batch, and
+        the output is yielded after every batch.
+
+        `types` is a dictionary of Python types of the values by label as
+        provided by the browser. Types of columns which are not known are
+        inferred from values of the first batch."""
+
+        if format not in ("arrow", "parquet"):
+            raise ArgumentError("Unknown Arrow export format '%s'" % format)
+
+        self.records = records
+        self.labels = list(labels)
+        self.types = types or {}
+        self.format = format
+        self.batch_size = batch_size
+
+    def arrow_type(self, label, values):
+        """Returns Arrow type of column `label` with `values` of the first
+        batch."""
+
+        pytype = self.types.get(label)
+        if pytype in (int, long):
+            return pyarrow.int64()
+        elif pytype in (float, decimal.Decimal):
+            return pyarrow.float64()
+        elif pytype is bool:
+            return pyarrow.bool_()
+        elif pytype is datetime.datetime:
+            return pyarrow.timestamp("us")
+        elif pytype is datetime.date:
+            return pyarrow.date32()
+        elif pytype in (str, unicode):
+            return pyarrow.string()
+
+        values = [_arrow_value(v) for v in values if v is not None]
+        if not values:
+            return pyarrow.string()
+
+        if all(isinstance(v, (int, long, float)) for v in values) \
+                and any(isinstance(v, float) for v in values):
+            return pyarrow.float64()
+
+        type_ = pyarrow.array(values).type
+        if pyarrow.types.is_null(type_):
+            return pyarrow.string()
+        return type_
+
+    def schema(self, batch):
+        fields = [pyarrow.field(label, self.arrow_type(label, batch[label]))
+                  for label in self.labels]
+        return pyarrow.schema(fields)
+
+    def record_batch(self, batch, schema):
+        arrays = []
+        for field in schema:
+            values = [_arrow_value(v) for v in batch[field.name]]
+            if pyarrow.types.is_floating(field.type):
+                values = [float(v) if v is not None else None
+                          for v in values]
+            elif pyarrow.types.is_string(field.type):
+                values = [v if v is None or isinstance(v, basestring)
+                          else unicode(v) for v in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+
+        return pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+
+    def __iter__(self):
+        sink = _ChunkSink()
+        writer = None
+        schema = None
+
+        batches = column_batches(self.records, self.labels, self.batch_size)
+        for batch in batches:
+            if writer is None:
+                schema = self.schema(batch)
+                writer = self._writer(sink, schema)
+
+            self._write(writer, self.record_batch(batch, schema))
+            yield sink.take()
+
+        if writer is None:
+            empty = dict((label, []) for label in self.labels)
+            schema = self.schema(empty)
+            writer = self._writer(sink, schema)
+
+        writer.close()
+        yield sink.take()
+
+    def _writer(self, sink, schema):
+        if self.format == "arrow":
+            return pyarrow.RecordBatchStreamWriter(sink, schema)
+        else:
+            return pyarrow.parquet.ParquetWriter(sink, schema)
+
+    def _write(self, writer, batch):
+        if self.format == "arrow":
+            writer.write_batch(batch)
+        else:
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+
+
+def _arrow_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
 class UnicodeCSVWriter:
     """
     A CSV writer which will write rows to CSV file "f",
@@ -1,13 +1,34 @@
-from collections import deque
+# -*- coding=utf -*-
+from collections import deque, OrderedDict
 from .errors import *
 from functools import partial
-from math import sqrt
+from math import sqrt, log, erf
+import hashlib
+import struct
+
+try:
+    import numpy
+except ImportError:
+    # Window functions are computed without the batch implementation
+    numpy = None
 
 __all__ = [
         "CALCULATED_AGGREGATIONS",
+        "WindowFunction",
+        "WindowAccumulator",
+        "MovingSum",
+        "MovingAverage",
+        "WeightedMovingAverage",
+        "MovingVariance",
         "calculators_for_aggregates",
         "available_calculators",
-        "aggregate_calculator_labels"
+        "aggregate_calculator_labels",
+        "HyperLogLog",
+        "hyperloglog_error",
+        "DEFAULT_HLL_PRECISION",
+        "normal_quantile",
+        "SampleEstimator",
+        "DEFAULT_CONFIDENCE"
 ]
 
 def calculators_for_aggregates(cube, aggregates, drilldown_levels=None,
@@ -52,50 +73,291 @@ def calculators_for_aggregates(cube, aggregates, drilldown_levels=None,
     return functions
 
 def weighted_moving_average(values):
-    n = len(values)
-    denom = n * (n + 1) / 2
-    total = 0.0
-    idx = 1
-    for val in values:
-        total += float(idx) * float(val)
-        idx += 1
-    return round(total / denom, 4)
+    return WeightedMovingAverage(values).result()
 
 
 def simple_moving_average(values):
     # use all the values
-    return round(reduce(lambda i, c: float(c) + i, values, 0.0) / len(values), 2)
+    return MovingAverage(values).result()
 
 def simple_moving_sum(values):
-    return reduce(lambda i, c: i + c, values, 0)
+    return sum(values)
 
 
 def _variance(values):
-    n, mean, std = len(values), 0, 0
-    for a in values:
-        mean = mean + a
-    mean = mean / float(n)
-    if n < 2:
-        return mean, 0
-    for a in values:
-        std = std + (a - mean)**2
-    return mean, (std / float(n-1))
+    variance = MovingVariance(values)
+    return variance.mean, variance.variance()
 
 def simple_relative_stdev(values):
-    mean, var = _variance(values)
-    return round(((sqrt(var)/mean) if mean > 0 else 0), 4)
+    return MovingVariance(values, "relative_stdev").result()
 
 def simple_variance(values):
-    mean, var = _variance(values)
-    return round(var, 2)
+    return MovingVariance(values, "variance").result()
 
 def simple_stdev(values):
-    mean, var = _variance(values)
-    return round(sqrt(var), 2)
+    return MovingVariance(values, "stdev").result()
+
+
+class WindowAccumulator(object):
+    def __init__(self, values=None):
+        """Aggregate of values in a sliding window updated in constant time
+        when a value enters (`add()`) or leaves (`remove()`) the window.
+        `result()` is the window function value. The window is initialized
+        with `values`, if specified."""
+        self.reset(values)
+
+    def reset(self, values=None):
+        """Recomputes the aggregate from the window `values`. Running sums
+        of floating point values are reset this way to not accumulate
+        rounding errors."""
+        self.count = 0
+        self.removed = 0
+        self.clear()
+        for value in values or []:
+            self.add(value)
+
+    def clear(self):
+        raise NotImplementedError
+
+    def add(self, value):
+        raise NotImplementedError
+
+    def remove(self, value):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def drifted(self):
+        """Returns ``True`` if the aggregate lost precision by removing
+        values and should be recomputed by `reset()`."""
+        return False
+
+    def batch(self, values, window_size):
+        """Returns list of results of the windows of size `window_size`
+        ending at every value of `values` – a list of integers or floats.
+        Uses NumPy, subclasses return ``None`` if there is no batch
+        implementation."""
+        return None
+
+
+def _windows(values, window_size, dtype=None):
+    """Returns a tuple (`windows`, `counts`): 2-D NumPy array with rows of
+    windows of size `window_size` ending at every one of `values` and array
+    of numbers of values in the windows. Windows at the beginning are
+    padded with zeros at the front. Values of a window are summed
+    separately, not as differences of cumulative sums, which would lose
+    precision on long series of large values."""
+
+    dtype = dtype or numpy.float64
+    array = numpy.array(values, dtype=dtype)
+    padded = numpy.concatenate((numpy.zeros(window_size - 1, dtype=dtype),
+                                array))
+    stride = padded.strides[0]
+    windows = numpy.lib.stride_tricks.as_strided(padded,
+                                                 shape=(len(array),
+                                                        window_size),
+                                                 strides=(stride, stride))
+    counts = numpy.minimum(numpy.arange(1, len(array) + 1), window_size)
+
+    return windows, counts
+
+
+class MovingSum(WindowAccumulator):
+    """Sum of the window values. Values are summed as they are, sum of
+    integers is an integer."""
+
+    def clear(self):
+        self.total = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+    def remove(self, value):
+        self.count -= 1
+        self.removed += 1
+        self.total -= value
+
+    def result(self):
+        return self.total
+
+    def batch(self, values, window_size):
+        if all(isinstance(value, (int, long)) for value in values):
+            # Sums of larger integers might overflow
+            bound = 2 ** 63 // window_size
+            if any(abs(value) >= bound for value in values):
+                return None
+            dtype = numpy.int64
+            convert = int
+        else:
+            dtype = numpy.float64
+            convert = float
+
+        windows, counts = _windows(values, window_size, dtype)
+
+        return [convert(value) for value in windows.sum(axis=1).tolist()]
+
+
+class MovingAverage(WindowAccumulator):
+    """Arithmetic mean of the window values rounded to two decimal
+    places."""
+
+    def clear(self):
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += float(value)
+
+    def remove(self, value):
+        self.count -= 1
+        self.removed += 1
+        self.total -= float(value)
+
+    def result(self):
+        return round(self.total / self.count, 2)
+
+    def batch(self, values, window_size):
+        windows, counts = _windows(values, window_size)
+        averages = windows.sum(axis=1) / counts
+
+        return [round(value, 2) for value in averages.tolist()]
+
+
+class WeightedMovingAverage(WindowAccumulator):
+    """Mean of the window values weighted by their position – the oldest
+    value has weight 1, the newest has weight equal to the window length –
+    rounded to four decimal places."""
+
+    def clear(self):
+        self.total = 0.0
+        self.weighted = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += float(value)
+        self.weighted += self.count * float(value)
+
+    def remove(self, value):
+        # The value leaving the window is the oldest one, weights of the
+        # remaining values decrease by one
+        self.weighted -= self.total
+        self.total -= float(value)
+        self.count -= 1
+        self.removed += 1
+
+    def result(self):
+        denom = self.count * (self.count + 1) / 2
+        return round(self.weighted / denom, 4)
 
-def _window_function_factory(aggregate, source, drilldown_paths, split_cell, window_function, label):
+    def batch(self, values, window_size):
+        windows, counts = _windows(values, window_size)
+
+        # The newest value has weight equal to the number of values in the
+        # window, padding has weight 0
+        weights = numpy.arange(1, window_size + 1) \
+                    - (window_size - counts)[:, numpy.newaxis]
+        weights = numpy.maximum(weights, 0)
+
+        totals = (windows * weights).sum(axis=1)
+        denoms = counts * (counts + 1) / 2.0
+
+        return [round(value, 4) for value in (totals / denoms).tolist()]
+
+
+# Ratio of the current and the largest sum of squared deviations of a moving
+# variance below which the variance is recomputed from the window values
+VARIANCE_PRECISION_RATIO = 1e-3
+
+
+class MovingVariance(WindowAccumulator):
+    def __init__(self, values=None, kind="variance"):
+        """Sample variance of the window values computed by Welford's
+        algorithm. The `result()` depends on the `kind`: ``variance`` or
+        ``stdev`` (rounded to two decimal places) or ``relative_stdev`` –
+        standard deviation relative to the mean (rounded to four decimal
+        places, 0 if the mean is not positive).
+
+        Removal of values that deviate much more than the remaining ones,
+        such as after a step in the series, cancels most of the sum of
+        squared deviations. The variance has `drifted()` then and should be
+        recomputed."""
+
+        if kind not in ("variance", "stdev", "relative_stdev"):
+            raise ArgumentError("Unknown variance kind '%s'" % (kind, ))
+
+        self.kind = kind
+        super(MovingVariance, self).__init__(values)
+
+    def clear(self):
+        self.mean = 0.0
+        self.squares = 0.0
+        self.peak = 0.0
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+        self.peak = max(self.peak, self.squares)
+
+    def remove(self, value):
+        value = float(value)
+        self.count -= 1
+        self.removed += 1
+        if not self.count:
+            self.clear()
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.squares -= delta * (value - self.mean)
+
+    def drifted(self):
+        return self.squares < self.peak * VARIANCE_PRECISION_RATIO
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return max(self.squares, 0.0) / (self.count - 1)
+
+    def result(self):
+        return self._result(self.mean, self.variance())
+
+    def _result(self, mean, variance):
+        if self.kind == "variance":
+            return round(variance, 2)
+        elif self.kind == "stdev":
+            return round(sqrt(variance), 2)
+        else:
+            return round(((sqrt(variance) / mean) if mean > 0 else 0), 4)
+
+    def batch(self, values, window_size):
+        windows, counts = _windows(values, window_size)
+
+        # Two passes over every window: the mean and then squares of
+        # deviations from the mean. Padding is excluded by the mask.
+        mask = numpy.arange(window_size) \
+                    >= (window_size - counts)[:, numpy.newaxis]
+        means = windows.sum(axis=1) / counts
+        deviations = (windows - means[:, numpy.newaxis]) * mask
+        squares = (deviations * deviations).sum(axis=1)
+        variances = numpy.where(counts > 1,
+                                squares / numpy.maximum(counts - 1, 1),
+                                0.0)
+
+        return [self._result(mean, variance)
+                for mean, variance in zip(means.tolist(),
+                                          variances.tolist())]
+
+
+def _window_function_factory(aggregate, source, drilldown_paths, split_cell,
+                             window_function, label, accumulator=None):
     """Returns a moving average window function. `aggregate` is the target
-    aggergate. `window_function` is concrete window function."""
+    aggergate. `window_function` is concrete window function, `accumulator`
+    is a factory of its incremental `WindowAccumulator`, if there is
+    one."""
 
     # If the level we're drilling to doesn't have aggregation_units configured,
     # we're not doing any calculations
@@ -140,7 +402,8 @@ def _window_function_factory(aggregate, source, drilldown_paths, split_cell, win
                               target_attribute=aggregate.name,
                               source_attribute=source,
                               window_size=num_units,
-                              label=label)
+                              label=label,
+                              accumulator=accumulator)
     return function
 
 def get_key(record, composite_key):
@@ -149,8 +412,11 @@ def get_key(record, composite_key):
 
 class WindowFunction(object):
     def __init__(self, function, window_key, target_attribute,
-                 source_attribute, window_size, label):
-        """Creates a window function."""
+                 source_attribute, window_size, label, accumulator=None):
+        """Creates a window function. If `accumulator` – a factory of a
+        `WindowAccumulator` – is specified, then the window value is
+        updated incrementally instead of calling the `function` with all
+        the window values for every record."""
 
         if not function:
             raise ArgumentError("No window function provided")
@@ -168,6 +434,8 @@ class WindowFunction(object):
         self.window_size = window_size
         self.window_values = {}
         self.label = label
+        self.accumulator = accumulator
+        self.accumulators = {}
 
     def __call__(self, record):
         """Collects the source value. If the window for the `window_key` is
@@ -182,32 +450,138 @@ class WindowFunction(object):
         except KeyError:
             values = deque()
             self.window_values[key] = values
+            if self.accumulator:
+                self.accumulators[key] = self.accumulator()
 
+        accumulator = self.accumulators.get(key)
         value = record.get(self.source_attribute)
 
         # TODO: What about those window functions that would want to have empty
         # values?
         if value is not None:
             values.append(value)
+            if accumulator:
+                accumulator.add(value)
 
         # Keep the window within the window size:
         while len(values) > self.window_size:
-            values.popleft()
+            removed = values.popleft()
+            if accumulator:
+                accumulator.remove(removed)
+                if accumulator.removed >= self.window_size \
+                        or accumulator.drifted():
+                    accumulator.reset(values)
 
         # Compute, if we have the values
         if len(values) > 0:
-            record[self.target_attribute] = self.function(values)
+            if accumulator:
+                record[self.target_attribute] = accumulator.result()
+            else:
+                record[self.target_attribute] = self.function(values)
+
+    def apply_columns(self, columns):
+        """Computes the window function for all rows of `columns` – an
+        ordered dictionary of lists of values by label, such as
+        `AggregationResult.columns()` – and stores the results in the column
+        `target_attribute`. The results are the same as of calling the
+        function with every row in order, except differences of floating
+        point rounding.
+
+        Windows of integer or float values are computed by NumPy at once, if
+        it is installed and the accumulator has a batch implementation. The
+        state of the function collected by calling it with records is not
+        used."""
+
+        source = columns.get(self.source_attribute)
+        if source is None:
+            return
+
+        count = len(source)
+        target = columns.get(self.target_attribute)
+        if target is None or len(target) != count:
+            target = [None] * count
+        else:
+            target = list(target)
+
+        if self.window_key:
+            key_columns = [columns.get(label) or [None] * count
+                           for label in self.window_key]
+            keys = zip(*key_columns)
+        else:
+            keys = [()] * count
+
+        # Row indexes by window key
+        groups = OrderedDict()
+        for index, key in enumerate(keys):
+            groups.setdefault(key, []).append(index)
+
+        for rows in groups.values():
+            values = [source[i] for i in rows if source[i] is not None]
+            if not values:
+                continue
+
+            results = self._window_results(values)
+
+            seen = 0
+            for i in rows:
+                if source[i] is not None:
+                    seen += 1
+                if seen:
+                    target[i] = results[seen - 1]
+
+        columns[self.target_attribute] = target
+
+    def _window_results(self, values):
+        """Returns list of window function results of windows ending at every
+        one of `values`."""
+
+        if self.accumulator:
+            accumulator = self.accumulator()
+            if numpy is not None and _is_numeric(values):
+                results = accumulator.batch(values, self.window_size)
+                if results is not None:
+                    return results
+        else:
+            accumulator = None
+
+        results = []
+        window = deque()
+        for value in values:
+            window.append(value)
+            if accumulator:
+                accumulator.add(value)
+
+            if len(window) > self.window_size:
+                removed = window.popleft()
+                if accumulator:
+                    accumulator.remove(removed)
+                    if accumulator.removed >= self.window_size \
+                            or accumulator.drifted():
+                        accumulator.reset(window)
+
+            if accumulator:
+                results.append(accumulator.result())
+            else:
+                results.append(self.function(window))
+
+        return results
+
+
+def _is_numeric(values):
+    """Returns ``True`` if `values` are all integers or all floats."""
+    types = set(type(value) for value in values)
+    return types <= set([int, long]) or types == set([float])
 
 
 
 # TODO: make CALCULATED_AGGREGATIONS a namespace (see extensions.py)
 CALCULATED_AGGREGATIONS = {
-    "wma": partial(_window_function_factory, window_function=weighted_moving_average, label='Weighted Moving Avg. of {measure}'),
-    "sma": partial(_window_function_factory, window_function=simple_moving_average, label='Simple Moving Avg. of {measure}'),
-    "sms": partial(_window_function_factory, window_function=simple_moving_sum, label='Simple Moving Sum of {measure}'),
-    "smstd": partial(_window_function_factory, window_function=simple_stdev, label='Moving Std. Deviation of {measure}'),
-    "smrsd": partial(_window_function_factory, window_function=simple_relative_stdev, label='Moving Relative St. Dev. of {measure}'),
-    "smvar": partial(_window_function_factory, window_function=simple_variance, label='Moving Variance of {measure}')
+    "wma": partial(_window_function_factory, window_function=weighted_moving_average, label='Weighted Moving Avg. of {measure}', accumulator=WeightedMovingAverage),
+    "sma": partial(_window_function_factory, window_function=simple_moving_average, label='Simple Moving Avg. of {measure}', accumulator=MovingAverage),
+    "sms": partial(_window_function_factory, window_function=simple_moving_sum, label='Simple Moving Sum of {measure}', accumulator=MovingSum),
+    "smstd": partial(_window_function_factory, window_function=simple_stdev, label='Moving Std. Deviation of {measure}', accumulator=partial(MovingVariance, kind="stdev")),
+    "smrsd": partial(_window_function_factory, window_function=simple_relative_stdev, label='Moving Relative St. Dev. of {measure}', accumulator=partial(MovingVariance, kind="relative_stdev")),
+    "smvar": partial(_window_function_factory, window_function=simple_variance, label='Moving Variance of {measure}', accumulator=partial(MovingVariance, kind="variance"))
 }
 
 def available_calculators():
@@ -216,3 +590,174 @@ def available_calculators():
 
 def aggregate_calculator_labels():
     return dict([(k, v.keywords['label']) for k, v in CALCULATED_AGGREGATIONS.iteritems()])
+
+
+# HyperLogLog
+# ===========
+
+# 2^14 registers, relative error about 0.8%
+DEFAULT_HLL_PRECISION = 14
+
+
+def hyperloglog_error(precision=DEFAULT_HLL_PRECISION):
+    """Returns relative standard error of a HyperLogLog estimate with
+    2^`precision` registers: 1.04 / sqrt(2^precision)."""
+    return 1.04 / sqrt(2 ** precision)
+
+
+class HyperLogLog(object):
+    def __init__(self, precision=DEFAULT_HLL_PRECISION):
+        """Approximate distinct counter by Flajolet et al. Values are hashed
+        to 64 bits, first `precision` bits select one of 2^`precision`
+        registers, the register keeps the maximal position of the first set
+        bit in the rest of the hash. Memory used is 2^`precision` bytes
+        regardless of number of values. Relative error of the estimate is
+        `hyperloglog_error(precision)`.
+
+        Counters with the same precision can be merged with `merge()`."""
+
+        if not 4 <= precision <= 18:
+            raise ArgumentError("HyperLogLog precision should be between "
+                                "4 and 18, not %s" % (precision, ))
+
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        """Adds `value` to the counter. ``None`` is ignored. Values are
+        hashed by their string representation, therefore ``1`` and ``"1"``
+        are the same value."""
+
+        if value is None:
+            return
+
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        else:
+            value = str(value)
+
+        digest = hashlib.sha1(value).digest()
+        hashed = struct.unpack(">Q", digest[:8])[0]
+
+        index = hashed >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rest = hashed & ((1 << rest_bits) - 1)
+        # Position of the first set bit, rest_bits + 1 if there is none
+        rank = rest_bits - rest.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        """Adds all `values` to the counter."""
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Merges counter `other` of the same precision into the receiver.
+        The receiver then estimates distinct count of values of both."""
+
+        if other.precision != self.precision:
+            raise ArgumentError("Can not merge HyperLogLog counters of "
+                                "different precision")
+
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def count(self):
+        """Returns estimated number of distinct values as an integer."""
+
+        m = self.size
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+
+        total = sum(2.0 ** -rank for rank in self.registers)
+        estimate = alpha * m * m / total
+
+        # Small range correction: linear counting of the empty registers
+        zeros = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(float(m) / zeros)
+
+        return int(round(estimate))
+
+
+
+# Sampled Aggregation
+# ===================
+
+# Confidence level of intervals of estimates from a sample
+DEFAULT_CONFIDENCE = 0.95
+
+
+def normal_quantile(probability):
+    """Returns value `z` for which probability of a standard normal variable
+    being less or equal to `z` is `probability`. Found by bisection of the
+    normal distribution function, precise to about 1e-9."""
+
+    if not 0 < probability < 1:
+        raise ArgumentError("Probability should be between 0 and 1, not %s"
+                            % (probability, ))
+
+    low, high = -40.0, 40.0
+    while high - low > 1e-9:
+        middle = (low + high) / 2
+        if 0.5 * (1 + erf(middle / sqrt(2))) < probability:
+            low = middle
+        else:
+            high = middle
+
+    return (low + high) / 2
+
+
+class SampleEstimator(object):
+    def __init__(self, fraction, confidence=DEFAULT_CONFIDENCE):
+        """Estimates totals of additive aggregates (sums and counts) from a
+        sample where every fact was included with probability `fraction`.
+        The estimate is the sampled value divided by the `fraction`
+        (Horvitz-Thompson estimator). Intervals are two-sided with
+        `confidence` level, computed by normal approximation."""
+
+        if not 0 < fraction <= 1:
+            raise ArgumentError("Sample fraction should be greater than 0 "
+                                "and at most 1, not %s" % (fraction, ))
+        if not 0 < confidence < 1:
+            raise ArgumentError("Confidence should be between 0 and 1, "
+                                "not %s" % (confidence, ))
+
+        self.fraction = float(fraction)
+        self.confidence = confidence
+        self.z = normal_quantile(0.5 + confidence / 2.0)
+
+    def estimate(self, value):
+        """Returns estimated total for `value` aggregated from the
+        sample."""
+        if value is None:
+            return None
+        return float(value) / self.fraction
+
+    def interval(self, value, sum_of_squares=None):
+        """Returns a tuple (`lower`, `upper`) of confidence interval bounds
+        of the total estimated from sampled `value`. `sum_of_squares` is sum
+        of squared measure values of the sampled facts, for counts it is
+        the count itself (the default)."""
+
+        if value is None:
+            return (None, None)
+
+        if sum_of_squares is None:
+            sum_of_squares = value
+
+        p = self.fraction
+        estimate = float(value) / p
+        error = self.z * sqrt(max(float(sum_of_squares), 0) * (1 - p)) / p
+
+        return (estimate - error, estimate + error)
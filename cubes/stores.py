@@ -47,4 +47,15 @@ def register_browser(type_, class_, options=None):
 
 class Store(object):
     """Abstract class to find other stores through the class hierarchy."""
-    pass
+
+    def flush_cache(self, cube=None):
+        """Flushes objects cached by the store, such as reflected physical
+        schemas. If `cube` is specified, then only objects related to the cube
+        are flushed. Default implementation does nothing."""
+        pass
+
+    def statistics(self):
+        """Returns a dictionary with store usage statistics, such as
+        utilization of connection pools, or ``None`` if the store does not
+        collect any. Default implementation returns ``None``."""
+        return None
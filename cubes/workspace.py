@@ -9,11 +9,13 @@ from .errors import *
 from .stores import open_store, create_browser
 from .calendar import Calendar
 import os.path
+import threading
 import ConfigParser
 from collections import OrderedDict
 
 __all__ = [
     "Workspace",
+    "BrowserPool",
 
     # Depreciated
     "get_backend",
@@ -230,6 +232,51 @@ class ModelObjectInfo(object):
         return self.instances[key]
 
 
+class BrowserPool(object):
+    def __init__(self, size=32):
+        """Creates a pool of reusable browsers with at most `size` browsers.
+        When the pool is full, the least recently used browser is discarded.
+        Pool of size 0 does not keep any browsers."""
+
+        self.size = size
+        self.browsers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a browser for `key` or `None` if there is no such browser
+        in the pool. The browser becomes the most recently used one."""
+
+        with self.lock:
+            try:
+                browser = self.browsers.pop(key)
+            except KeyError:
+                return None
+            self.browsers[key] = browser
+            return browser
+
+    def put(self, key, browser):
+        """Adds `browser` to the pool under `key`, evicting the least recently
+        used browsers if necessary."""
+
+        if self.size < 1:
+            return
+
+        with self.lock:
+            self.browsers.pop(key, None)
+            self.browsers[key] = browser
+
+            while len(self.browsers) > self.size:
+                self.browsers.popitem(last=False)
+
+    def clear(self):
+        """Removes all browsers from the pool."""
+        with self.lock:
+            self.browsers.clear()
+
+    def __len__(self):
+        return len(self.browsers)
+
+
 class Workspace(object):
     def __init__(self, config=None, stores=None):
         """Creates a workspace. `config` should be a `ConfigParser` or a
@@ -285,6 +332,14 @@ class Workspace(object):
         self._cubes = {}
         # Note: providers are responsible for their own caching
 
+        # Pool of reusable browsers
+        if config.has_option("workspace", "browser_pool_size"):
+            pool_size = config.getint("workspace", "browser_pool_size")
+        else:
+            pool_size = 32
+
+        self.browser_pool = BrowserPool(pool_size)
+
         if config.has_option("workspace", "lookup_method"):
             method = config.get("workspace", "lookup_method")
             if method not in ["exact", "recursive"]:
@@ -391,7 +446,6 @@ class Workspace(object):
             self.browser_options = dict(config.items("browser"))
         else:
             self.browser_options = {}
-
         if config.has_section("main"):
             self.options = dict(config.items("main"))
         else:
@@ -578,6 +632,19 @@ class Workspace(object):
 
         ns.add_provider(provider)
 
+        # New model might replace already used cubes
+        self.flush_lookup_cache()
+
+    def flush_lookup_cache(self):
+        """Flushes the cube lookup cache and caches of all open stores. Call
+        this method when a model was changed or reloaded."""
+
+        self._cubes.clear()
+        self.browser_pool.clear()
+
+        for store in self.stores.values():
+            store.flush_cache()
+
     # TODO: depreciated
     def add_model(self, model, name=None, store=None, translations=None):
         """Registers the `model` in the workspace. `model` can be a metadata
@@ -647,7 +714,7 @@ class Workspace(object):
                 raise NotAuthorized
 
         cube_key = (name, locale)
-        if name in self._cubes:
+        if cube_key in self._cubes:
             return self._cubes[cube_key]
 
         (ns, ns_cube) = self.namespace.namespace_for_cube(name)
@@ -788,7 +855,13 @@ class Workspace(object):
         return options
 
     def browser(self, cube, locale=None, identity=None):
-        """Returns a browser for `cube`."""
+        """Returns a browser for `cube`.
+
+        Browsers are reused: a browser created for the same cube, locale and
+        options is taken from the workspace's browser pool (see
+        `browser_pool_size` workspace configuration option). The browser
+        does not depend on `identity`, which is used only to get the cube.
+        """
 
         # TODO: bring back the localization
         # model = self.localized_model(locale)
@@ -807,6 +880,14 @@ class Workspace(object):
         options = dict(store_info)
         options.update(cube_options)
 
+        key = (cube.name, locale, repr(sorted(options.items())))
+        browser = self.browser_pool.get(key)
+
+        # Reuse only a browser of the very same cube object – the cube might
+        # have been replaced by a new model
+        if browser is not None and browser.cube is cube:
+            return browser
+
         # TODO: Construct options for the browser from cube's options dictionary and
         # workspece default configuration
         #
@@ -824,14 +905,13 @@ class Workspace(object):
 
         browser.calendar = self.calendar
 
+        self.browser_pool.put(key, browser)
+
         return browser
 
     def cube_features(self, cube, identity=None):
         """Returns browser features for `cube`"""
-        # TODO: this might be expensive, make it a bit cheaper
-        # recycle the feature-providing browser or something. Maybe use class
-        # method for that
-        return self.browser(cube, identity).features()
+        return self.browser(cube, identity=identity).features()
 
     def get_store(self, name=None):
         """Opens a store `name`. If the store is already open, returns the
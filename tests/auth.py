@@ -113,3 +113,17 @@ class AuthTestCase(CubesTestCaseBase):
         self.assertEqual([self.sales_cube],
                          self.auth.authorize("john", [self.sales_cube]))
 
+
+    def test_unlimited_export(self):
+        roles = {
+            "export": {"unlimited_export": True}
+        }
+        rights = {
+            "john": {"roles": ["export"]},
+            "ivana": {}
+        }
+        self.auth = SimpleAuthorizer(rights=rights, roles=roles)
+
+        self.assertTrue(self.auth.unlimited_export("john"))
+        self.assertFalse(self.auth.unlimited_export("ivana"))
+        self.assertFalse(self.auth.unlimited_export("unknown"))
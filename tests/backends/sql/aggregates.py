@@ -3,6 +3,10 @@ import unittest
 from sqlalchemy import create_engine, MetaData, Table, Integer, String, Column
 from cubes import *
 from cubes.errors import *
+from cubes.statutils import HyperLogLog, WindowFunction, MovingVariance
+from cubes.statutils import CALCULATED_AGGREGATIONS
+from cubes import statutils
+from collections import OrderedDict
 from ...common import CubesTestCaseBase
 
 from json import dumps
@@ -10,6 +14,132 @@ from json import dumps
 def printable(obj):
     return dumps(obj, indent=4)
 
+class HyperLogLogTestCase(unittest.TestCase):
+    def test_estimate(self):
+        counter = HyperLogLog()
+        self.assertEqual(0, counter.count())
+
+        counter.update(range(20000))
+        counter.update(range(10000))
+        self.assertLess(abs(counter.count() - 20000), 20000 * 0.03)
+
+        other = HyperLogLog()
+        other.update(range(15000, 30000))
+        counter.merge(other)
+        self.assertLess(abs(counter.count() - 30000), 30000 * 0.03)
+
+        with self.assertRaises(ArgumentError):
+            counter.merge(HyperLogLog(10))
+
+class WindowFunctionTestCase(unittest.TestCase):
+    values = [3, 10, None, 4, 8, 15, 1, 7, 7, 12, 2.5, 9]
+
+    def window_function(self, name, window_size=3):
+        factory = CALCULATED_AGGREGATIONS[name]
+        return WindowFunction(factory.keywords["window_function"], ["key"],
+                              target_attribute="target",
+                              source_attribute="value",
+                              window_size=window_size,
+                              label=name,
+                              accumulator=factory.keywords["accumulator"])
+
+    def records(self):
+        return [{"key": i % 2, "value": value}
+                for i, value in enumerate(self.values)]
+
+    def test_accumulators(self):
+        for name, factory in CALCULATED_AGGREGATIONS.items():
+            function = factory.keywords["window_function"]
+            calculator = self.window_function(name)
+            windows = {}
+            for record in self.records():
+                calculator(record)
+                if record["value"] is None:
+                    continue
+                window = windows.setdefault(record["key"], [])
+                window.append(record["value"])
+                self.assertAlmostEqual(function(window[-3:]),
+                                       record["target"], places=4,
+                                       msg=name)
+
+    def test_apply_columns(self):
+        for name in CALCULATED_AGGREGATIONS:
+            records = self.records()
+            calculator = self.window_function(name)
+            for record in records:
+                calculator(record)
+
+            columns = OrderedDict()
+            columns["key"] = [record["key"] for record in records]
+            columns["value"] = [record["value"] for record in records]
+
+            calculator = self.window_function(name)
+            calculator.apply_columns(columns)
+
+            for record, value in zip(records, columns["target"]):
+                self.assertAlmostEqual(record.get("target"), value,
+                                       places=2, msg=name)
+
+    def steps(self):
+        # Large values with steps and small differences between the steps
+        return [1e9 + (i // 10) * 1e6 + (i % 3) * 0.25 for i in range(300)]
+
+    def assertWindowsEqual(self, name, expected, values):
+        for expected_value, value in zip(expected, values):
+            self.assertLessEqual(abs(expected_value - value),
+                                 max(abs(expected_value), 1) * 1e-9,
+                                 msg="%s: %s != %s"
+                                     % (name, expected_value, value))
+
+    def test_large_values(self):
+        values = self.steps()
+        for name, factory in CALCULATED_AGGREGATIONS.items():
+            function = factory.keywords["window_function"]
+            calculator = self.window_function(name, window_size=7)
+            records = [{"value": value} for value in values]
+            for record in records:
+                calculator(record)
+
+            expected = [function(values[max(i - 6, 0):i + 1])
+                        for i in range(len(values))]
+            self.assertWindowsEqual(name, expected,
+                                    [record["target"] for record in records])
+
+    @unittest.skipIf(statutils.numpy is None, "NumPy is not installed")
+    def test_batch(self):
+        values = self.steps()
+        for name, factory in CALCULATED_AGGREGATIONS.items():
+            accumulator = factory.keywords["accumulator"]()
+            batch = accumulator.batch(values, 7)
+            self.assertIsNotNone(batch)
+
+            calculator = self.window_function(name, window_size=7)
+            records = [{"value": value} for value in values]
+            for record in records:
+                calculator(record)
+
+            self.assertWindowsEqual(name,
+                                    [record["target"] for record in records],
+                                    batch)
+
+        batch = CALCULATED_AGGREGATIONS["sms"].keywords["accumulator"]()
+        self.assertEqual([3, 10, 13, 14, 12],
+                         batch.batch([3, 7, 3, 4, 5], 3))
+
+    def test_variance(self):
+        variance = MovingVariance([2, 4, 4, 4, 5, 5, 7, 9])
+        self.assertAlmostEqual(5.0, variance.mean)
+        self.assertAlmostEqual(4.57, variance.result())
+
+        variance.remove(2)
+        variance.add(1)
+        self.assertAlmostEqual(4.875, variance.mean)
+        self.assertAlmostEqual(5.55, variance.result())
+
+        with self.assertRaises(ArgumentError):
+            MovingVariance(kind="unknown")
+
+
 class AggregatesTestCase(CubesTestCaseBase):
     sql_engine = "sqlite:///"
 
@@ -70,3 +200,29 @@ class AggregatesTestCase(CubesTestCaseBase):
         aggregates = sorted(cells[0].keys())
         self.assertSequenceEqual(['amount_sma', 'amount_sum', 'count', 'year'],
                                  aggregates)
+
+        columns = browser.aggregate(drilldown=["year"]).columns()
+        self.assertEqual([cell["amount_sma"] for cell in cells],
+                         columns["amount_sma"])
+
+        result = browser.aggregate(drilldown=["year"]).to_dict(columnar=True)
+        self.assertEqual(list(result["columns"].keys()), result["labels"])
+        self.assertIn("amount_sma", result["labels"])
+
+    def test_distinct_count(self):
+        browser = self.workspace.browser("distinct")
+        result = browser.aggregate(drilldown=["year"])
+        self.assertEqual(8, result.summary["price_count_distinct"])
+        self.assertEqual(8, result.summary["price_approx_count_distinct"])
+
+        for cell in result.cells:
+            self.assertEqual(4, cell["price_count_distinct"])
+            self.assertEqual(4, cell["price_approx_count_distinct"])
+
+        approximate = browser.features()["approximate_aggregates"]
+        self.assertEqual(["price_approx_count_distinct"], approximate.keys())
+        self.assertEqual("hyperloglog",
+                         approximate["price_approx_count_distinct"]["method"])
+        self.assertAlmostEqual(0.008125,
+                    approximate["price_approx_count_distinct"]["relative_error"])
+
@@ -4,12 +4,18 @@ import json
 import re
 import sqlalchemy
 import datetime
+import tempfile
+import time
+import threading
 
 from ...common import CubesTestCaseBase
 from sqlalchemy import Table, Column, Integer, Float, String, MetaData, ForeignKey
 from sqlalchemy import create_engine
 from cubes.backends.sql.mapper import coalesce_physical
 from cubes.backends.sql.browser import *
+from cubes.backends.sql.store import SQLStore
+from cubes.backends.sql.query import MemberCache
+from cubes.backends.sql.replicas import ReplicaSet
 
 from cubes import *
 from cubes.errors import *
@@ -415,6 +421,31 @@ class StarSQLBrowserTestCase(StarSQLTestCase):
         self.assertEqual(1, len(keys))
         self.assertEqual(["discount_sum"], keys)
 
+    def test_shared_schema(self):
+        store = self.workspace.get_store("default")
+        store.flush_cache()
+
+        schema = self.browser.snowflake_schema()
+        self.assertEqual(1, len(store.schema_cache))
+
+        browser = SnowflakeBrowser(self.cube, store=store,
+                                   dimension_prefix="dim_")
+        self.assertIs(schema, browser.snowflake_schema())
+
+        # Different mapping should not share the schema
+        browser = SnowflakeBrowser(self.cube, store=store,
+                                   dimension_prefix="dim_",
+                                   safe_labels=True)
+        self.assertIsNot(schema, browser.snowflake_schema())
+        self.assertEqual(2, len(store.schema_cache))
+
+        result = browser.aggregate(drilldown=["date"])
+        self.assertEqual(1, len(list(result.cells)))
+
+        store.flush_cache(self.cube)
+        self.assertEqual(0, len(store.schema_cache))
+        self.assertIsNot(schema, self.browser.snowflake_schema())
+
 
 class HierarchyTestCase(CubesTestCaseBase):
     def setUp(self):
@@ -688,6 +719,740 @@ class SQLBrowserTestCase(CubesTestCaseBase):
         values = [cell["country"] for cell in cells]
         self.assertSequenceEqual(["uk", "sk", "fr", "at"], values)
 
+    def test_single_pass_aggregate(self):
+        browser = SnowflakeBrowser(self.cube, store=self.browser.store,
+                                   single_pass_aggregation=True)
+        drilldown = [("country", None, "country")]
+
+        expected = self.browser.aggregate(drilldown=drilldown)
+        result = browser.aggregate(drilldown=drilldown)
+
+        self.assertEqual(expected.summary, result.summary)
+        self.assertEqual(4, result.total_cell_count)
+        self.assertEqual(list(expected.cells), list(result.cells))
+
+        # Pagination should not affect totals
+        result = browser.aggregate(drilldown=drilldown, page=1, page_size=3)
+        self.assertEqual(5550, result.summary["amount_sum"])
+        self.assertEqual(4, result.total_cell_count)
+        cells = list(result.cells)
+        self.assertEqual(1, len(cells))
+        self.assertEqual("uk", cells[0]["country"])
+
+        # Empty page falls back to separate queries
+        result = browser.aggregate(drilldown=drilldown, page=2, page_size=3)
+        self.assertEqual(5550, result.summary["amount_sum"])
+        self.assertEqual(4, result.total_cell_count)
+        self.assertEqual([], list(result.cells))
+
+        result = browser.aggregate(drilldown=drilldown, include_summary=False)
+        self.assertFalse(result.summary)
+        self.assertEqual(4, result.total_cell_count)
+
+    def test_columns(self):
+        drilldown = [("country", None, "country")]
+        expected = list(self.browser.aggregate(drilldown=drilldown).cells)
+
+        result = self.browser.aggregate(drilldown=drilldown)
+        columns = result.columns()
+        self.assertEqual(result.labels, list(columns.keys()))
+        self.assertEqual([cell["country"] for cell in expected],
+                         columns["country"])
+        self.assertEqual([cell["amount_sum"] for cell in expected],
+                         columns["amount_sum"])
+
+        result = self.browser.aggregate(drilldown=drilldown)
+        columns = result.columns(limit=2)
+        self.assertEqual(2, len(columns["country"]))
+
+        result = self.browser.aggregate(drilldown=drilldown, page=5,
+                                        page_size=10)
+        columns = result.columns()
+        self.assertEqual([], columns["country"])
+
+        # Cells that are not from a SQL result
+        result = self.browser.aggregate(drilldown=drilldown)
+        result.cells = list(result.cells)
+        self.assertEqual([cell["country"] for cell in expected],
+                         result.columns()["country"])
+
+    def test_statement_cache(self):
+        cache = self.browser.store.statement_cache
+        cache.invalidate()
+
+        def aggregate(cuts, drilldown=["date"], **options):
+            cell = Cell(self.cube, cuts)
+            result = self.browser.aggregate(cell, drilldown=drilldown,
+                                            **options)
+            return (result.summary["amount_sum"],
+                    [c["amount_sum"] for c in result.cells])
+
+        self.assertEqual((550, [20, 20, 110, 200, 200]),
+                         aggregate([PointCut("date", [2012])]))
+        misses = cache.misses
+        # Drill-down and summary statements
+        self.assertEqual(2, len(cache))
+
+        # Same shape, different values: the statements are reused
+        self.assertEqual((5000, [2000, 2000, 1000]),
+                         aggregate([PointCut("date", [2013])]))
+        self.assertEqual(misses, cache.misses)
+        self.assertEqual(2, len(cache))
+
+        # Different shape
+        self.assertEqual((20, [10, 10]),
+                         aggregate([PointCut("date", [2012, 1])]))
+        self.assertEqual(4, len(cache))
+
+        cuts = [RangeCut("date", [2012, 4], [2013, 1])]
+        self.assertEqual((2400, [400, 2000]), aggregate(cuts))
+        cuts = [RangeCut("date", [2012, 2], [2012, 3])]
+        self.assertEqual((130, [130]), aggregate(cuts))
+
+        cuts = [SetCut("country", [["sk"], ["at"]])]
+        self.assertEqual((50, [50]), aggregate(cuts))
+        cuts = [SetCut("country", [["uk"], ["fr"]])]
+        self.assertEqual((5500, [500, 5000]), aggregate(cuts))
+
+        cuts = [PointCut("country", ["fr"], invert=True)]
+        self.assertEqual((550, [550]), aggregate(cuts))
+        cuts = [PointCut("country", ["uk"], invert=True)]
+        self.assertEqual((5050, [50, 5000]), aggregate(cuts))
+
+        # Pagination and order are part of the shape
+        result = aggregate([PointCut("date", [2012])], page=0, page_size=2,
+                           order=[("amount_sum", "desc")])
+        self.assertEqual((550, [200, 200]), result)
+        result = aggregate([PointCut("date", [2012])], page=1, page_size=2,
+                           order=[("amount_sum", "desc")])
+        self.assertEqual((550, [110, 20]), result)
+
+        self.browser.store.flush_cache(self.cube)
+        self.assertEqual(0, len(cache))
+
+    def test_concurrent_report(self):
+        # In-memory database has only one connection
+        self.assertEqual(1, self.browser.report_workers)
+
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        try:
+            engine = create_engine("sqlite:///%s" % path)
+            self.metadata.create_all(engine)
+            rows = self.engine.execute(self.facts.select()).fetchall()
+            engine.execute(self.facts.insert(), [dict(row) for row in rows])
+
+            store = SQLStore(engine=engine)
+            browser = SnowflakeBrowser(self.cube, store, report_workers=3)
+            self.assertEqual(3, browser.report_workers)
+
+            queries = {
+                "years": {"query": "aggregate", "drilldown": ["date"]},
+                "countries": {"query": "aggregate", "drilldown": ["country"]},
+                "facts": {"query": "facts", "page": 0, "page_size": 2},
+                "total": {"query": "aggregate"}
+            }
+            result = browser.report(Cell(self.cube), queries)
+            expected = self.browser.report(Cell(self.cube), queries)
+
+            for name in ["years", "countries"]:
+                self.assertEqual(list(expected[name].cells),
+                                 result[name].cells)
+            self.assertEqual(5550, result["total"].summary["amount_sum"])
+            self.assertEqual([1, 2], [fact["id"] for fact in result["facts"]])
+        finally:
+            os.remove(path)
+
+    def test_stream_facts(self):
+        browser = SnowflakeBrowser(self.cube, self.browser.store,
+                                   stream_results=True, fetch_size=4)
+        facts = browser.facts()
+        options = facts.result.context.execution_options
+        self.assertTrue(options.get("stream_results"))
+
+        # Rows are fetched in batches of fetch size
+        first = next(facts)
+        self.assertEqual(3, len(facts.batch))
+        ids = [first["id"]] + [fact["id"] for fact in facts]
+        self.assertEqual(range(1, 16), ids)
+
+        facts = self.browser.facts()
+        options = facts.result.context.execution_options
+        self.assertFalse(options.get("stream_results"))
+
+        facts = browser.facts()
+        next(facts)
+        facts.close()
+        self.assertTrue(facts.result.closed)
+        self.assertEqual([], list(facts))
+
+    def test_column_batches(self):
+        drilldown = [("country", None, "country")]
+        expected = list(self.browser.aggregate(drilldown=drilldown).cells)
+
+        for cells in [None, list]:
+            result = self.browser.aggregate(drilldown=drilldown)
+            if cells:
+                result.cells = cells(result.cells)
+            batches = list(result.column_batches(2))
+            self.assertEqual((len(expected) + 1) // 2, len(batches))
+            self.assertEqual([2] * (len(batches) - 1),
+                             [len(b["country"]) for b in batches[:-1]])
+            countries = sum((b["country"] for b in batches), [])
+            self.assertEqual([cell["country"] for cell in expected],
+                             countries)
+
+        result = self.browser.aggregate(drilldown=drilldown)
+        self.assertIs(int, result.types["amount_sum"])
+
+    def test_grouping_sets_statement(self):
+        from sqlalchemy.dialects import postgresql
+        from cubes.backends.sql.query import QueryBuilder
+        from cubes.backends.sql.utils import supports_grouping_sets
+
+        self.assertFalse(supports_grouping_sets(self.engine.dialect))
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (9, 4)
+        self.assertFalse(supports_grouping_sets(dialect))
+        dialect.server_version_info = (9, 5)
+        self.assertTrue(supports_grouping_sets(dialect))
+
+        cell = Cell(self.cube, [PointCut("date", [2012])])
+        drilldowns = [Drilldown(["date"], cell), Drilldown(["country"], cell)]
+        aggregates = self.browser.prepare_aggregates(None)
+
+        builder = QueryBuilder(self.browser)
+        statement = builder.grouping_sets_statement(cell, drilldowns,
+                                                    aggregates)
+        self.assertEqual(["date.year", "date.month", "country", "amount_sum"],
+                         builder.labels)
+
+        sql = str(statement.compile(dialect=dialect))
+        self.assertIn("GROUPING SETS ((facts.year, facts.month), "
+                      "(facts.country), ())", sql)
+        self.assertEqual(3, sql.count("grouping("))
+
+    def test_merged_report(self):
+        from cubes.backends.sql import browser as browser_module
+
+        queries = {
+            "years": {"query": "aggregate", "drilldown": ["date"]},
+            "countries": {"query": "aggregate", "drilldown": ["country"]},
+            "paged": {"query": "aggregate", "drilldown": ["country"],
+                      "page": 0, "page_size": 1},
+            "total": {"query": "aggregate"}
+        }
+        expected = self.browser.report(Cell(self.cube), queries)
+        cells = dict((name, list(expected[name].cells))
+                     for name in ["years", "countries"])
+
+        # SQLite has no GROUPING SETS: pretend it does and return the rows
+        # the database would return
+        rows = [(None, None, 5550, 1, 1)]
+        for cell in cells["years"]:
+            rows.append((cell["date.year"], None, cell["amount_sum"], 0, 1))
+        for cell in cells["countries"]:
+            rows.append((None, cell["country"], cell["amount_sum"], 1, 0))
+
+        class Cursor(list):
+            def close(self):
+                pass
+
+        statements = []
+        def execute_statement(statement, label=None, **options):
+            statements.append(label)
+            return Cursor(reversed(rows))
+
+        original = browser_module.supports_grouping_sets
+        browser_module.supports_grouping_sets = lambda dialect: True
+        try:
+            jobs = self.browser.report_jobs(Cell(self.cube), queries)
+            names = [name for name, function in jobs]
+            self.assertIn(("countries", "years"), names)
+            self.assertItemsEqual(["paged", "total"],
+                                  [n for n in names if not isinstance(n, tuple)])
+
+            self.browser.execute_statement = execute_statement
+            result = self.browser.grouped_aggregate(Cell(self.cube),
+                            self.browser.prepare_aggregates(None),
+                            [("years", Drilldown(["date"], Cell(self.cube))),
+                             ("countries", Drilldown(["country"],
+                                                     Cell(self.cube)))])
+        finally:
+            browser_module.supports_grouping_sets = original
+            del self.browser.execute_statement
+
+        self.assertEqual(["grouped aggregation"], statements)
+        for name in ["years", "countries"]:
+            self.assertEqual(cells[name], list(result[name].cells))
+            self.assertEqual(expected[name].summary, result[name].summary)
+            self.assertEqual(expected[name].total_cell_count,
+                             result[name].total_cell_count)
+            self.assertEqual(expected[name].labels, result[name].labels)
+
+    def test_statement_timeout(self):
+        self.assertIsNone(self.browser.query_timeout())
+        self.assertEqual(2.0, self.browser.query_timeout(2))
+
+        slow = sqlalchemy.text("WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL "
+                               "SELECT i + 1 FROM r) "
+                               "SELECT count(*) FROM r")
+        with self.assertRaises(QueryTimeoutError):
+            self.browser.execute_statement(slow, timeout=0.1)
+
+        # The connection is usable after the cancelled statement
+        result = self.browser.aggregate(timeout=5)
+        self.assertEqual(5550, result.summary["amount_sum"])
+
+        self.browser.timeout = 0.1
+        try:
+            self.assertEqual(0.1, self.browser.query_timeout(5))
+            with self.assertRaises(QueryTimeoutError):
+                self.browser.execute_statement(slow)
+        finally:
+            self.browser.timeout = None
+
+        self.assertEqual(["after", "timeout"],
+                         self.browser.features()["query_options"])
+
+    def test_session_timeout_statements(self):
+        from sqlalchemy.dialects import mysql, mssql
+        from cubes.backends.sql.utils import session_timeout_statements
+        from cubes.backends.sql.utils import supports_statement_timeout
+
+        dialect = mysql.dialect()
+        dialect.server_version_info = (5, 7, 20)
+        self.assertEqual(("SET SESSION max_execution_time = 1500",
+                          "SET SESSION max_execution_time = 0"),
+                         session_timeout_statements(dialect, 1.5))
+
+        dialect.server_version_info = (5, 5, 5, 10, 2, 1, "MariaDB")
+        self.assertEqual(("SET SESSION max_statement_time = 1.500",
+                          "SET SESSION max_statement_time = 0"),
+                         session_timeout_statements(dialect, 1.5))
+
+        dialect.server_version_info = (5, 6, 10)
+        self.assertIsNone(session_timeout_statements(dialect, 1.5))
+
+        self.assertTrue(supports_statement_timeout(dialect))
+        self.assertFalse(supports_statement_timeout(mssql.dialect()))
+
+    def test_sampled_aggregate(self):
+        # SQLite has no TABLESAMPLE: facts 5, 10 and 15 are sampled
+        result = self.browser.aggregate(sample=0.2, drilldown=["date"])
+        self.assertEqual({"method": "modulo", "fraction": 0.2,
+                          "confidence": 0.95}, result.sample)
+
+        summary = result.summary
+        self.assertAlmostEqual(5550, summary["amount_sum"])
+        self.assertLess(summary["amount_sum_lower"], 5550)
+        self.assertGreater(summary["amount_sum_upper"], 5550)
+        # 1.96 * sqrt((10^2 + 100^2 + 1000^2) * 0.8) / 0.2
+        self.assertAlmostEqual(8810.0,
+                               summary["amount_sum_upper"] - 5550, -1)
+
+        self.assertIn("amount_sum_lower", result.labels)
+        cells = list(result.cells)
+        self.assertEqual([550, 5000], [c["amount_sum"] for c in cells])
+        self.assertNotIn("__square0", cells[0])
+
+        self.assertEqual("modulo",
+                         self.browser.features()["sampling"]["method"])
+
+        result = self.browser.aggregate(sample=1)
+        self.assertIsNone(result.sample)
+        self.assertEqual(5550, result.summary["amount_sum"])
+
+        with self.assertRaises(ArgumentError):
+            self.browser.aggregate(sample=2)
+
+    def test_keyset_pagination(self):
+        ids = []
+        after = None
+        while True:
+            facts = self.browser.facts(page_size=4, after=after)
+            ids += [fact["id"] for fact in facts]
+            after = facts.next_page
+            if not after:
+                break
+        self.assertEqual(range(1, 16), ids)
+
+        facts = self.browser.facts(page_size=4)
+        self.assertEqual([1, 2, 3, 4], [fact["id"] for fact in facts])
+
+        # Deep pages by offset and by token are the same
+        order = [("amount_sum", "desc")]
+        by_page = []
+        for page in range(3):
+            result = self.browser.aggregate(drilldown=["date:month"],
+                                            page=page, page_size=3,
+                                            order=order)
+            by_page += list(result.cells)
+
+        by_token = []
+        after = None
+        while True:
+            result = self.browser.aggregate(drilldown=["date:month"],
+                                            page_size=3, order=order,
+                                            after=after)
+            by_token += list(result.cells)
+            after = result.next_page
+            if not after:
+                break
+
+        self.assertEqual(8, len(by_token))
+        self.assertEqual(by_page, by_token)
+        self.assertEqual([2000, 2000, 1000, 200, 200, 110, 20, 20],
+                         [cell["amount_sum"] for cell in by_token])
+        self.assertEqual(8, result.total_cell_count)
+
+        members = self.browser.members(None, "date", depth=1, page_size=1)
+        self.assertEqual([2012], [m["date.year"] for m in members])
+        members = self.browser.members(None, "date", depth=1, page_size=1,
+                                       after=members.next_page)
+        self.assertEqual([2013], [m["date.year"] for m in members])
+
+        with self.assertRaises(ArgumentError):
+            self.browser.facts(page_size=4, after="invalid")
+        with self.assertRaises(ArgumentError):
+            self.browser.facts(page_size=4, after=members.next_page)
+        with self.assertRaises(ArgumentError):
+            self.browser.facts(after=facts.next_page)
+
+    def test_keyset_pagination_nulls(self):
+        for row in [(16, 2013, 3, 5, None, 1),
+                    (17, 2013, 3, 5, None, 2),
+                    (18, 2012, 1, 1, None, 3)]:
+            self.engine.execute(self.facts.insert().values(row))
+
+        facts = []
+        after = None
+        while True:
+            page = self.browser.facts(page_size=2, order=["country"],
+                                      after=after)
+            facts += list(page)
+            after = page.next_page
+            if not after:
+                break
+
+        self.assertEqual(18, len(facts))
+        # SQLite sorts NULLs first
+        self.assertEqual([None, None, None],
+                         [fact["country"] for fact in facts[0:3]])
+        self.assertEqual([16, 17, 18], [fact["id"] for fact in facts[0:3]])
+        self.assertEqual(range(1, 19), sorted(fact["id"] for fact in facts))
+
+        cells = []
+        after = None
+        while True:
+            result = self.browser.aggregate(drilldown=["country"],
+                                            order=[("country", "desc")],
+                                            page_size=2, after=after)
+            cells += list(result.cells)
+            after = result.next_page
+            if not after:
+                break
+
+        self.assertEqual(["uk", "sk", "fr", "at", None],
+                         [cell["country"] for cell in cells])
+
+    def test_member_cache(self):
+        store = self.browser.store
+        store.member_cache = MemberCache(60)
+
+        members = self.browser.members(None, "date", depth=1)
+        self.assertEqual([2012, 2013], [m["date.year"] for m in members])
+        self.assertEqual(1, len(store.member_cache))
+
+        details = self.browser.path_details("date", ["2012", "4"])
+        self.assertEqual(4, details["date.month"])
+        self.assertEqual(2, len(store.member_cache))
+
+        # Cached members are not affected by changes of the returned ones
+        details["date.month"] = 0
+        details = self.browser.path_details("date", [2012, 4])
+        self.assertEqual(4, details["date.month"])
+
+        # Missing path is queried
+        self.assertIsNone(self.browser.path_details("date", [2012, 9]))
+
+        cell = Cell(self.cube, [PointCut("date", [2012, 4])])
+        details = self.browser.cell_details(cell)
+        self.assertEqual(4, details[0][-1]["date.month"])
+
+        # Restricted cell is not answered from the cache
+        cell = Cell(self.cube, [PointCut("country", ["fr"])])
+        members = self.browser.members(cell, "date", depth=1)
+        self.assertEqual([2013], [m["date.year"] for m in members])
+
+        store.flush_cache(self.cube)
+        self.assertEqual(0, len(store.member_cache))
+
+    def test_member_cache_concurrent_load(self):
+        cache = MemberCache(60)
+        loading = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def slow_factory():
+            loads.append("slow")
+            loading.set()
+            release.wait(5)
+            return ["slow"]
+
+        def load_slow():
+            cache.get(("facts", "date", "year"), slow_factory)
+
+        threads = [threading.Thread(target=load_slow) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        loading.wait(5)
+
+        # Other levels are loaded while the slow one is still loading
+        members = cache.get(("facts", "country", "country"),
+                            lambda: ["fast"])
+        self.assertEqual(["fast"], members)
+        self.assertEqual(1, len(cache))
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # The slow level was loaded only once
+        self.assertEqual(["slow"], loads)
+        self.assertEqual(2, len(cache))
+
+    def test_cell_details(self):
+        labels = []
+        execute = self.browser.execute_statement
+        def execute_statement(statement, label=None, *args, **kwargs):
+            labels.append(label)
+            return execute(statement, label, *args, **kwargs)
+        self.browser.execute_statement = execute_statement
+
+        cell = Cell(self.cube, [
+                        SetCut("date", [["2012", "1"], ["2012", "4"],
+                                        ["2013", "9"]]),
+                        RangeCut("date", ["2012"], ["2013"]),
+                        PointCut("country", ["sk"])
+                    ])
+        details = self.browser.cell_details(cell)
+
+        # One query per dimension and path length
+        self.assertEqual(3, len(labels))
+
+        self.assertEqual(3, len(details[0]))
+        self.assertEqual([2012, 4], [level["_key"] for level in details[0][1]])
+        self.assertIsNone(details[0][2])
+        self.assertEqual(2013, details[1]["to"][0]["_key"])
+        self.assertEqual("sk", details[2][0]["_key"])
+
+        self.assertEqual([{"date.year": 2012, "date.month": 1}, None],
+                         self.browser.paths_details("date", [[2012, 1],
+                                                             [2012, 9]]))
+
+    def test_replica_failover(self):
+        store = self.browser.store
+        broken = create_engine("sqlite:////nonexistent/directory/replica.db")
+        store.replicas = ReplicaSet(self.engine, [broken], retry_interval=60)
+
+        self.assertEqual([broken, self.engine],
+                         store.replicas.connectables())
+
+        result = self.browser.aggregate()
+        self.assertEqual(5550, result.summary["amount_sum"])
+
+        # Failed replica is skipped
+        self.assertEqual([self.engine], store.replicas.connectables())
+        stats = store.statistics()
+        self.assertFalse(stats["replicas"][0]["available"])
+        self.assertIn("pool", stats["primary"])
+
+        # Statement errors are not failures of the replica
+        store.replicas = ReplicaSet(self.engine, [self.engine])
+        with self.assertRaises(sqlalchemy.exc.DBAPIError):
+            self.browser.execute_statement("SELECT * FROM no_table")
+        self.assertEqual([self.engine, self.engine],
+                         store.replicas.connectables())
+
+    def test_replica_single_check(self):
+        class SlowReplica(object):
+            url = "slow://replica"
+            checks = 0
+            def execute(self, statement):
+                SlowReplica.checks += 1
+                time.sleep(0.2)
+
+        replica = SlowReplica()
+        replicas = ReplicaSet(self.engine, [replica], retry_interval=10)
+        replicas.failed[0] = time.time() - 20
+
+        results = []
+        def connectables():
+            results.append(replicas.connectables())
+        threads = [threading.Thread(target=connectables) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # One caller checks the replica, the others skip it meanwhile
+        self.assertEqual(1, SlowReplica.checks)
+        self.assertEqual(1, sum(1 for engines in results
+                                if replica in engines))
+        self.assertEqual([replica, self.engine], replicas.connectables())
+
+    def test_partitioned_facts(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "sales",
+                    "dimensions": ["date", "country"],
+                    "measures": ["amount"],
+                    "mappings": {
+                        "date.year": "year",
+                        "date.month": "month",
+                        "date.day": "day"
+                    },
+                    "browser_options": {
+                        "fact_partitions": "sales_{year}_{month:02d}",
+                        "partition_dimension": "date"
+                    }
+                }
+            ],
+            "dimensions": [
+                {"name": "date", "levels": ["year", "month", "day"]},
+                {"name": "country"}
+            ]
+        }
+
+        rows = self.engine.execute(self.facts.select()).fetchall()
+        months = sorted(set((row["year"], row["month"]) for row in rows))
+        for year, month in months:
+            table = Table("sales_%d_%02d" % (year, month), self.metadata,
+                          *[Column(c.name, c.type) for c in self.facts.c])
+            table.create()
+            self.load_data(table, [tuple(row) for row in rows
+                                   if (row["year"], row["month"])
+                                        == (year, month)])
+
+        workspace = self.create_workspace(model=model)
+        browser = workspace.browser("sales")
+        schema = browser.snowflake_schema()
+        self.assertEqual(8, len(schema.partitions))
+
+        result = browser.aggregate()
+        self.assertEqual(5550, result.summary["amount_sum"])
+
+        cell = Cell(browser.cube, [PointCut("date", ["2012", "2"])])
+        self.assertEqual(["sales_2012_02"], schema.partition_tables(cell))
+        result = browser.aggregate(cell, drilldown=["country"])
+        self.assertEqual(20, result.summary["amount_sum"])
+        self.assertEqual([("at", 10), ("sk", 10)],
+                         [(c["country"], c["amount_sum"])
+                          for c in result.cells])
+
+        # Same statement shape, different partition
+        cell = Cell(browser.cube, [PointCut("date", [2013, 1])])
+        result = browser.aggregate(cell, drilldown=["country"])
+        self.assertEqual([("fr", 2000)],
+                         [(c["country"], c["amount_sum"])
+                          for c in result.cells])
+        self.assertEqual(2, len(list(browser.facts(cell))))
+
+        cut = RangeCut("date", [2012, 4], [2013, 1])
+        cell = Cell(browser.cube, [cut])
+        self.assertEqual(["sales_2012_04", "sales_2012_05", "sales_2013_01"],
+                         schema.partition_tables(cell))
+        result = browser.aggregate(cell)
+        self.assertEqual(2400, result.summary["amount_sum"])
+
+        cut = SetCut("date", [[2012, 1], [2013]])
+        cell = Cell(browser.cube, [cut])
+        self.assertEqual(4, len(schema.partition_tables(cell)))
+        result = browser.aggregate(cell, drilldown=["date"])
+        self.assertEqual([(2012, 20), (2013, 5000)],
+                         [(c["date.year"], c["amount_sum"])
+                          for c in result.cells])
+
+        # Inverted cuts read all the partitions
+        cell = Cell(browser.cube, [PointCut("date", [2012], invert=True)])
+        self.assertEqual(8, len(schema.partition_tables(cell)))
+        result = browser.aggregate(cell)
+        self.assertEqual(5000, result.summary["amount_sum"])
+
+        cell = Cell(browser.cube, [PointCut("date", [2014])])
+        self.assertEqual([], schema.partition_tables(cell))
+        result = browser.aggregate(cell)
+        self.assertEqual(None, result.summary["amount_sum"])
+
+        # New partition is found after refresh
+        table = Table("sales_2014_01", self.metadata,
+                      *[Column(c.name, c.type) for c in self.facts.c])
+        table.create()
+        row = dict(rows[0])
+        row.update(id=100, year=2014, month=1, amount=7)
+        self.engine.execute(table.insert().values(row))
+
+        self.assertEqual([], schema.partition_tables(cell))
+        browser.store.refresh_partitions("sales")
+        self.assertEqual(["sales_2014_01"], schema.partition_tables(cell))
+        result = browser.aggregate(cell)
+        self.assertEqual(7, result.summary["amount_sum"])
+
+        # ... or when the refresh interval elapsed
+        table = Table("sales_2014_02", self.metadata,
+                      *[Column(c.name, c.type) for c in self.facts.c])
+        table.create()
+        self.assertEqual(9, len(schema.partition_tables(None)))
+        schema.partition_refresh = 0
+        self.assertEqual(10, len(schema.partition_tables(None)))
+
+    def test_page_token(self):
+        values = [1, u"sk", datetime.date(2014, 1, 2),
+                  datetime.datetime(2014, 1, 2, 3, 4, 5)]
+        token = page_token(["a", "b", "c", "d"], values)
+        self.assertEqual(values,
+                         page_token_values(token, ["a", "b", "c", "d"]))
+
+    def test_tablesample(self):
+        from sqlalchemy.dialects import mssql, postgresql
+        from cubes.backends.sql.utils import SampledTable, tablesample_clause
+
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (9, 6)
+        clause = tablesample_clause(dialect, 0.01)
+        self.assertEqual("TABLESAMPLE BERNOULLI (1)", clause)
+        self.assertIsNone(tablesample_clause(self.browser.connectable.dialect,
+                                             0.01))
+        # Pages are sampled, not rows
+        self.assertIsNone(tablesample_clause(mssql.dialect(), 0.01))
+
+        sampled = SampledTable(self.facts, clause)
+        statement = sqlalchemy.select([self.facts.c.amount])
+        statement = statement.replace_selectable(self.facts, sampled)
+        self.assertIn("FROM facts AS facts TABLESAMPLE BERNOULLI (1)",
+                      str(statement.compile(dialect=dialect)))
+
+    def test_sample_text_key(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "key": "country",
+                    "dimensions": ["country"],
+                    "measures": ["amount"]
+                }
+            ],
+            "dimensions": [{"name": "country"}]
+        }
+        workspace = self.create_workspace(model=model)
+        browser = workspace.browser("facts")
+
+        with self.assertRaises(ArgumentError):
+            browser.aggregate(sample=0.5)
+        self.assertEqual(5550, browser.aggregate().summary["amount_sum"])
+
     # test_drilldown_pagination
     # test_split
     # test_drilldown_selected_attributes
@@ -0,0 +1,115 @@
+import unittest
+
+from ...common import CubesTestCaseBase
+from sqlalchemy import Table, Column, Integer, String, Index
+
+from cubes.backends.sql.indexes import *
+from cubes.backends.sql.logging import SQLRequestLogHandler
+from cubes import *
+
+
+class IndexAdvisorTestCase(CubesTestCaseBase):
+    sql_engine = "sqlite:///"
+
+    def setUp(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "dimensions": ["date", "product"],
+                    "measures": ["amount"],
+                    "joins": [
+                        {"master": "facts.product_id",
+                         "detail": "dim_product.id"}
+                    ],
+                    "mappings": {
+                        "date.year": "year",
+                        "date.month": "month",
+                        "product.category": "dim_product.category",
+                        "product.product": "dim_product.code"
+                    }
+                }
+            ],
+            "dimensions": [
+                {
+                    "name": "date",
+                    "levels": ["year", "month"]
+                },
+                {
+                    "name": "product",
+                    "levels": ["category", "product"]
+                }
+            ]
+        }
+
+        super(IndexAdvisorTestCase, self).setUp()
+        self.facts = Table("facts", self.metadata,
+                        Column("id", Integer),
+                        Column("year", Integer),
+                        Column("month", Integer),
+                        Column("product_id", Integer),
+                        Column("amount", Integer)
+                        )
+        self.products = Table("dim_product", self.metadata,
+                        Column("id", Integer, primary_key=True),
+                        Column("category", String),
+                        Column("code", String)
+                        )
+        self.metadata.create_all()
+
+        self.workspace = self.create_workspace(model=model)
+        self.store = self.workspace.get_store("default")
+        self.cube = self.workspace.cube("facts")
+
+        self.log = SQLRequestLogHandler(url="sqlite:///", table="requests",
+                                        dimensions_table="request_dimensions")
+
+    def log_query(self, cell, drilldown, count, elapsed):
+        for i in range(count):
+            record = {"method": "aggregate", "cube": "facts",
+                      "drilldown": drilldown, "elapsed_time": elapsed}
+            self.log.write_record(self.cube, cell, record)
+
+    def test_query_uses(self):
+        cell = Cell(self.cube, [PointCut("date", [2012])])
+        self.log_query(cell, ["product"], 3, 2.0)
+
+        uses = self.log.query_uses("facts")
+        self.assertEqual(1, len(uses))
+        (levels, count, elapsed) = uses[0]
+        self.assertItemsEqual([("date", None, "year", "cell"),
+                               ("product", "default", "category",
+                                "drilldown")], levels)
+        self.assertEqual(3, count)
+        self.assertAlmostEqual(6.0, elapsed)
+
+    def test_recommend(self):
+        cell = Cell(self.cube, [PointCut("date", [2012])])
+        self.log_query(cell, ["product"], 3, 2.0)
+
+        cell = Cell(self.cube, [PointCut("product", ["a", "b"])])
+        self.log_query(cell, ["date"], 1, 10.0)
+
+        indexes = self.store.recommend_indexes(self.cube, self.log)
+        self.assertEqual([("dim_product", ["category", "code"], 10.0, 1),
+                          ("facts", ["product_id", "year"], 10.0, 1),
+                          ("facts", ["year", "product_id"], 6.0, 3)],
+                         [(index.table, index.columns, index.elapsed_time,
+                           index.queries) for index in indexes])
+
+        advisor = IndexAdvisor(self.store, self.cube)
+        ddl = advisor.ddl(indexes[1])
+        self.assertIn("CREATE INDEX idx_facts_product_id_year", ddl)
+        self.assertIn("(product_id, year)", ddl)
+
+        indexes = self.store.recommend_indexes(self.cube, self.log, limit=1)
+        self.assertEqual(["dim_product"], [index.table for index in indexes])
+
+        # Covered by an existing index
+        index = Index("idx_category", self.products.c.category,
+                      self.products.c.code, self.products.c.id)
+        index.create(self.engine)
+
+        indexes = self.store.recommend_indexes(self.cube, self.log)
+        self.assertEqual(["facts", "facts"],
+                         [index.table for index in indexes])
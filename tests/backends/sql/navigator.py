@@ -0,0 +1,353 @@
+import unittest
+
+from ...common import CubesTestCaseBase
+from sqlalchemy import Table, Column, Integer, String, Date
+from datetime import date
+
+from cubes.backends.sql.navigator import *
+from cubes.backends.sql.browser import SnowflakeBrowser
+from cubes import *
+
+
+class AggregateNavigatorTestCase(CubesTestCaseBase):
+    sql_engine = "sqlite:///"
+
+    def setUp(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "dimensions": ["date", "country"],
+                    "measures": ["amount"],
+                    "aggregates": [
+                        {"name": "amount_sum", "function": "sum",
+                         "measure": "amount"},
+                        {"name": "amount_min", "function": "min",
+                         "measure": "amount"},
+                        {"name": "amount_avg", "function": "avg",
+                         "measure": "amount"},
+                        {"name": "record_count", "function": "count"}
+                    ]
+                }
+            ],
+            "dimensions": [
+                {
+                    "name": "date",
+                    "levels": ["year", "month", "day"]
+                },
+                {
+                    "name": "country",
+                },
+            ],
+            "mappings": {
+                "date.year": "year",
+                "date.month": "month",
+                "date.day": "day"
+            }
+        }
+
+        super(AggregateNavigatorTestCase, self).setUp()
+        self.facts = Table("facts", self.metadata,
+                        Column("id", Integer),
+                        Column("year", Integer),
+                        Column("month", Integer),
+                        Column("day", Integer),
+                        Column("country", String),
+                        Column("amount", Integer)
+                        )
+
+        self.metadata.create_all()
+        data = [
+                ( 1,2012,1,1,"sk",10),
+                ( 2,2012,1,2,"sk",20),
+                ( 3,2012,2,3,"sk",10),
+                ( 4,2012,2,4,"at",10),
+                ( 5,2012,3,5,"at",10),
+                ( 6,2013,1,1,"fr",1000),
+                ( 7,2013,1,2,"fr",500),
+                ( 8,2013,2,3,"fr",1000)
+            ]
+        self.load_data(self.facts, data)
+
+        self.workspace = self.create_workspace(model=model)
+        self.store = self.workspace.get_store("default")
+        self.cube = self.workspace.cube("facts")
+
+        self.browser = self.workspace.browser("facts")
+        self.agg_browser = SnowflakeBrowser(self.cube, self.store,
+                                            use_aggregates=True)
+
+    def test_create_cuboid(self):
+        cuboid = self.store.create_cuboid(self.cube, [("date", "month")])
+
+        self.assertEqual("facts_date_month", cuboid.table)
+        self.assertEqual(5, cuboid.row_count)
+        self.assertItemsEqual(["date.year", "date.month"], cuboid.attributes)
+        self.assertItemsEqual(["amount_sum", "amount_min", "record_count"],
+                              cuboid.aggregates)
+
+        cuboids = self.store.aggregate_registry.cuboids("facts")
+        self.assertEqual(1, len(cuboids))
+        self.assertEqual("facts_date_month", cuboids[0].table)
+
+        # Registry is persistent
+        self.store.flush_cache()
+        cuboids = self.store.aggregate_registry.cuboids("facts")
+        self.assertEqual(1, len(cuboids))
+        self.assertEqual(5, cuboids[0].row_count)
+
+        with self.assertRaises(WorkspaceError):
+            self.store.create_cuboid(self.cube, [("date", "month")])
+
+        self.store.create_cuboid(self.cube, [("date", "month")], replace=True)
+        cuboids = self.store.aggregate_registry.cuboids("facts")
+        self.assertEqual(1, len(cuboids))
+
+    def test_create_cube_aggregate(self):
+        cuboids = self.store.create_cube_aggregate(self.cube)
+        # date levels x country + date levels + country
+        self.assertEqual(7, len(cuboids))
+        self.assertEqual(7, len(self.store.aggregate_registry.cuboids("facts")))
+
+    def test_aggregate_from_cuboid(self):
+        drilldown = [("date", None, "year")]
+        aggregates = ["amount_sum", "amount_min", "record_count"]
+        expected = self.browser.aggregate(drilldown=drilldown,
+                                          aggregates=aggregates)
+        expected_cells = list(expected.cells)
+
+        self.store.create_cuboid(self.cube, [("date", "month")])
+
+        # Remove the facts - results should come from the aggregate table
+        self.engine.execute(self.facts.delete())
+
+        result = self.agg_browser.aggregate(drilldown=drilldown,
+                                            aggregates=aggregates)
+        self.assertEqual(expected.summary, result.summary)
+        self.assertEqual(list(result.cells), expected_cells)
+        self.assertEqual(2, result.total_cell_count)
+        self.assertEqual(["date.year", "amount_sum", "amount_min",
+                          "record_count"], result.labels)
+        self.assertIs(self.cube, result.cell.cube)
+
+        cell = Cell(self.cube, [PointCut("date", [2012])])
+        result = self.agg_browser.aggregate(cell, drilldown=["date"],
+                                            aggregates=aggregates,
+                                            order=[("amount_sum", "desc")])
+        cells = list(result.cells)
+        self.assertEqual([30, 20, 10], [c["amount_sum"] for c in cells])
+        self.assertEqual([1, 2, 3], [c["date.month"] for c in cells])
+        self.assertEqual(60, result.summary["amount_sum"])
+
+        # Not covered: country is not in the cuboid, avg can not be rolled up
+        result = self.agg_browser.aggregate(drilldown=["country"],
+                                            aggregates=aggregates)
+        self.assertEqual([], list(result.cells))
+        result = self.agg_browser.aggregate(aggregates=["amount_avg"])
+        self.assertIsNone(result.summary["amount_avg"])
+
+    def test_registry_refresh(self):
+        registry = self.store.aggregate_registry
+        self.assertEqual([], registry.cuboids(self.cube))
+
+        # Cuboid created by another process
+        other = AggregateRegistry(self.engine, registry.table_name)
+        cuboid = MaterializedCuboid("facts", "facts_agg", [["date", "year"]],
+                                    ["date.year"], ["amount_sum"])
+        other.register(cuboid)
+
+        registry.refresh = None
+        self.assertEqual([], registry.cuboids(self.cube))
+
+        registry.refresh = 0
+        cuboids = registry.cuboids(self.cube)
+        self.assertEqual(["facts_agg"], [c.table for c in cuboids])
+
+        # ... and dropped by it
+        other.unregister("facts")
+        self.assertEqual([], registry.cuboids(self.cube))
+
+    def test_smallest_cuboid(self):
+        self.store.create_cuboid(self.cube, [("date", "day")])
+        self.store.create_cuboid(self.cube, [("date", "month")])
+        self.store.create_cuboid(self.cube, [("date", "year"),
+                                             ("country", "country")])
+
+        navigator = self.agg_browser.navigator
+        aggregates = self.cube.get_aggregates(["amount_sum"])
+        cell = Cell(self.cube)
+
+        def find(drilldown, cell=cell, aggregates=aggregates):
+            cuboid = navigator.find_cuboid(cell, Drilldown(drilldown, cell),
+                                           aggregates)
+            return cuboid.table if cuboid else None
+
+        self.assertEqual("facts_date_year_country_country", find(["date"]))
+        self.assertEqual("facts_date_month",
+                         find([("date", None, "month")]))
+        self.assertEqual("facts_date_year_country_country", find(["country"]))
+        self.assertEqual("facts_date_day",
+                         find([("date", None, "day")]))
+
+        cell = Cell(self.cube, [PointCut("date", [2012, 1, 1])])
+        self.assertEqual("facts_date_day", find([], cell))
+
+        aggregates = self.cube.get_aggregates(["amount_avg"])
+        self.assertIsNone(find(["date"], aggregates=aggregates))
+
+    def append_facts(self, data):
+        for row in data:
+            self.engine.execute(self.facts.insert().values(row))
+
+    def assertCuboidsEqualFacts(self, drilldowns):
+        aggregates = ["amount_sum", "amount_min", "record_count"]
+        plain = SnowflakeBrowser(self.cube, self.store, use_aggregates=False)
+
+        for drilldown in drilldowns:
+            expected = plain.aggregate(drilldown=drilldown,
+                                       aggregates=aggregates)
+            result = self.agg_browser.aggregate(drilldown=drilldown,
+                                                aggregates=aggregates)
+            self.assertEqual(expected.summary, result.summary)
+            self.assertEqual(list(expected.cells), list(result.cells))
+
+    def test_refresh_appended_facts(self):
+        self.store.create_cuboid(self.cube, [("date", "month")])
+        self.store.create_cuboid(self.cube, [("country", "country")])
+        self.store.create_cuboid(self.cube, [])
+
+        registry = self.store.aggregate_registry
+        self.assertEqual(8, registry.watermark("facts", "facts_date_month"))
+
+        data = [
+                ( 9,2012,3,6,"at",5),
+                (10,2013,3,1,"de",7)
+            ]
+        self.append_facts(data)
+
+        cuboids = self.store.refresh_cube_aggregate(self.cube)
+        self.assertEqual(3, len(cuboids))
+        self.assertEqual(10, registry.watermark("facts", "facts_date_month"))
+        self.assertEqual(10, registry.watermark("facts", "facts_all"))
+
+        counts = dict((c.table, c.row_count) for c in registry.cuboids("facts"))
+        self.assertEqual(6, counts["facts_date_month"])
+        self.assertEqual(4, counts["facts_country_country"])
+
+        self.assertCuboidsEqualFacts([["date"], [("date", None, "month")],
+                                      ["country"], []])
+
+        # Nothing new - nothing is merged again
+        self.store.refresh_cube_aggregate(self.cube)
+        self.assertCuboidsEqualFacts([[("date", None, "month")]])
+
+        # Facts up to explicit watermark only
+        self.append_facts([(11,2012,1,1,"sk",1),
+                           (12,2012,1,1,"sk",100)])
+        self.store.refresh_cube_aggregate(self.cube, watermark=11)
+        self.assertEqual(11, registry.watermark("facts", "facts_all"))
+
+        result = self.agg_browser.aggregate(aggregates=["amount_sum"])
+        self.assertEqual(2573, result.summary["amount_sum"])
+
+    def test_refresh_cell(self):
+        self.store.create_cuboid(self.cube, [("date", "month")])
+        self.store.create_cuboid(self.cube, [("country", "country")])
+
+        # Restate 2013 and load a fact that was not merged yet
+        self.engine.execute(self.facts.update(self.facts.c.year == 2013),
+                            amount=1)
+        self.engine.execute(self.facts.delete(self.facts.c.id == 8))
+        self.append_facts([(9,2013,3,1,"fr",2)])
+
+        cell = Cell(self.cube, [PointCut("date", [2013])])
+        self.store.refresh_cube_aggregate(self.cube, cell)
+
+        registry = self.store.aggregate_registry
+        self.assertEqual(8, registry.watermark("facts", "facts_date_month"))
+
+        result = self.agg_browser.aggregate(aggregates=["amount_sum"])
+        self.assertEqual(62, result.summary["amount_sum"])
+        result = self.agg_browser.aggregate(drilldown=["country"],
+                                            aggregates=["amount_sum"])
+        self.assertEqual(62, result.summary["amount_sum"])
+
+        self.store.refresh_cube_aggregate(self.cube)
+        self.assertCuboidsEqualFacts([["date"], [("date", None, "month")],
+                                      ["country"]])
+
+
+class DateWatermarkTestCase(CubesTestCaseBase):
+    sql_engine = "sqlite:///"
+
+    def setUp(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "dimensions": ["country"],
+                    "measures": ["amount"],
+                    "aggregates": [
+                        {"name": "amount_sum", "function": "sum",
+                         "measure": "amount"},
+                        {"name": "amount_max", "function": "max",
+                         "measure": "amount"}
+                    ],
+                    "browser_options": {
+                        "aggregates_watermark": "loaded"
+                    }
+                }
+            ],
+            "dimensions": [{"name": "country"}]
+        }
+
+        super(DateWatermarkTestCase, self).setUp()
+        self.facts = Table("facts", self.metadata,
+                        Column("id", Integer),
+                        Column("loaded", Date),
+                        Column("country", String),
+                        Column("amount", Integer)
+                        )
+
+        self.metadata.create_all()
+        data = [
+                (1, date(2013, 1, 1), "sk", 10),
+                (2, date(2013, 1, 1), "at", 20),
+                (3, date(2013, 1, 2), None, 5)
+            ]
+        self.load_data(self.facts, data)
+
+        self.workspace = self.create_workspace(model=model)
+        self.store = self.workspace.get_store("default")
+        self.cube = self.workspace.cube("facts")
+
+    def test_refresh_date_watermark(self):
+        self.store.create_cuboid(self.cube, [("country", "country")])
+
+        registry = self.store.aggregate_registry
+        self.assertEqual(date(2013, 1, 2),
+                         registry.watermark("facts", "facts_country_country"))
+
+        for row in [(4, date(2013, 1, 3), "sk", 30),
+                    (5, date(2013, 1, 3), None, 1),
+                    (6, date(2013, 1, 4), "de", 7)]:
+            self.engine.execute(self.facts.insert().values(row))
+
+        self.store.refresh_cube_aggregate(self.cube)
+        self.assertEqual(date(2013, 1, 4),
+                         registry.watermark("facts", "facts_country_country"))
+
+        # Nothing new
+        self.store.refresh_cube_aggregate(self.cube)
+
+        browser = SnowflakeBrowser(self.cube, self.store,
+                                   use_aggregates=True)
+        result = browser.aggregate(drilldown=["country"])
+        cells = dict((cell["country"], cell) for cell in result.cells)
+
+        self.assertEqual(73, result.summary["amount_sum"])
+        self.assertEqual(40, cells["sk"]["amount_sum"])
+        self.assertEqual(30, cells["sk"]["amount_max"])
+        self.assertEqual(6, cells[None]["amount_sum"])
+        self.assertEqual(7, cells["de"]["amount_sum"])
+        self.assertEqual(4, len(cells))
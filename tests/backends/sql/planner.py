@@ -0,0 +1,157 @@
+import unittest
+import random
+
+from ...common import CubesTestCaseBase
+from sqlalchemy import Table, Column, Integer, String
+
+from cubes.backends.sql.planner import *
+from cubes.backends.sql.logging import SQLRequestLogHandler
+from cubes import *
+
+
+class CuboidSelectionTestCase(unittest.TestCase):
+    def test_estimate_distinct_count(self):
+        self.assertEqual(3, estimate_distinct_count([2, 1, 1], 4, 4))
+        # Values seen more than once are assumed to be all of them
+        self.assertEqual(2, estimate_distinct_count([50, 50], 100, 10000))
+        # Singletons are scaled by square root of the sampling ratio
+        self.assertEqual(1000, estimate_distinct_count([1] * 100, 100, 10000))
+        self.assertEqual(122, estimate_distinct_count([1] * 100, 100, 150))
+
+    def test_greedy_selection(self):
+        candidates = [
+            ("day", {"date": 3}, 900),
+            ("month", {"date": 2}, 30),
+            ("year", {"date": 1}, 3),
+            ("country", {"country": 1}, 10)
+        ]
+
+        selected = greedy_cuboid_selection(candidates, 1000)
+        self.assertEqual(["year", "country", "month", "day"],
+                         [key for key, size, benefit in selected])
+
+        selected = greedy_cuboid_selection(candidates, 1000, budget=35)
+        self.assertEqual(["year", "country"],
+                         [key for key, size, benefit in selected])
+
+        selected = greedy_cuboid_selection(candidates, 1000, max_cuboids=1)
+        self.assertEqual(["year"], [key for key, size, benefit in selected])
+
+        queries = [({"country": 1}, 100), ({"date": 1}, 1)]
+        selected = greedy_cuboid_selection(candidates, 1000, queries=queries)
+        self.assertEqual(["country", "year"],
+                         [key for key, size, benefit in selected])
+
+
+class CuboidPlannerTestCase(CubesTestCaseBase):
+    sql_engine = "sqlite:///"
+
+    def setUp(self):
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "dimensions": ["date", "country", "product"],
+                    "measures": ["amount"],
+                    "aggregates": [
+                        {"name": "amount_sum", "function": "sum",
+                         "measure": "amount"},
+                        {"name": "record_count", "function": "count"}
+                    ]
+                }
+            ],
+            "dimensions": [
+                {
+                    "name": "date",
+                    "levels": ["year", "month", "day"]
+                },
+                {"name": "country"},
+                {"name": "product"}
+            ],
+            "mappings": {
+                "date.year": "year",
+                "date.month": "month",
+                "date.day": "day"
+            }
+        }
+
+        super(CuboidPlannerTestCase, self).setUp()
+        self.facts = Table("facts", self.metadata,
+                        Column("id", Integer),
+                        Column("year", Integer),
+                        Column("month", Integer),
+                        Column("day", Integer),
+                        Column("country", String),
+                        Column("product", Integer),
+                        Column("amount", Integer)
+                        )
+
+        self.metadata.create_all()
+        rnd = random.Random(0)
+        data = []
+        for i in range(1, 401):
+            data.append((i, rnd.choice([2012, 2013]), rnd.randint(1, 12),
+                         rnd.randint(1, 28), rnd.choice("abcd"), rnd.randint(0, 99), i))
+        self.load_data(self.facts, data)
+
+        self.workspace = self.create_workspace(model=model)
+        self.store = self.workspace.get_store("default")
+        self.cube = self.workspace.cube("facts")
+
+    def test_estimate_sizes(self):
+        planner = CuboidPlanner(self.store, self.cube, sample_size=100)
+        candidates = [{"date": 1}, {"country": 1}, {"date": 2},
+                      {"product": 1}]
+        sizes = planner.estimate_sizes(candidates, 400)
+        self.assertEqual([2, 4, 12], sizes[0:3])
+        # 100 products, many of them seen only once in the sample
+        self.assertGreater(sizes[3], 80)
+        self.assertLessEqual(sizes[3], 400)
+
+    def test_plan(self):
+        plan = self.store.plan_cube_aggregate(self.cube, max_dimensions=2)
+        self.assertEqual("facts", plan.cube)
+        self.assertEqual(400, plan.fact_count)
+        self.assertTrue(len(plan) > 0)
+        for cuboid in plan:
+            self.assertLessEqual(len(cuboid.levels), 2)
+            self.assertLess(cuboid.estimated_rows, 400)
+
+        plan = self.store.plan_cube_aggregate(self.cube, budget=20)
+        self.assertLessEqual(plan.estimated_rows, 20)
+        self.assertIn([("date", "year")], plan.levels())
+
+        cuboids = self.store.create_cube_aggregate(self.cube, plan=plan)
+        self.assertEqual(len(plan), len(cuboids))
+        registered = self.store.aggregate_registry.cuboids("facts")
+        self.assertItemsEqual([c.table for c in cuboids],
+                              [c.table for c in registered])
+
+    def test_plan_from_request_log(self):
+        log = SQLRequestLogHandler(url="sqlite:///", table="requests",
+                                   dimensions_table="request_dimensions")
+
+        def log_query(cell, drilldown, count):
+            for i in range(count):
+                record = {"method": "aggregate", "cube": "facts",
+                          "drilldown": drilldown}
+                log.write_record(self.cube, cell, record)
+
+        cell = Cell(self.cube, [PointCut("date", [2012])])
+        log_query(cell, ["date"], 10)
+        log_query(Cell(self.cube), [("product", None, "product")], 3)
+        log_query(cell, ["country"], 1)
+
+        usage = dict(log.level_usage("facts"))
+        self.assertEqual(10, usage[(("date", None, "year"),
+                                    ("date", "default", "month"))])
+
+        plan = self.store.plan_cube_aggregate(self.cube, request_log=log,
+                                              max_dimensions=1)
+        levels = plan.levels()
+        self.assertIn([("date", "month")], levels)
+        self.assertIn([("date", "year"), ("country", "country")], levels)
+
+        plan = self.store.plan_cube_aggregate(self.cube, request_log=log,
+                                              max_cuboids=1)
+        self.assertEqual([[("date", "month")]], plan.levels())
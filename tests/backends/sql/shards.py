@@ -0,0 +1,180 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from ...common import CubesTestCaseBase
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+
+from cubes.backends.sql.shards import *
+from cubes import *
+
+
+class ShardedBrowserTestCase(CubesTestCaseBase):
+    def setUp(self):
+        super(ShardedBrowserTestCase, self).setUp()
+
+        model = {
+            "cubes": [
+                {
+                    "name": "facts",
+                    "dimensions": ["date", "country"],
+                    "measures": ["amount"],
+                    "aggregates": [
+                        {"name": "amount_sum", "function": "sum",
+                         "measure": "amount"},
+                        {"name": "amount_min", "function": "min",
+                         "measure": "amount"},
+                        {"name": "amount_max", "function": "max",
+                         "measure": "amount"},
+                        {"name": "amount_avg", "function": "avg",
+                         "measure": "amount"},
+                        {"name": "record_count", "function": "count"}
+                    ],
+                    "mappings": {
+                        "date.year": "year",
+                        "date.month": "month"
+                    }
+                }
+            ],
+            "dimensions": [
+                {"name": "date", "levels": ["year", "month"]},
+                {"name": "country"}
+            ]
+        }
+
+        shards = [
+            [(1, 2012, 1, "sk", 10),
+             (2, 2012, 2, "sk", 20),
+             (3, 2013, 1, "at", 30)],
+            [(1, 2012, 1, "sk", 5),
+             (2, 2013, 1, "fr", 40)]
+        ]
+
+        self.directory = tempfile.mkdtemp()
+        urls = []
+        for i, data in enumerate(shards):
+            url = "sqlite:///%s" % os.path.join(self.directory,
+                                                "shard%d.db" % i)
+            engine = create_engine(url)
+            metadata = MetaData(bind=engine)
+            table = Table("facts", metadata,
+                          Column("id", Integer),
+                          Column("year", Integer),
+                          Column("month", Integer),
+                          Column("country", String),
+                          Column("amount", Integer))
+            metadata.create_all()
+            for row in data:
+                engine.execute(table.insert().values(row))
+            urls.append(url)
+
+        store = {"type": "sharded_sql", "shards": " ".join(urls)}
+        self.workspace = self.create_workspace(store=store, model=model)
+        self.browser = self.workspace.browser("facts")
+        self.cube = self.browser.cube
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_browser(self):
+        self.assertIsInstance(self.browser, ShardedBrowser)
+        self.assertEqual(2, len(self.browser.browsers))
+
+    def test_aggregate(self):
+        result = self.browser.aggregate(drilldown=["date"])
+
+        summary = result.summary
+        self.assertEqual(105, summary["amount_sum"])
+        self.assertEqual(5, summary["record_count"])
+        self.assertEqual(5, summary["amount_min"])
+        self.assertEqual(40, summary["amount_max"])
+        self.assertAlmostEqual(21.0, summary["amount_avg"])
+        self.assertNotIn("__amount_avg_sum", summary)
+
+        cells = list(result.cells)
+        self.assertEqual(2, result.total_cell_count)
+        self.assertEqual([2012, 2013], [c["date.year"] for c in cells])
+        self.assertEqual([35, 70], [c["amount_sum"] for c in cells])
+        self.assertEqual([3, 2], [c["record_count"] for c in cells])
+        self.assertEqual([5, 30], [c["amount_min"] for c in cells])
+        self.assertEqual([20, 40], [c["amount_max"] for c in cells])
+        self.assertAlmostEqual(35.0 / 3, cells[0]["amount_avg"])
+        self.assertAlmostEqual(35.0, cells[1]["amount_avg"])
+
+        cell = Cell(self.cube, [PointCut("date", [2013])])
+        result = self.browser.aggregate(cell)
+        self.assertEqual(70, result.summary["amount_sum"])
+
+    def test_aggregate_order_and_page(self):
+        result = self.browser.aggregate(drilldown=["country"],
+                                        order=[("amount_sum", "desc")],
+                                        page=0, page_size=2)
+        self.assertEqual(3, result.total_cell_count)
+        self.assertEqual([("fr", 40), ("sk", 35)],
+                         [(c["country"], c["amount_sum"])
+                          for c in result.cells])
+
+    def test_aggregate_high_cardinality_page(self):
+        self.cube.dimension("country").cardinality = "high"
+
+        with self.assertRaises(ArgumentError):
+            self.browser.aggregate(drilldown=["country"])
+
+        requests = []
+        def recorded(aggregate):
+            def wrapper(*args, **kwargs):
+                requests.append((kwargs.get("page"), kwargs.get("page_size")))
+                return aggregate(*args, **kwargs)
+            return wrapper
+
+        for browser in self.browser.browsers:
+            browser.aggregate = recorded(browser.aggregate)
+
+        result = self.browser.aggregate(drilldown=["country"],
+                                        page=0, page_size=2)
+        self.assertIsNone(result.total_cell_count)
+        self.assertEqual([("at", 30), ("fr", 40)],
+                         [(c["country"], c["amount_sum"])
+                          for c in result.cells])
+
+        result = self.browser.aggregate(drilldown=["country"],
+                                        order=[("country", "desc")],
+                                        page=1, page_size=2)
+        self.assertEqual([("at", 30, 1)],
+                         [(c["country"], c["amount_sum"], c["record_count"])
+                          for c in result.cells])
+
+        result = self.browser.aggregate(drilldown=["country"],
+                                        page=0, page_size=1)
+        self.assertEqual([("at", 30)],
+                         [(c["country"], c["amount_sum"])
+                          for c in result.cells])
+
+        # Shards return only the cells up to the requested page
+        self.assertEqual([(0, 2)] * 2 + [(0, 4)] * 2 + [(0, 1)] * 2, requests)
+
+        # Merged order by aggregates is not known from the first pages
+        with self.assertRaises(ArgumentError):
+            self.browser.aggregate(drilldown=["country"],
+                                   order=[("amount_sum", "desc")],
+                                   page=0, page_size=2)
+
+    def test_facts(self):
+        facts = self.browser.facts(order=["amount"], page=1, page_size=2)
+        self.assertEqual([20, 30], [f["amount"] for f in facts])
+
+        facts = self.browser.facts(order=[("amount", "desc")])
+        self.assertEqual([40, 30, 20, 10, 5], [f["amount"] for f in facts])
+
+        self.assertEqual(5, len(list(self.browser.facts())))
+
+    def test_members(self):
+        members = self.browser.members(None, "country")
+        self.assertEqual(["at", "fr", "sk"], [m["country"] for m in members])
+
+    def test_merge_records(self):
+        records = [{"a": 1, "b": 2, "key": "x"},
+                   {"a": 3, "b": None, "key": "x"}]
+        merged = merge_records(records, {"a": "sum", "b": "max"})
+        self.assertEqual({"a": 4, "b": 2, "key": "x"}, merged)
@@ -1,9 +1,12 @@
+from __future__ import absolute_import
+
 import unittest
+import time
 
 from cubes.browser import *
 from cubes.errors import *
 
-from common import CubesTestCaseBase
+from .common import CubesTestCaseBase
 
 
 class CutsTestCase(CubesTestCaseBase):
@@ -251,10 +254,113 @@ class AggregationBrowserTestCase(BrowserTestCase):
         self.assertEqual([2010, 1, 2], cell.cut_for_dimension("date").path)
 
 
+class ReportTestBrowser(AggregationBrowser):
+    """Browser with queries that take `delay` seconds or fail. Queries
+    are cancelled after `timeout` seconds."""
+    def __init__(self, cube):
+        super(ReportTestBrowser, self).__init__(cube)
+        self.timeouts = []
+
+    def features(self):
+        return {"query_options": ["timeout"]}
+
+    def aggregate(self, cell=None, delay=0, fail=None, timeout=None,
+                  **options):
+        self.timeouts.append(timeout)
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            raise QueryTimeoutError("Query cancelled")
+        time.sleep(delay)
+        if fail:
+            raise fail("Query failed")
+        return iter([{"delay": delay}])
+
+
+class ReportTestCase(BrowserTestCase):
+    def setUp(self):
+        super(ReportTestCase, self).setUp()
+        self.browser = ReportTestBrowser(self.cube)
+        self.cell = Cell(self.cube)
+
+    def test_concurrent_report(self):
+        queries = dict(("q%d" % i, {"query": "aggregate", "delay": 0.2})
+                       for i in range(6))
+
+        start = time.time()
+        result = self.browser.report(self.cell, queries, workers=6)
+        self.assertLess(time.time() - start, 1.0)
+
+        self.assertItemsEqual(queries.keys(), result.keys())
+        # Lazy results are fetched
+        self.assertEqual([{"delay": 0.2}], result["q0"])
+
+    def test_error_isolation(self):
+        queries = {
+            "ok": {"query": "aggregate"},
+            "user": {"query": "aggregate", "fail": ArgumentError},
+            "internal": {"query": "aggregate", "fail": ValueError}
+        }
+
+        for workers in [1, 2]:
+            result = self.browser.report(self.cell, queries, workers=workers)
+            self.assertEqual([{"delay": 0}], result["ok"])
+            self.assertEqual(ArgumentError.error_type,
+                             result["user"]["error"])
+            self.assertEqual("Query failed", result["user"]["message"])
+            self.assertEqual("internal_error", result["internal"]["error"])
+
+        with self.assertRaises(ArgumentError):
+            self.browser.report(self.cell, {"bad": {"query": "unknown"}},
+                                workers=2)
+
+    def test_report_deadline(self):
+        queries = {
+            "fast": {"query": "aggregate"},
+            "slow": {"query": "aggregate", "delay": 2}
+        }
+
+        start = time.time()
+        result = self.browser.report(self.cell, queries, workers=2,
+                                     timeout=0.2)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([{"delay": 0}], result["fast"])
+        self.assertEqual("timeout", result["slow"]["error"])
+
+        # Queries get the time left until the deadline
+        self.assertEqual(2, len(self.browser.timeouts))
+        for timeout in self.browser.timeouts:
+            self.assertGreater(timeout, 0)
+            self.assertLessEqual(timeout, 0.2)
+
+    def test_sequential_report_deadline(self):
+        queries = {
+            "fast": {"query": "aggregate"},
+            "limited": {"query": "aggregate", "delay": 2, "timeout": 0.1}
+        }
+
+        start = time.time()
+        result = self.browser.report(self.cell, queries, workers=1,
+                                     timeout=0.5)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual([{"delay": 0}], result["fast"])
+        self.assertEqual("timeout", result["limited"]["error"])
+        self.assertIn(0.1, self.browser.timeouts)
+
+        # Query running past the deadline is cancelled
+        start = time.time()
+        result = self.browser.report(self.cell,
+                                     {"slow": {"query": "aggregate",
+                                               "delay": 2}},
+                                     workers=1, timeout=0.2)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual("timeout", result["slow"]["error"])
+
+
 def test_suite():
     suite = unittest.TestSuite()
 
     suite.addTest(unittest.makeSuite(AggregationBrowserTestCase))
     suite.addTest(unittest.makeSuite(CellsAndCutsTestCase))
+    suite.addTest(unittest.makeSuite(ReportTestCase))
 
     return suite
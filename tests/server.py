@@ -9,8 +9,25 @@ from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 
 from cubes.server import create_server
-
+from cubes.server.caching import *
+from cubes.server.utils import SlicerJSONEncoder
+from cubes.server.auth import PassParameterAuthenticator
+from cubes.auth import SimpleAuthorizer
+from cubes.errors import QueryTimeoutError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import ConfigParser
+import collections
+import datetime
+import decimal
+import tempfile
 import csv
+import os
 
 class SlicerTestCaseBase(CubesTestCaseBase):
     def setUp(self):
@@ -248,3 +265,388 @@ class SlicerAggregateTestCase(SlicerTestCaseBase):
         header = reader.next()
         self.assertSequenceEqual(["2013", "100", "5"],
                                  header)
+
+
+
+class SlicerColumnsTestCase(SlicerAggregateTestCase):
+    def test_aggregate_json_columns(self):
+        url = "cube/aggregate_test/aggregate?drilldown=item"
+        expected, status = self.get(url)
+
+        response, status = self.get(url + "&format=json_columns")
+        self.assertEqual(200, status)
+        self.assertNotIn("cells", response)
+        self.assertEqual(expected["summary"], response["summary"])
+        self.assertEqual(["item.name", "item.id", "amount_sum", "count"],
+                         response["labels"])
+
+        columns = response["columns"]
+        self.assertEqual([cell["item.name"] for cell in expected["cells"]],
+                         columns["item.name"])
+        self.assertEqual([cell["amount_sum"] for cell in expected["cells"]],
+                         columns["amount_sum"])
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class SlicerArrowTestCase(SlicerAggregateTestCase):
+    def read_table(self, url):
+        response = self.server.get(url)
+        self.assertEqual(200, response.status_code)
+
+        if "format=arrow" in url:
+            self.assertEqual("application/vnd.apache.arrow.stream",
+                             response.headers["Content-Type"])
+            return pyarrow.ipc.open_stream(response.data).read_all()
+        else:
+            buffer = pyarrow.BufferReader(response.data)
+            return pyarrow.parquet.read_table(buffer)
+
+    def test_facts_arrow(self):
+        expected, status = self.get("cube/aggregate_test/facts")
+
+        for output_format in ["arrow", "parquet"]:
+            url = "/cube/aggregate_test/facts?format=%s" % output_format
+            table = self.read_table(url)
+            self.assertEqual(len(expected), table.num_rows)
+
+            self.assertEqual(pyarrow.int64(),
+                             table.schema.field_by_name("amount").type)
+            self.assertEqual(pyarrow.string(),
+                             table.schema.field_by_name("item.name").type)
+
+            columns = table.to_pydict()
+            self.assertEqual([fact["amount"] for fact in expected],
+                             columns["amount"])
+
+    def test_aggregate_arrow(self):
+        url = "cube/aggregate_test/aggregate?drilldown=item"
+        expected, status = self.get(url)
+
+        for output_format in ["arrow", "parquet"]:
+            table = self.read_table("/%s&format=%s" % (url, output_format))
+            self.assertEqual(["item.name", "item.id", "amount_sum", "count"],
+                             table.schema.names)
+            self.assertEqual(pyarrow.int64(),
+                             table.schema.field_by_name("count").type)
+
+            columns = table.to_pydict()
+            self.assertEqual([cell["amount_sum"] for cell in expected["cells"]],
+                             columns["amount_sum"])
+
+    def test_empty_arrow(self):
+        url = "/cube/aggregate_test/facts?cut=item:100&format=arrow"
+        table = self.read_table(url)
+        self.assertEqual(0, table.num_rows)
+        self.assertIn("amount", table.schema.names)
+
+
+class SlicerTimeoutTestCase(SlicerAggregateTestCase):
+    def test_aggregate_timeout(self):
+        url = "cube/aggregate_test/aggregate"
+        response, status = self.get(url + "?timeout=5")
+        self.assertEqual(200, status)
+        self.assertEqual(1100, response["summary"]["amount_sum"])
+
+        response, status = self.get(url + "?timeout=soon")
+        self.assertEqual(400, status)
+        response, status = self.get(url + "?timeout=0")
+        self.assertEqual(400, status)
+
+        browser = self.workspace.browser(self.cube)
+        def aggregate(*args, **kwargs):
+            self.assertEqual(0.5, kwargs["timeout"])
+            raise QueryTimeoutError("Query did not finish in time")
+        browser.aggregate = aggregate
+
+        response, status = self.get(url + "?timeout=0.5")
+        self.assertEqual(503, status)
+        self.assertEqual("timeout", response["error"])
+
+    def test_unsupported_timeout(self):
+        browser = self.workspace.browser(self.cube)
+        browser.features = lambda: {"actions": ["facts", "members"]}
+
+        url = "cube/aggregate_test/"
+        for action in ["facts?timeout=5", "members/item?timeout=5",
+                       "aggregate?pagesize=2&after=token"]:
+            response, status = self.get(url + action)
+            self.assertEqual(400, status)
+
+
+class SlicerSampleTestCase(SlicerAggregateTestCase):
+    def test_aggregate_sample(self):
+        url = "cube/aggregate_test/aggregate"
+        response, status = self.get(url + "?sample=0.2")
+        self.assertEqual(200, status)
+        self.assertEqual("modulo", response["sample"]["method"])
+        self.assertEqual(1100, response["summary"]["amount_sum"])
+        self.assertIn("amount_sum_upper", response["summary"])
+
+        response, status = self.get(url + "?sample=some")
+        self.assertEqual(400, status)
+        response, status = self.get(url + "?sample=0")
+        self.assertEqual(400, status)
+
+
+class SlicerPaginationTestCase(SlicerAggregateTestCase):
+    def test_facts_next_page(self):
+        # Only facts 1 to 5 match the date dimension
+        url = "cube/aggregate_test/facts?pagesize=3"
+        response = self.server.get("/" + url)
+        self.assertEqual(200, response.status_code)
+        facts = json.loads(response.data)
+        self.assertEqual(3, len(facts))
+
+        after = response.headers["X-Cubes-Next-Page"]
+        response = self.server.get("/" + url + "&after=" + after)
+        facts += json.loads(response.data)
+        self.assertEqual(range(1, 6), [fact["id"] for fact in facts])
+        self.assertNotIn("X-Cubes-Next-Page", response.headers)
+
+        response, status = self.get("cube/aggregate_test/facts?after=" + after)
+        self.assertEqual(400, status)
+
+    def test_aggregate_next_page(self):
+        url = "cube/aggregate_test/aggregate?drilldown=item&pagesize=2"
+        response, status = self.get(url)
+        self.assertEqual(2, len(response["cells"]))
+
+        response, status = self.get(url + "&after=" + response["next_page"])
+        self.assertEqual(200, status)
+        self.assertEqual(1, len(response["cells"]))
+        self.assertNotIn("next_page", response)
+
+
+class SlicerExportTestCase(SlicerAggregateTestCase):
+    def authorize(self):
+        rights = {
+            "exporter": {"allowed_cubes": ["*"], "unlimited_export": True},
+            "viewer": {"allowed_cubes": ["*"]}
+        }
+        self.workspace.authorizer = SimpleAuthorizer(rights=rights)
+        self.slicer.slicer.authenticator = PassParameterAuthenticator()
+        self.slicer.slicer.json_record_limit = 3
+
+    def test_record_limit(self):
+        self.authorize()
+        url = "cube/aggregate_test/facts?api_key=viewer"
+        response, status = self.get(url)
+        self.assertEqual(200, status)
+        self.assertEqual(3, len(response))
+
+        response, status = self.get(url + "&unlimited=true")
+        self.assertEqual(403, status)
+
+    def test_unlimited_export(self):
+        self.authorize()
+        url = "cube/aggregate_test/facts?api_key=exporter"
+        response, status = self.get(url)
+        self.assertEqual(3, len(response))
+
+        response, status = self.get(url + "&unlimited=true")
+        self.assertEqual(200, status)
+        self.assertEqual(5, len(response))
+
+
+class SlicerJSONEncoderTestCase(unittest.TestCase):
+    def test_same_as_json(self):
+        obj = collections.OrderedDict([
+            ("list", [1, 2.5, None, True, "text", u"\u017eltu\u0161k\xfd"]),
+            ("empty", {}),
+            ("nested", {"a": [], "b": [{"c": (1, 2)}]}),
+            ("number", 10),
+            (1, "integer key")
+        ])
+
+        for indent in [None, 4]:
+            encoder = SlicerJSONEncoder(indent=indent)
+            self.assertEqual(json.dumps(obj, indent=indent),
+                             "".join(encoder.iterencode(obj)))
+
+    def test_converted_values(self):
+        encoder = SlicerJSONEncoder()
+        obj = [decimal.Decimal("1.5"), datetime.date(2013, 9, 1)]
+        self.assertEqual('[1.5, "2013-09-01"]', encoder.encode(obj))
+
+        with self.assertRaises(TypeError):
+            encoder.encode(object())
+
+    def test_streamed_iterator(self):
+        fetched = []
+
+        def records():
+            for i in range(10):
+                fetched.append(i)
+                yield {"id": i}
+
+        encoder = SlicerJSONEncoder()
+        encoder.chunk_size = 1
+        chunks = encoder.iterencode({"cells": records()})
+
+        # Records are fetched while the output is being consumed
+        first = next(chunks)
+        self.assertEqual("{", first)
+        self.assertEqual([], fetched)
+
+        output = first + "".join(chunks)
+        self.assertEqual(10, len(fetched))
+        self.assertEqual(10, len(json.loads(output)["cells"]))
+
+    def test_streamed_same_as_json(self):
+        rows = [{"id": i, "amount": decimal.Decimal("1.5"),
+                 "path": [i, {"date": datetime.date(2013, 9, i + 1)}]}
+                for i in range(3)]
+        obj = collections.OrderedDict([
+            ("result", {"cells": iter(rows), "count": 3}),
+            ("empty", iter([])),
+            ("summary", {"amount": 4.5})
+        ])
+        expected = collections.OrderedDict([
+            ("result", {"cells": rows, "count": 3}),
+            ("empty", []),
+            ("summary", {"amount": 4.5})
+        ])
+
+        for indent in [None, 4]:
+            encoder = SlicerJSONEncoder(indent=indent)
+            obj["result"]["cells"] = iter(rows)
+            obj["empty"] = iter([])
+            self.assertEqual(json.dumps(expected, indent=indent,
+                                        default=encoder.default),
+                             "".join(encoder.iterencode(obj)))
+
+    def test_iterator_limit(self):
+        encoder = SlicerJSONEncoder()
+        encoder.iterator_limit = 3
+        self.assertEqual("[0, 1, 2]", encoder.encode(iter(range(10))))
+        # Lists are not limited
+        self.assertEqual(10, len(json.loads(encoder.encode(range(10)))))
+
+        encoder.iterator_limit = None
+        self.assertEqual(10, len(json.loads(encoder.encode(xrange(10)))))
+
+
+class SlicerCacheTestCase(SlicerAggregateTestCase):
+    def setUp(self):
+        super(SlicerCacheTestCase, self).setUp()
+        self.cache = MemoryCache(ttl=60)
+        self.slicer.slicer.cache = self.cache
+
+    def test_cached_aggregate(self):
+        url = "cube/aggregate_test/aggregate?drilldown=date"
+        response, status = self.get(url)
+        self.assertEqual(200, status)
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+        # Change data – cached response should be returned
+        self.engine.execute(self.facts.delete())
+        cached, status = self.get(url)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(response, cached)
+
+        # Different drilldown is a different key
+        response, status = self.get(url + "&drilldown=item")
+        self.assertEqual(2, self.cache.misses)
+
+        # Streamed CSV is not cached
+        response, status = self.get(url + "&format=csv")
+        response, status = self.get(url + "&format=csv")
+        self.assertEqual(4, self.cache.misses)
+
+        response, status = self.get("info")
+        self.assertEqual(1, response["cache"]["hits"])
+
+    def test_restricted_report_cell(self):
+        rights = {
+            "viewer": {
+                "allowed_cubes": ["*"],
+                "cell_restrictions": {"aggregate_test": ["item:2"]}
+            },
+            "admin": {"allowed_cubes": ["*"]}
+        }
+        self.workspace.authorizer = SimpleAuthorizer(rights=rights)
+        self.slicer.slicer.authenticator = PassParameterAuthenticator()
+
+        report = {
+            "cell": [{"type": "point", "dimension": "date", "path": [2013]}],
+            "queries": {"summary": {"query": "aggregate"}}
+        }
+
+        def post(identity):
+            url = "/cube/aggregate_test/report?api_key=" + identity
+            response = self.server.post(url, data=json.dumps(report))
+            self.assertEqual(200, response.status_code)
+            return json.loads(response.data)["summary"]["summary"]
+
+        # Cell of the report is restricted the same way as the URL cell and
+        # the restricted response is not served to other identities
+        self.assertIsNone(post("viewer")["amount_sum"])
+        self.assertEqual(100, post("admin")["amount_sum"])
+        self.assertIsNone(post("viewer")["amount_sum"])
+        self.assertEqual(1, self.cache.hits)
+
+    def test_cube_ttl(self):
+        self.cache.cube_ttl["aggregate_test"] = -1
+        url = "cube/aggregate_test/aggregate"
+        self.get(url)
+        self.get(url)
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(2, self.cache.misses)
+
+
+class CacheTestCase(unittest.TestCase):
+    def test_memory_lru(self):
+        cache = MemoryCache(max_items=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual({"hits": 3, "misses": 1, "hit_ratio": 0.75},
+                         cache.statistics())
+
+    def test_memory_bytes(self):
+        cache = MemoryCache(max_bytes=1000)
+        self.assertFalse(cache.set("big", "x" * 2000))
+        cache.set("a", "x" * 400)
+        cache.set("b", "x" * 400)
+        cache.set("c", "x" * 400)
+        self.assertEqual(2, len(cache))
+        self.assertLessEqual(cache.size, 1000)
+        self.assertIsNone(cache.get("a"))
+
+    def test_file_cache(self):
+        path = tempfile.mktemp(suffix=".sqlite")
+        try:
+            cache = FileCache(path=path)
+            cache.set("a", {"data": "x"})
+            cache.set("b", 2, ttl=-1)
+            self.assertEqual({"data": "x"}, cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+
+            cache = FileCache(path=path)
+            self.assertEqual({"data": "x"}, cache.get("a"))
+            cache.clear()
+            self.assertIsNone(cache.get("a"))
+        finally:
+            os.remove(path)
+
+    def test_configured_cache(self):
+        config = ConfigParser.SafeConfigParser()
+        self.assertIsNone(configured_cache(config))
+
+        config.add_section("cache")
+        config.set("cache", "type", "memory")
+        config.set("cache", "max_items", "10")
+        config.add_section("cache_ttl")
+        config.set("cache_ttl", "sales", "3600")
+
+        cache = configured_cache(config)
+        self.assertIsInstance(cache, MemoryCache)
+        self.assertEqual(10, cache.max_items)
+        self.assertEqual(3600, cache.ttl_for_cube("sales"))
+        self.assertEqual(60, cache.ttl_for_cube("other"))
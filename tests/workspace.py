@@ -60,6 +60,36 @@ class WorkspaceModelTestCase(WorkspaceTestCaseBase):
         cube = ws.cube("local.contracts")
         self.assertEqual("local.contracts", cube.name)
 
+    def test_browser_pool(self):
+        ws = Workspace()
+        ws.register_default_store("sql", url="sqlite://")
+        ws.import_model(self.model_path("model.json"))
+
+        browser = ws.browser("contracts")
+        self.assertIs(browser, ws.browser("contracts"))
+        self.assertIsNot(browser, ws.browser("contracts", locale="sk"))
+
+        # Model import flushes the pool
+        ws.import_model(self.model_path("sales_no_date.json"))
+        self.assertEqual(0, len(ws.browser_pool))
+        self.assertIsNot(browser, ws.browser("contracts"))
+
+    def test_browser_pool_eviction(self):
+        pool = BrowserPool(2)
+        pool.put("a", 1)
+        pool.put("b", 2)
+        self.assertEqual(1, pool.get("a"))
+        pool.put("c", 3)
+
+        self.assertEqual(2, len(pool))
+        self.assertIsNone(pool.get("b"))
+        self.assertEqual(1, pool.get("a"))
+        self.assertEqual(3, pool.get("c"))
+
+        pool = BrowserPool(0)
+        pool.put("a", 1)
+        self.assertIsNone(pool.get("a"))
+
     def test_get_dimension(self):
         ws = self.default_workspace()
         dim = ws.dimension("date")